@@ -0,0 +1,32 @@
+"""
+The plugin runs inside SIP, so the tests need a SIP installation: set SIP_DIR to its
+directory. The tests are skipped without one.
+"""
+import builtins
+import importlib.util
+import os
+import sys
+
+import pytest
+
+PLUGIN_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "water_tank.py")
+
+
+@pytest.fixture(scope="session")
+def plugin():
+    """The water_tank module, imported without starting its background work"""
+    sip_dir = os.environ.get("SIP_DIR")
+    if not sip_dir:
+        pytest.skip("SIP_DIR is not set")
+    if sip_dir not in sys.path:
+        sys.path.insert(0, sip_dir)
+    if not hasattr(builtins, "_"):
+        builtins._ = lambda s: s    # installed by SIP's i18n at startup
+    os.environ["WATER_TANK_NO_AUTOSTART"] = "1"
+    spec = importlib.util.spec_from_file_location("water_tank", PLUGIN_FILE)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as e:
+        pytest.skip("SIP modules not importable from SIP_DIR: {}".format(e))
+    return module
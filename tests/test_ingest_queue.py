@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+
+class Message():
+    def __init__(self, sensor_id, measurement, topic = "tanks"):
+        self.topic = topic
+        self.payload = json.dumps({"sensor_id": sensor_id, "measurement": measurement}).encode("utf-8")
+
+
+SENSORS = {"S{}".format(i): ["t{}".format(i)] for i in range(1, 5)}
+
+
+@pytest.fixture
+def posted(plugin, monkeypatch):
+    """Commands posted to the state thread, which is not running; readings of 90 and more are in the upper band"""
+    commands = []
+    monkeypatch.setattr(plugin.state_actor, "Post", commands.append)
+    monkeypatch.setattr(plugin.sensor_topic_router, "Band", lambda ids, measurement: (measurement >= 90,))
+    return commands
+
+
+def drain(posted):
+    while posted:
+        posted.pop(0)()
+
+
+def test_full_queue_makes_room_for_band_change(plugin, posted, monkeypatch):
+    processed = []
+    monkeypatch.setattr(plugin, "process_sensor_mqtt_message", lambda msg, sensors, cmd: processed.append(cmd))
+    queue = plugin.SensorIngestQueue(max_size = 3)
+    for sensor_id in ["S1", "S2", "S3"]:
+        queue.Put(Message(sensor_id, 10), SENSORS)
+    drain(posted)
+    for sensor_id in ["S1", "S2", "S3"]:
+        queue.Put(Message(sensor_id, 20), SENSORS)
+
+    queue.Put(Message("S4", 95), SENSORS)
+    assert queue.Stats()["dropped"] == 1
+    assert queue.Stats()["overflowed"] == 0
+    assert [entry["cmd"]["sensor_id"] for entry in queue.queue] == ["S2", "S3", "S4"]
+    queue.Put(Message("S1", 96), SENSORS)
+    queue.Put(Message("S2", 95), SENSORS)
+    assert queue.Stats()["dropped"] == 3
+    # with no routine reading left to drop the band change is lost
+    queue.Put(Message("S3", 99), SENSORS)
+    assert queue.Stats()["overflowed"] == 1
+
+    del processed[:]
+    drain(posted)
+    assert [(cmd["sensor_id"], cmd["measurement"]) for cmd in processed] == [("S4", 95), ("S1", 96), ("S2", 95)]
+
+
+def test_drain_continues_after_exception(plugin, posted, monkeypatch):
+    processed = []
+
+    def process(msg, sensors, cmd):
+        processed.append(cmd["sensor_id"])
+        if cmd["sensor_id"] == "S1":
+            raise IOError("data file not readable")
+
+    monkeypatch.setattr(plugin, "process_sensor_mqtt_message", process)
+    queue = plugin.SensorIngestQueue()
+    queue.Put(Message("S1", 10), SENSORS)
+    queue.Put(Message("S2", 10), SENSORS)
+    drain(posted)
+    assert processed == ["S1", "S2"]
+    assert not queue.scheduled
+
+    queue.Put(Message("S3", 10), SENSORS)
+    drain(posted)
+    assert processed == ["S1", "S2", "S3"]
+
+
+def test_merged_readings_are_logged(plugin, posted, monkeypatch):
+    logged = []
+    monkeypatch.setattr(plugin, "get_settings", lambda: {plugin.SENSOR_LOG_ENABLED: True})
+    monkeypatch.setattr(plugin, "log_sensor_msg", logged.append)
+    monkeypatch.setattr(plugin.sensor_topic_router, "Route", lambda topic: SENSORS)
+    queue = plugin.SensorIngestQueue()
+    monkeypatch.setattr(plugin, "sensor_ingest_queue", queue)
+    for measurement in [10, 11, 12, 13]:
+        plugin.on_sensor_mqtt_message(None, Message("S1", measurement))
+    assert queue.Stats()["merged"] == 2
+    assert len(queue.queue) == 2
+    assert len(logged) == 4
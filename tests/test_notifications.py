@@ -0,0 +1,24 @@
+import pytest
+
+
+@pytest.fixture
+def delivered(plugin, monkeypatch):
+    """Notifications delivered, through a governor of its own"""
+    messages = []
+    monkeypatch.setattr(plugin, "deliver_notification", lambda event, msg, xmpp, email: messages.append((event, msg)))
+    monkeypatch.setattr(plugin, "notification_governor", plugin.NotificationGovernor(cooldown = 300, max_cooldown = 21600, max_per_hour = 60))
+    return messages
+
+
+def test_repeated_sensor_noise_is_throttled(plugin, delivered):
+    for i in range(100):
+        plugin.send_notification("S1", "Invalid measurement", "reading {}".format(i), True, False)
+    assert delivered == [("Invalid measurement", "reading 0")]
+
+
+def test_state_notifications_are_not_throttled(plugin, delivered):
+    for i in range(100):
+        plugin.send_notification("S1", "Invalid measurement", "reading {}".format(i), True, False)
+    for event in ["Critical", "Warning", "Critical"]:
+        plugin.send_state_notification(event, "entered " + event, True, True)
+    assert delivered[1:] == [("Critical", "entered Critical"), ("Warning", "entered Warning"), ("Critical", "entered Critical")]
@@ -0,0 +1,140 @@
+import smtplib
+import socket
+import time
+
+import pytest
+
+controller = pytest.importorskip("aiosmtpd.controller")
+smtp = pytest.importorskip("aiosmtpd.smtp")
+
+
+class Mailbox():
+    """aiosmtpd handler keeping the messages it receives"""
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope.content.decode("utf-8", "replace"))
+        return "250 OK"
+
+
+def accept_any_login(server, session, envelope, mechanism, auth_data):
+    return smtp.AuthResult(success = True)
+
+
+class MailServer():
+    """SMTP stand-in that can be stopped and started again on the same port"""
+    def __init__(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.mailbox = Mailbox()
+        self.controller = None
+
+    def Start(self):
+        self.controller = controller.Controller(self.mailbox, hostname = "127.0.0.1", port = self.port,
+                                                authenticator = accept_any_login, auth_require_tls = False)
+        self.controller.start()
+
+    def Stop(self):
+        self.controller.stop()
+        self.controller = None
+
+    def Received(self, text):
+        return sum(1 for message in self.mailbox.messages if text in message)
+
+
+@pytest.fixture
+def mail_server():
+    server = MailServer()
+    server.Start()
+    yield server
+    if server.controller is not None:
+        server.Stop()
+
+
+@pytest.fixture
+def mail_settings(plugin, mail_server, monkeypatch):
+    """E-mail settings of the plugin pointing at mail_server"""
+    settings = {
+        plugin.EMAIL_USERNAME: "sip@example.com", plugin.EMAIL_PASSWORD: "secret",
+        plugin.EMAIL_SERVER: "127.0.0.1", plugin.EMAIL_SERVER_PORT: mail_server.port,
+        plugin.EMAIL_SUBJECT: "Water tank", plugin.EMAIL_RECIPIENTS: "owner@example.com",
+    }
+    monkeypatch.setattr(plugin, "get_settings", lambda: settings)
+    # the stand-in speaks plain SMTP
+    monkeypatch.setattr(smtplib, "SMTP_SSL", smtplib.SMTP)
+    return settings
+
+
+@pytest.fixture
+def sender(plugin, mail_settings, tmp_path, monkeypatch):
+    """An outbox sender delivering e-mail to mail_server, with retries and breaker timings of a fraction of a second"""
+    monkeypatch.setattr(plugin, "OUTBOX_RETRY_SECONDS", 0.05)
+    outbox = plugin.NotificationOutbox(str(tmp_path / "outbox.db"))
+    monkeypatch.setattr(plugin, "notification_outbox", outbox)
+    sender = plugin.OutboxSender(outbox, {plugin.OUTBOX_EMAIL: plugin.email_deliver})
+    sender.breakers[plugin.OUTBOX_EMAIL] = plugin.CircuitBreaker(failure_threshold = 3, open_seconds = 0.2)
+    return sender
+
+
+def send_until_empty(sender, timeout = 10):
+    deadline = time.time() + timeout
+    while sender.outbox.NextAttempt() is not None and time.time() < deadline:
+        sender.SendDue()
+        time.sleep(0.02)
+
+
+def test_outbox_delivers_once_after_mail_server_outage(plugin, mail_server, sender):
+    breaker = sender.breakers[plugin.OUTBOX_EMAIL]
+    plugin.email_send_msg("level is 95%", "Overflow")
+    send_until_empty(sender)
+    assert mail_server.Received("level is 95%") == 1
+
+    mail_server.Stop()
+    texts = ["level is {}%".format(p) for p in (29, 14, 9)]
+    for text in texts:
+        plugin.email_send_msg(text, "Warning")
+    sender.SendDue()
+    assert breaker.open_until is not None
+    assert len(sender.outbox.Due(time.time() + 3600)) == len(texts)
+    # once the retries are due the open breaker still holds them back
+    attempts = [n["attempts"] for n in sender.outbox.Due(time.time() + 3600)]
+    time.sleep(0.1)
+    assert len(sender.outbox.Due(time.time())) == len(texts)
+    sender.SendDue()
+    assert [n["attempts"] for n in sender.outbox.Due(time.time() + 3600)] == attempts
+
+    mail_server.Start()
+    send_until_empty(sender)
+    assert sender.outbox.NextAttempt() is None
+    assert breaker.open_until is None
+    sender.SendDue()
+    for text in texts:
+        assert mail_server.Received(text) == 1
+    assert mail_server.Received("level is 95%") == 1
+
+
+def test_sender_thread_idles_while_breaker_is_open(plugin, mail_server, mail_settings, tmp_path, monkeypatch):
+    outbox = plugin.NotificationOutbox(str(tmp_path / "outbox.db"))
+    sender = plugin.OutboxSender(outbox, {plugin.OUTBOX_EMAIL: plugin.email_deliver})
+    breaker = sender.breakers[plugin.OUTBOX_EMAIL] = plugin.CircuitBreaker(failure_threshold = 1, open_seconds = 60)
+    due = outbox.Due
+    calls = []
+    monkeypatch.setattr(outbox, "Due", lambda now: calls.append(now) or due(now))
+    mail_server.Stop()
+    sender.start()
+
+    outbox.Add(plugin.OUTBOX_EMAIL, "level is 95%", "Overflow")
+    deadline = time.time() + 10
+    while breaker.open_until is None and time.time() < deadline:
+        time.sleep(0.02)
+    assert breaker.open_until is not None
+    # a notification added while the breaker is open waits for it
+    outbox.Add(plugin.OUTBOX_EMAIL, "level is 96%", "Overflow")
+    time.sleep(0.2)
+    calls.clear()
+    time.sleep(0.5)
+    assert len(calls) <= 1
+    waiting = [n for n in due(time.time() + 3600) if n["text"] == "level is 96%"]
+    assert waiting[0]["next_attempt"] == breaker.open_until
@@ -0,0 +1,117 @@
+import json
+from datetime import datetime
+
+import pytest
+
+SINGLE = {"sensor_id": "S1", "measurement": 1.5}
+MULTI = [{"sensor_id": "S1", "measurement": 1.4}, {"sensor_id": "S2", "measurement": 0.7}]
+
+
+def record(minute, payload):
+    return {"date": "2026-10-19 12:{:02d}:00".format(minute), "mqtt_topic": "tanks",
+            "mqtt_payload": str(json.dumps(payload).encode("utf-8"))}
+
+
+RECORDS = [record(0, SINGLE), record(1, MULTI), record(2, {"sensor_id": "S3", "measurement": 1.0})]
+
+
+@pytest.fixture(params = ["json", "sqlite"])
+def storage(request, plugin, tmp_path, monkeypatch):
+    if request.param == "sqlite":
+        return plugin.SqliteStorage(str(tmp_path / "water_tank.db"))
+    monkeypatch.setattr(plugin, "LOG_FILE", str(tmp_path / "sensor_log.json"))
+    return plugin.JsonStorage()
+
+
+def test_payload_sensor_ids_of_list_payload(plugin):
+    assert plugin.payload_sensor_ids(json.dumps(MULTI).encode("utf-8")) == ["S1", "S2"]
+    assert plugin.payload_sensor_ids(RECORDS[1]["mqtt_payload"]) == ["S1", "S2"]
+    assert plugin.payload_sensor_ids(b"garbage") == []
+
+
+def test_storage_query_finds_list_payloads_by_sensor(plugin, storage):
+    for r in RECORDS:
+        storage.AppendSensorLog(r, 0)
+    dates = lambda records: [r["date"][-5:] for r in records]
+    assert dates(storage.QuerySensorLog(sensor_id = "S1")) == ["01:00", "00:00"]
+    assert dates(storage.QuerySensorLog(sensor_id = "S2")) == ["01:00"]
+    assert dates(storage.QuerySensorLog(sensor_id = "S1", limit = 1)) == ["01:00"]
+
+    storage.ReplaceSensorLog(list(storage.ReadSensorLog())[:2])
+    assert dates(storage.QuerySensorLog(sensor_id = "S2")) == ["01:00"]
+    assert dates(storage.QuerySensorLog(sensor_id = "S1")) == ["01:00"]
+
+
+def test_sqlite_log_trims_sensor_index(plugin, tmp_path):
+    storage = plugin.SqliteStorage(str(tmp_path / "water_tank.db"))
+    for minute in range(10):
+        storage.AppendSensorLog(record(minute, MULTI), 4)
+    assert len(list(storage.QuerySensorLog(sensor_id = "S2"))) == 4
+    assert storage.connection.execute("SELECT COUNT(*) FROM sensor_log_sensors").fetchone()[0] == 8
+
+
+def test_binary_log_finds_list_payloads_by_sensor(plugin, tmp_path):
+    log = plugin.BinarySensorLog(str(tmp_path / "sensor_log.bin"))
+    for minute in range(10):
+        payload = MULTI if minute % 2 else SINGLE
+        log.Append(datetime(2026, 10, 19, 12, minute).timestamp(), "tanks", json.dumps(payload).encode("utf-8"), 4)
+    minutes = lambda records: [r["date"][-5:-3] for r in records]
+    # compacted to the newest 4 at 8 records
+    assert minutes(log.Query(sensor_id = "S2")) == ["09", "07", "05"]
+    assert minutes(log.Query(sensor_id = "S1")) == ["09", "08", "07", "06", "05", "04"]
+    assert minutes(log.Query(topic = "tanks", sensor_id = "S2", limit = 1)) == ["09"]
+
+
+def append_minutes(log, minutes, max_records = 0):
+    for minute in minutes:
+        log.Append(datetime(2026, 10, 19, 12, minute).timestamp(), "tanks", json.dumps(MULTI if minute % 2 else SINGLE).encode("utf-8"), max_records)
+
+
+def test_binary_log_recovers_from_interrupted_append(plugin, tmp_path):
+    file_name = str(tmp_path / "sensor_log.bin")
+    append_minutes(plugin.BinarySensorLog(file_name), range(3))
+    # a crash after the data and keys of a record but before its index entry
+    with open(file_name, "ab") as f:
+        f.write(plugin.BinarySensorLog.HEADER.pack(0, 0, 100) + b"{")
+    with open(file_name + ".sensor_keys", "ab") as f:
+        f.write(plugin.BinarySensorLog.KEYS.pack(3, 0, 1) + b"\0")
+    # and an index entry whose record did not make it to disk
+    with open(file_name + ".idx", "ab") as f:
+        f.write(plugin.BinarySensorLog.OFFSET.pack(10 ** 6))
+
+    log = plugin.BinarySensorLog(file_name)
+    append_minutes(log, [3])
+    minutes = lambda records: [r["date"][-5:-3] for r in records]
+    assert minutes(log.Read()) == ["03", "02", "01", "00"]
+    assert minutes(log.Query(sensor_id = "S2")) == ["03", "01"]
+    assert minutes(plugin.BinarySensorLog(file_name).Query(sensor_id = "S1")) == ["03", "02", "01", "00"]
+
+
+def test_binary_log_finishes_interrupted_compaction(plugin, tmp_path, monkeypatch):
+    file_name = str(tmp_path / "sensor_log.bin")
+    log = plugin.BinarySensorLog(file_name)
+    append_minutes(log, range(7), 4)
+    replace = plugin.os.replace
+
+    def crash_after_data(source, destination):
+        replace(source, destination)
+        if destination == file_name:
+            raise KeyboardInterrupt("crash")
+
+    monkeypatch.setattr(plugin.os, "replace", crash_after_data)
+    with pytest.raises(KeyboardInterrupt):
+        append_minutes(log, [7], 4)
+    monkeypatch.setattr(plugin.os, "replace", replace)
+
+    log = plugin.BinarySensorLog(file_name)
+    minutes = lambda records: [r["date"][-5:-3] for r in records]
+    assert minutes(log.Read()) == ["07", "06", "05", "04"]
+    assert minutes(log.Query(sensor_id = "S2")) == ["07", "05"]
+
+
+def test_binary_log_rejects_topics_past_limit(plugin, tmp_path, monkeypatch):
+    monkeypatch.setattr(plugin.BinarySensorLog, "MAX_TOPICS", 2)
+    log = plugin.BinarySensorLog(str(tmp_path / "sensor_log.bin"))
+    for topic in ["a", "b", "c", "a"]:
+        log.Append(0.0, topic, json.dumps(SINGLE).encode("utf-8"), 0)
+    assert [r["mqtt_topic"] for r in log.Read()] == ["a", "b", "a"]
@@ -0,0 +1,107 @@
+import random
+
+import pytest
+
+INTERVAL = 60       # seconds between readings
+LEAD_MINUTES = 30
+
+
+def water_tank_form(**fields):
+    """A 2 m high tank: overflow 90/80, warning 30/40, critical 10/15, running program 1 on overflow"""
+    form = {
+        "id": "t1", "label": "Tank", "type": "1", "sensor_mqtt_topic": "tank", "sensor_id": "S1",
+        "sensor_offset_from_top": "0", "max_sensor_no_signal_time": "60", "water_tank_units": "2",
+        "sensor_units": "2", "enabled": "on", "width": "1", "length": "1", "height": "2",
+        "overflow_level": "90", "overflow_safe_level": "80", "warning_level": "30", "warning_safe_level": "40",
+        "critical_level": "10", "critical_safe_level": "15", "predictive_lead_minutes": str(LEAD_MINUTES),
+        "overflow_pr_run_1": "on", "critical_pr_run_1": "on",
+    }
+    for name in ["overflow", "warning", "critical"]:
+        for i in range(8):
+            form["{}_sn_minutes_{}".format(name, i)] = ""
+            form["{}_sn_percentage_{}".format(name, i)] = ""
+    form.update(fields)
+    return form
+
+
+def simulate(plugin, percentages, **fields):
+    wt = plugin.WaterTankFactory.FromDict(water_tank_form(**fields))
+    times = [i * INTERVAL for i in range(len(percentages))]
+    report = plugin.WaterTankSimulator(wt).Run(percentages, plugin.WaterTankState.NORMAL, times = times)
+    assert report["predictive"]
+    return report["events"]
+
+
+def events_of(events, kind, event = None):
+    return [e for e in events if e["type"] == kind and (event is None or e.get("event") == event)]
+
+
+def first_crossing(percentages, level, direction):
+    return next(i for i, p in enumerate(percentages) if direction * (p - level) >= 0)
+
+
+@pytest.mark.parametrize("percentages, event, level, direction", [
+    ([50 + 1.0 * i for i in range(60)], "overflow", 90, 1),     # filling 1 %/min
+    ([50 - 1.0 * i for i in range(50)], "critical", 10, -1),    # draining 1 %/min
+])
+def test_predict_ahead_of_crossing_by_lead_time(plugin, percentages, event, level, direction):
+    events = simulate(plugin, percentages)
+    predictions = events_of(events, "predict", event)
+    assert len(predictions) == 1
+    ahead = (first_crossing(percentages, level, direction) - predictions[0]["sample"]) * INTERVAL
+    assert LEAD_MINUTES * 60 - INTERVAL <= ahead <= LEAD_MINUTES * 60 + INTERVAL
+    # the reactions are activated with the prediction
+    assert [e["sample"] for e in events_of(events, "run_programs", event)] == [predictions[0]["sample"]]
+
+
+def test_real_entry_after_predict_does_not_activate_again(plugin):
+    percentages = [50 + 1.0 * i for i in range(60)]
+    events = simulate(plugin, percentages)
+    crossing = first_crossing(percentages, 90, 1)
+    entries = [e for e in events_of(events, "state") if e["new"] == "OVERFLOW"]
+    assert [e["sample"] for e in entries] == [crossing]
+    assert len(events_of(events, "run_programs", "overflow")) == 1
+    assert events_of(events, "run_programs", "overflow")[0]["sample"] < crossing
+    assert not events_of(events, "unpredict")
+
+
+def test_unpredict_once_past_safe_level(plugin):
+    # fills to 85 %, past the safe level but short of overflow, then drains
+    percentages = [50 + 1.0 * i for i in range(36)] + [85 - 0.5 * i for i in range(1, 40)]
+    events = simulate(plugin, percentages)
+    assert len(events_of(events, "predict", "overflow")) == 1
+    assert not [e for e in events_of(events, "state") if e["new"] == "OVERFLOW"]
+    unpredictions = events_of(events, "unpredict", "overflow")
+    assert len(unpredictions) == 1
+    sample = unpredictions[0]["sample"]
+    # kept while draining above the safe level, reverted on the first reading below it
+    assert percentages[sample - 1] >= 80 > percentages[sample]
+    assert [e["sample"] for e in events_of(events, "stop_programs", "overflow")] == [sample]
+
+
+def test_no_significant_rate_for_noisy_flat_readings(plugin):
+    # at 3 standard errors about 0.3 % of flat series still show a significant slope by chance
+    significant = 0
+    for seed in range(200):
+        rng = random.Random(seed)
+        trend = plugin.FillTrend(window = 600, t_statistic = 3.0)
+        for i in range(120):
+            trend.Add("t1", 0.5 + rng.gauss(0, 0.02), i * 10.0)
+        assert trend.Rate("t1") is not None
+        if trend.SignificantRate("t1") is not None:
+            significant += 1
+    assert significant <= 2
+
+
+def test_significant_rate_for_noisy_ramp(plugin):
+    rng = random.Random(1)
+    trend = plugin.FillTrend(window = 600, t_statistic = 3.0)
+    for i in range(120):
+        trend.Add("t1", 0.2 + 0.0002 * i * 10.0 + rng.gauss(0, 0.005), i * 10.0)
+    assert trend.SignificantRate("t1") == pytest.approx(0.0002, rel = 0.1)
+
+
+def test_synthetic_trajectory_is_bounded(plugin):
+    assert len(plugin.synthetic_trajectory("sine", plugin.SIMULATION_SAMPLES, 0, 100)) == plugin.SIMULATION_SAMPLES
+    with pytest.raises(ValueError):
+        plugin.synthetic_trajectory("ramp", plugin.SIMULATION_MAX_SAMPLES + 1, 0, 100)
@@ -0,0 +1,104 @@
+import itertools
+import random
+
+import pytest
+
+
+def reference_state(plugin, levels, percentage, state):
+    """The if-chain WaterTank.CalculateNewState used before the band table"""
+    S = plugin.WaterTankState
+    overflow_level, overflow_safe_level, warning_level, warning_safe_level, critical_level, critical_safe_level = levels
+    if overflow_level is not None and percentage >= overflow_level:
+        return S.OVERFLOW
+    if (overflow_safe_level is not None and state in [S.OVERFLOW, S.OVERFLOW_UNSAFE] and
+            percentage >= overflow_safe_level and percentage < overflow_level):
+        return S.OVERFLOW_UNSAFE
+    if critical_level is not None and percentage <= critical_level:
+        return S.CRITICAL
+    if (critical_safe_level is not None and state in [S.CRITICAL, S.CRITICAL_UNSAFE] and
+            percentage <= critical_safe_level and percentage > critical_level):
+        return S.CRITICAL_UNSAFE
+    if warning_level is not None and percentage <= warning_level:
+        return S.WARNING
+    if (warning_safe_level is not None and state in [S.WARNING, S.WARNING_UNSAFE] and
+            percentage <= warning_safe_level and percentage > warning_level):
+        return S.WARNING_UNSAFE
+    return S.NORMAL
+
+
+def reference_transition(plugin, old, new):
+    """The (revert programs of old, activate programs of new) conditions of WaterTank.SetState before the table"""
+    S = plugin.WaterTankState
+    exit_event = (
+        (old == S.OVERFLOW and new != S.OVERFLOW_UNSAFE) or
+        (old == S.OVERFLOW_UNSAFE and new != S.OVERFLOW) or
+        (old == S.CRITICAL and new != S.CRITICAL_UNSAFE) or
+        (old == S.CRITICAL_UNSAFE and new != S.CRITICAL) or
+        (old == S.WARNING and new != S.WARNING_UNSAFE) or
+        (old == S.WARNING_UNSAFE and new != S.WARNING)
+    )
+    enter_event = (
+        (new == S.OVERFLOW and old != S.OVERFLOW_UNSAFE) or
+        (new == S.CRITICAL and old != S.CRITICAL_UNSAFE) or
+        (new == S.WARNING and old != S.WARNING_UNSAFE)
+    )
+    return (exit_event, enter_event)
+
+
+def random_levels(rng):
+    """Levels of overflow, warning and critical as (level, safe level), a level may be unset and a safe level unset or on either side"""
+    levels = []
+    for i in range(3):
+        if rng.random() < 0.15:
+            levels += [None, None]
+        else:
+            level = rng.choice([rng.randint(0, 100), round(rng.uniform(0, 100), 2)])
+            safe_level = None if rng.random() < 0.15 else rng.choice([level, rng.randint(0, 100), round(rng.uniform(0, 100), 2)])
+            levels += [level, safe_level]
+    return levels
+
+
+def probe_percentages(rng, levels):
+    """Every level, just either side of it, the ends and random percentages"""
+    percentages = {0.0, 100.0, -5.0, 105.0}
+    for level in levels:
+        if level is not None:
+            percentages.update([level, level - 1e-9, level + 1e-9, level - 0.5, level + 0.5])
+    percentages.update(rng.uniform(-5, 105) for i in range(20))
+    return sorted(percentages)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_band_table_matches_if_chain(plugin, seed):
+    rng = random.Random(seed)
+    states = [None] + list(plugin.WaterTankState)
+    for i in range(50):
+        levels = random_levels(rng)
+        table = plugin.StateBandTable(*levels)
+        for percentage in probe_percentages(rng, levels):
+            for state in states:
+                assert table.State(percentage, state) == reference_state(plugin, levels, percentage, state), (levels, percentage, state)
+
+
+def test_band_table_treats_missing_level_as_unbounded(plugin):
+    # the if-chain raised comparing with a missing level, the table keeps a water tank already
+    # in the event in its unsafe state up to the safe level
+    S = plugin.WaterTankState
+    table = plugin.StateBandTable(None, 80, None, 40, None, 15)
+    for percentage in [0, 15, 40, 80, 100]:
+        assert table.State(percentage, None) == S.NORMAL
+        assert table.State(percentage, S.NORMAL) == S.NORMAL
+    assert table.State(85, S.OVERFLOW) == S.OVERFLOW_UNSAFE
+    assert table.State(79, S.OVERFLOW) == S.NORMAL
+    assert table.State(10, S.CRITICAL) == S.CRITICAL_UNSAFE
+    assert table.State(16, S.CRITICAL_UNSAFE) == S.NORMAL
+    assert table.State(35, S.WARNING) == S.WARNING_UNSAFE
+    assert table.State(41, S.WARNING) == S.NORMAL
+
+
+def test_state_transitions_of_every_pair(plugin):
+    states = [None] + list(plugin.WaterTankState)
+    pairs = [(old, new) for old, new in itertools.product(states, plugin.WaterTankState) if old != new]
+    assert set(plugin.STATE_TRANSITIONS) == set(pairs)
+    for old, new in pairs:
+        assert plugin.STATE_TRANSITIONS[(old, new)] == reference_transition(plugin, old, new), (old, new)
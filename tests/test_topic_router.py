@@ -0,0 +1,25 @@
+def water_tank(id, topic, sensor_id):
+    return {"id": id, "sensor_mqtt_topic": topic, "sensor_id": sensor_id}
+
+
+def test_route_exact_and_wildcard_topics(plugin):
+    router = plugin.SensorTopicRouter({
+        "t1": water_tank("t1", "tanks/garden", "S1"),
+        "t2": water_tank("t2", "tanks/+", "S2"),
+        "t3": water_tank("t3", "house/#", "S3"),
+        "t4": water_tank("t4", "house#", "S4"),
+    })
+    assert router.Route("tanks/garden") == {"S1": ["t1"], "S2": ["t2"]}
+    assert router.Route("house/roof/tank") == {"S3": ["t3"]}
+    assert router.Route("house#") == {"S4": ["t4"]}
+    assert router.Route("housex") is None
+
+
+def test_matched_topics_are_bounded(plugin, monkeypatch):
+    monkeypatch.setattr(plugin.SensorTopicRouter, "MATCHED_TOPICS", 3)
+    router = plugin.SensorTopicRouter({"t1": water_tank("t1", "tanks/+", "S1")})
+    for i in range(10):
+        router.Route("gateway/{}".format(i))
+        router.Route("tanks/garden")
+    assert len(router.matched) == 3
+    assert "tanks/garden" in router.matched
@@ -2,35 +2,112 @@ $(document).ready(function() {
   //
   // get all water tank info for initial setup
   var water_tanks = null;
-  var water_tank_settings = null;
 
-  setInterval(updateLastSensorUpdate, 1000);
+  //
+  // per-tank view model: the elements of the tank's row and the values last written to them,
+  // so that incoming data only touch what changed
+  var views = {};
+  var age_update_requested = false;
 
-  function updateLastSensorUpdate()
+  // "last updated" counters of all tanks are refreshed in a single animation frame
+  setInterval(requestLastSensorUpdate, 1000);
+
+  function requestLastSensorUpdate()
   {
-    if( water_tanks == null || water_tank_settings == null)
+    if( !age_update_requested )
     {
-      return; // no data has come in yet
+      age_update_requested = true;
+      window.requestAnimationFrame(updateLastSensorUpdate);
     }
+  }
 
-    Object.keys(water_tanks).forEach(e => {
-      // console.log(`key= $${e} value=$${water_tanks[e]}`);
-      const id = e;
-      const water_tank = water_tanks[e];
-      const time_passed_str = get_time_passed_str(water_tank.last_updated);
-      const exceeded = get_exceeded_4_dead_sensor(water_tank);
-      $(`#${water_tank.id}_last_updated`).text(time_passed_str);
-      if( exceeded.length == 0 )
+  function updateLastSensorUpdate()
+  {
+    age_update_requested = false;
+    const now = Date.now();
+    Object.values(views).forEach(view => {
+      const time_passed_str = get_time_passed_str(view.last_updated_ms, now);
+      if( time_passed_str != view.time_passed_str )
       {
-        $(`#${water_tank.id}_last_updated`).removeClass('exceeded');
+        view.last_updated_el.text(time_passed_str);
+        view.time_passed_str = time_passed_str;
       }
-      else
+      const exceeded = (now - view.last_updated_ms) > view.water_tank.max_sensor_no_signal_time*1000;
+      if( exceeded != view.exceeded )
       {
-        $(`#${water_tank.id}_last_updated`).addClass('exceeded');
+        view.last_updated_el.toggleClass('exceeded', exceeded);
+        view.exceeded = exceeded;
       }
     });
   }
 
+  function getViewValues(water_tank)
+  {
+    let text = "";
+    let width = 0;
+    if(!water_tank.invalid_sensor_measurement && water_tank.percentage != null)
+    {
+      width = Math.round(water_tank.percentage);
+      text = width + "%";
+    }
+    return {
+      state: DetermineWaterTankState(water_tank),
+      text: text,
+      width: width,
+      label: water_tank.label,
+      hidden: !water_tank.enabled
+    };
+  }
+
+  function createView(water_tank)
+  {
+    const row = $(`#${water_tank.id}`);
+    const last_updated_el = row.find(`#${water_tank.id}_last_updated`);
+    return Object.assign(getViewValues(water_tank), {
+      row: row,
+      label_el: row.find(".water-tank-label"),
+      last_updated_el: last_updated_el,
+      bar_el: row.find(".percent-bar"),
+      text_el: row.find("h4"),
+      water_tank: water_tank,
+      last_updated_ms: new Date(water_tank.last_updated).getTime(),
+      time_passed_str: last_updated_el.text(),
+      exceeded: last_updated_el.hasClass('exceeded')
+    });
+  }
+
+  function patchView(view, water_tank)
+  {
+    const values = getViewValues(water_tank);
+    if( values.state != view.state )
+    {
+      view.bar_el.removeClass(view.state).addClass(values.state);
+      view.text_el.removeClass(view.state).addClass(values.state);
+    }
+    if( values.width != view.width )
+    {
+      view.bar_el.css("width", values.width + "%");
+    }
+    if( values.text != view.text )
+    {
+      view.text_el.text(values.text);
+    }
+    if( values.label != view.label )
+    {
+      view.label_el.text(values.label);
+    }
+    if( values.hidden != view.hidden )
+    {
+      view.row.prop("hidden", values.hidden);
+    }
+    if( water_tank.last_updated != view.water_tank.last_updated )
+    {
+      view.last_updated_ms = new Date(water_tank.last_updated).getTime();
+    }
+    Object.assign(view, values);
+    view.water_tank = water_tank;
+  }
+
   function get_exceeded_4_dead_sensor(water_tank)
   {
     return (Date.now() - new Date(water_tank.last_updated)) > water_tank.max_sensor_no_signal_time*1000 ? "exceeded" : "";
@@ -44,9 +121,9 @@ $(document).ready(function() {
     }; return time_data;
   };
 
-  function get_time_passed_str(last_updated)
+  function get_time_passed_str(last_updated, now = Date.now())
   {
-    const time_passed = get_whole_values(Date.now() - new Date(last_updated), [1000,  60, 60, 24]);
+    const time_passed = get_whole_values(now - new Date(last_updated), [1000,  60, 60, 24]);
     // console.log("time_passed: ", time_passed);
     let time_passed_str = "";
     if(time_passed[4]>0)
@@ -105,26 +182,6 @@ $(document).ready(function() {
     let hidden = !water_tank.enabled ? "hidden" : "";
     // console.log(`Water_tank_id:${water_tank.id}, enabled: ${water_tank.enabled}, hidden:${hidden}`);
 
-    // I need to synchronously fetch the water_tank plugin settings to get the max_station_no_signal_time
-    // since jQuery.getJson uses ajax configuration  just set the global ajax configs
-    // from https://stackoverflow.com/a/23057124
-    $.ajaxSetup({
-      async: false
-    });
-    
-    // The $.getJSON() request is now synchronous...
-    $.getJSON('water_tank_get_settings_json', function(data)
-    {
-      water_tank_settings = data;
-      // console.log("water_tank_settings: ", water_tank_settings);
-    });
-    
-    // Set the global configs back to asynchronous 
-    $.ajaxSetup({
-        async: true
-    });
-    
-    // console.log("water_tank_settings: ", water_tank_settings);
     // console.log("Time passed millis: " + (Date.now() - new Date(water_tank.last_updated)));
     // console.log("max_sensor_no_signal_time in millis: " + water_tank_settings.max_sensor_no_signal_time);
     // const exceeded = (Date.now() - new Date(water_tank.last_updated)) > water_tank_settings.max_sensor_no_signal_time*60000 ? "exceeded" : "";
@@ -174,40 +231,47 @@ $(document).ready(function() {
 
   // add water tank display only to home page
   let url_parts = window.location.href.split('/');
-  if(url_parts[url_parts.length-1].length == 0)
+  const is_home_page = url_parts[url_parts.length-1].length == 0;
+
+  //
+  // water tanks and mqtt connection info come in a single request
+  $.getJSON('water-tank-bootstrap', function(data)
   {
-    $.getJSON('water-tank-get-all', function(data){
-      water_tanks = data;
-      // Add the new div right after the "options" div
-      // if(data.length > 1)
-      // if(array.filter((obj) => obj.enabled).length > 1)
-      // console.log(Object.keys(data).map(function(key){return data[key];}));
-      // if(Object.keys(data).map(function(key){return data[key];}).filter((obj) => obj.enabled).length > 1)
-      // {        
-      //   $('#options').after(many_water_tank_div);
-      // }
-      // else
-      {      
-        $('#options').after(single_water_tank_div);
-      }
+    if(is_home_page)
+    {
+      renderWaterTanks(data.water_tanks);
+    }
+    connectMqtt(data.mqtt);
+  });
 
-      $.each( data, function( i, water_tank ) {
-        let tr = template( water_tank, DetermineWaterTankState(water_tank) );
-        $('#water_tank_table').append(tr);
+  function renderWaterTanks(data)
+  {
+    water_tanks = data;
+    // Add the new div right after the "options" div
+    // if(data.length > 1)
+    // if(array.filter((obj) => obj.enabled).length > 1)
+    // console.log(Object.keys(data).map(function(key){return data[key];}));
+    // if(Object.keys(data).map(function(key){return data[key];}).filter((obj) => obj.enabled).length > 1)
+    // {        
+    //   $('#options').after(many_water_tank_div);
+    // }
+    // else
+    {      
+      $('#options').after(single_water_tank_div);
+    }
 
-      });  
+    $('#water_tank_table').append( data.map( water_tank => template( water_tank, DetermineWaterTankState(water_tank) ) ).join("") );
+    data.forEach(water_tank => {
+      views[water_tank.id] = createView(water_tank);
     });
   }
 
   //
   // Register mqtt client to update water tank data based on incoming mqtt messages
   // Create a client instance
-  $.getJSON('water-tank-get_mqtt_settings', function(data)
+  function connectMqtt(mqtt_settings)
   {
-    let mqtt_settings = null;
-  
-    console.log('mqtt_settings: ', data);
-    mqtt_settings = data;
+    console.log('mqtt_settings: ', mqtt_settings);
 
     const client_id = "browser_" + uuidv4();
     console.log('water_tank.js connecting to mqtt broker with ' +
@@ -241,46 +305,40 @@ $(document).ready(function() {
       try
       {
         water_tanks = JSON.parse(message.payloadString);
-        Object.keys(water_tanks).forEach(e => {
-            // console.log(`key= $${e} value=$${water_tanks[e]}`);
-            const id = e;
-            const water_tank = water_tanks[e];
-            // console.log('id: ' + id + ", last_updated: " + water_tank.last_updated);
-            
-            if(water_tank.invalid_sensor_measurement)
-            {
-              $(`#${water_tank.id}`).replaceWith( template( water_tank ) );
-            }
-            else if(water_tank.percentage != null)
-            {
-              let state = "normal";              
-
-              if(water_tank.critical_level != null &&
-                water_tank.percentage <= water_tank.critical_level)
-              {
-                state = "critical";
-              }
-              else if(water_tank.warning_level != null &&
-                water_tank.percentage <= water_tank.warning_level)
-              {
-                state = "warning";
-              }
-              else if(water_tank.overflow_level != null &&
-                water_tank.percentage >= water_tank.overflow_level)
-              {
-                state = "overflow";
-              }              
-              $(`#${water_tank.id}`).replaceWith( template( water_tank, DetermineWaterTankState(water_tank) ) );
-            }
-            
-        });        
+        if($('#water_tank_table').length == 0)
+        {
+          return; // not the home page
+        }
+
+        let ids = new Set();
+        water_tanks.forEach(water_tank => {
+          ids.add(water_tank.id);
+          if(water_tank.id in views)
+          {
+            patchView(views[water_tank.id], water_tank);
+          }
+          else
+          {
+            $('#water_tank_table').append( template( water_tank, DetermineWaterTankState(water_tank) ) );
+            views[water_tank.id] = createView(water_tank);
+          }
+        });
+
+        // remove rows of deleted water tanks
+        Object.keys(views).forEach(id => {
+          if(!ids.has(id))
+          {
+            views[id].row.remove();
+            delete views[id];
+          }
+        });
       }
       catch(e)
       {
         console.error(e);
       }
     }
-  });
+  }
 
 });
 
@@ -9,16 +9,28 @@ import os
 from enum import IntEnum
 from datetime import datetime, timedelta
 from abc import ABC, abstractmethod
-from math import acos, pi, sqrt
-import xmpp
-import smtplib
-from email.mime.text import MIMEText
-import traceback # for exception debugging
+from math import acos, cos, pi, sqrt
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+import sys
+import logging
+import logging.handlers
+import queue    # for the logging queue
+import atexit
+import hashlib  # for ETags of cached payloads
+import gzip     # for the sensor log archive
+import itertools
+import mmap     # for reading the binary sensor log
+import struct   # for the binary sensor log records
 import ast      # for logging
 import io       # for logging
 import codecs   # for logging
 import threading as th # for timing dead sensors
 import time # for timing dead sensors
+try:
+    import orjson   # optional, faster serialization of water tank data
+except ImportError:
+    orjson = None
 
 # local module imports
 from blinker import signal
@@ -34,11 +46,64 @@ from plugins import mqtt
 from helpers import load_programs, jsave, run_program, stop_stations, schedule_stations, report_stations_scheduled
 
 
+class RateLimitFilter(logging.Filter):
+    """
+    Let an identical log line through at most once every interval seconds.
+    The next one let through reports how many repetitions were dropped.
+    """
+    MAX_TRACKED_LINES = 1000
+
+    def __init__(self, interval = 10):
+        super().__init__()
+        self.interval = interval
+        self.last_seen = {} # line -> [monotonic time it was let through, dropped repetitions]
+        self.lock = th.Lock()
+
+    def filter(self, record):
+        if self.interval <= 0:
+            return True
+
+        message = record.getMessage()
+        key = (record.levelno, message)
+        now = time.monotonic()
+        with self.lock:
+            seen = self.last_seen.get(key)
+            if seen is not None and now - seen[0] < self.interval:
+                seen[1] += 1
+                return False
+
+            if seen is not None and seen[1] > 0:
+                record.msg = "%s (%d identical lines suppressed)"
+                record.args = (message, seen[1])
+            if len(self.last_seen) >= self.MAX_TRACKED_LINES:
+                self.last_seen = {k: v for k, v in self.last_seen.items() if now - v[0] < self.interval}
+            self.last_seen[key] = [now, 0]
+        return True
+
+
+# Log records are formatted and written to stdout by a listener thread so that
+# the MQTT thread never blocks on the console
+log = logging.getLogger(u"water_tank")
+log.propagate = False
+log.setLevel(logging.INFO)
+log_rate_limit_filter = RateLimitFilter()
+_log_listener = None    # started by start_plugin
+if not log.handlers:
+    _log_queue = queue.SimpleQueue()
+    _log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+    _log_queue_handler.addFilter(log_rate_limit_filter)
+    log.addHandler(_log_queue_handler)
+    _log_stream_handler = logging.StreamHandler(sys.stdout)
+    _log_stream_handler.setFormatter(logging.Formatter(u"%(asctime)s %(levelname)s water_tank: %(message)s"))
+    _log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+
+
 class WaterTankType(IntEnum):
     RECTANGULAR = 1
     CYLINDRICAL_HORIZONTAL = 2
     CYLINDRICAL_VERTICAL = 3
     ELLIPTICAL = 4
+    CALIBRATION_TABLE = 5
 
 
 class WaterTankState(IntEnum):
@@ -51,6 +116,84 @@ class WaterTankState(IntEnum):
     CRITICAL_UNSAFE = 7
 
 
+# the event each state belongs to, an event is entered at its level and left past its safe level
+STATE_EVENTS = {
+    None: None,
+    WaterTankState.NORMAL: None,
+    WaterTankState.OVERFLOW: WaterTankState.OVERFLOW,
+    WaterTankState.OVERFLOW_UNSAFE: WaterTankState.OVERFLOW,
+    WaterTankState.WARNING: WaterTankState.WARNING,
+    WaterTankState.WARNING_UNSAFE: WaterTankState.WARNING,
+    WaterTankState.CRITICAL: WaterTankState.CRITICAL,
+    WaterTankState.CRITICAL_UNSAFE: WaterTankState.CRITICAL,
+}
+
+
+def compile_state_transitions():
+    """
+    Return {(old state, new state): (exit old event, enter new event)} for every change of state.
+    Moving between an event and its unsafe state neither exits nor enters the event.
+    """
+    transitions = {}
+    for old in STATE_EVENTS:
+        for new in WaterTankState:
+            if old != new:
+                same_event = STATE_EVENTS[old] == STATE_EVENTS[new]
+                transitions[(old, new)] = (
+                    STATE_EVENTS[old] is not None and not same_event,
+                    STATE_EVENTS[new] == new and not same_event
+                )
+    return transitions
+
+
+STATE_TRANSITIONS = compile_state_transitions()
+
+
+class StateBandTable():
+    """
+    The state levels of a water tank compiled into sorted bands. Within a band every
+    level comparison has the same outcome, so the new state only depends on the band
+    and on the event the water tank is in, which is looked up in a precomputed row.
+    A level reached from above (<=) and one reached from below (>=) at the same
+    percentage are kept apart by sorting (level, 2) and (level, 0) around (percentage, 1).
+    """
+    EVENTS = [None, WaterTankState.OVERFLOW, WaterTankState.WARNING, WaterTankState.CRITICAL]
+
+    def __init__(self, overflow_level, overflow_safe_level, warning_level, warning_safe_level, critical_level, critical_safe_level):
+        at_least = lambda level: None if level is None else (level, 0)
+        at_most = lambda level: None if level is None else (level, 2)
+        # (state, boundary it is within, boundary it is beyond, event the water tank must already be in)
+        rules = [
+            (WaterTankState.OVERFLOW, at_least(overflow_level), None, None),
+            (WaterTankState.OVERFLOW_UNSAFE, at_least(overflow_safe_level), at_least(overflow_level), WaterTankState.OVERFLOW),
+            (WaterTankState.CRITICAL, at_most(critical_level), None, None),
+            (WaterTankState.CRITICAL_UNSAFE, at_most(critical_safe_level), at_most(critical_level), WaterTankState.CRITICAL),
+            (WaterTankState.WARNING, at_most(warning_level), None, None),
+            (WaterTankState.WARNING_UNSAFE, at_most(warning_safe_level), at_most(warning_level), WaterTankState.WARNING),
+        ]
+        self.boundaries = sorted(set(b for rule in rules for b in rule[1:3] if b is not None))
+
+        def within(boundary, band):
+            if boundary is None:
+                return False
+            index = self.boundaries.index(boundary)
+            return band > index if boundary[1] == 0 else band <= index
+
+        self.rows = []
+        for band in range(len(self.boundaries) + 1):
+            row = {}
+            for event in self.EVENTS:
+                row[event] = next(
+                    (state for state, inside, beyond, required in rules
+                     if within(inside, band) and not within(beyond, band) and required in (None, event)),
+                    WaterTankState.NORMAL
+                )
+            self.rows.append(row)
+
+    def State(self, percentage, state):
+        return self.rows[bisect_left(self.boundaries, (percentage, 1))][STATE_EVENTS[state]]
+
+
 class LengthUnit(IntEnum):
     CENTIMETERS = 1
     METERS = 2
@@ -83,6 +226,15 @@ class WaterTankProgram():
         self.start_datetime = start_datetime
         self.end_datetime = end_datetime
 
+    def IsConfigured(self):
+        """
+        A program reaction is stored only if it does something or still holds
+        run-time data that is needed to revert it
+        """
+        return (self.run or self.enable or self.suspend or
+                self.original_enabled is not None or
+                self.start_datetime is not None or self.end_datetime is not None)
+
 
 class WaterTankStation():
     """
@@ -98,6 +250,63 @@ class WaterTankStation():
         self.start_datetime = start_datetime
         self.end_datetime = end_datetime
 
+    def IsConfigured(self):
+        """
+        A station reaction is stored only if it does something or still holds
+        run-time data
+        """
+        return (self.run or self.stop_on_exit or
+                self.minutes is not None or self.percentage is not None or
+                self.start_datetime is not None or self.end_datetime is not None)
+
+
+class WaterTankModel():
+    """
+    The tank geometry resolved once, when the water tank is saved.
+    Lengths are in meters and the valid measurement range is in sensor units,
+    so a sensor reading is validated and turned into a percentage without any
+    unit conversions.
+    """
+    def __init__(self, height = None, offset = None, volume = None, sensor_scale = None, min_measurement = 0.0, max_measurement = -1.0, fill_at_zero = None, fill_per_sensor_unit = None, calibration_levels = None, calibration_fractions = None):
+        self.height = height
+        self.offset = offset
+        self.volume = volume
+        self.sensor_scale = sensor_scale
+        # an incomplete tank has an empty range and accepts no measurement
+        self.min_measurement = min_measurement
+        self.max_measurement = max_measurement
+        # the filled fraction of the height is fill_at_zero - fill_per_sensor_unit * measurement
+        self.fill_at_zero = fill_at_zero
+        self.fill_per_sensor_unit = fill_per_sensor_unit
+        # calibration table tanks: sorted fractions of the height and the filled fraction of the volume at each
+        self.calibration_levels = calibration_levels
+        self.calibration_fractions = calibration_fractions
+
+    def IsValid(self, measurement):
+        return self.min_measurement <= measurement <= self.max_measurement
+
+    def FillRatio(self, measurement):
+        return self.fill_at_zero - self.fill_per_sensor_unit * measurement
+
+    def CalibratedFraction(self, measurement):
+        """
+        Return the filled fraction of the volume, interpolated linearly between
+        the two calibration table rows around the level of measurement
+        """
+        levels = self.calibration_levels
+        fractions = self.calibration_fractions
+        level = self.FillRatio(measurement)
+        i = bisect_right(levels, level)
+        if i == 0:
+            return fractions[0]
+        if i == len(levels):
+            return fractions[-1]
+        return fractions[i-1] + (fractions[i] - fractions[i-1]) * (level - levels[i-1]) / (levels[i] - levels[i-1])
+
+    @staticmethod
+    def FromDict(d):
+        return WaterTankModel(**d)
+
 
 class WaterTank(ABC):
     def __init__(self, id, label, type, sensor_mqtt_topic, invalid_sensor_measurement_email, invalid_sensor_measurement_xmpp, sensor_id, sensor_offset_from_top, max_sensor_no_signal_time, min_valid_sensor_measurement, max_valid_sensor_measurement, sensor_warning, sensor_warning_email, sensor_warning_xmpp, water_tank_units, sensor_units, enabled, overflow_level, overflow_email, overflow_xmpp, overflow_safe_level, overflow_programs, warning_level, warning_safe_level, warning_email, warning_xmpp, warning_programs, critical_level, critical_safe_level, critical_email, critical_xmpp, critical_programs, loss_email, loss_xmpp, overflow_stations = None, warning_stations = None, critical_stations = None):
@@ -142,12 +351,30 @@ class WaterTank(ABC):
         self.sensor_measurement = None
         self.invalid_sensor_measurement = False
         self.percentage = None
+        self.fill_fraction = None   # the unrounded filled fraction of the volume that percentage is rounded from
+        self.volume_litres = None
+        self.capacity_litres = None
         self.order = None
         self.state = None
+        self.predictive_lead_minutes = None # react this long before the projected overflow or critical level, None for not ahead of time
+        self.predicted_state = None         # OVERFLOW or CRITICAL if its reactions were activated ahead of time
+        self.model = None
+        self.state_bands = None
         self.state_change_observers = []
         self.percentage_change_observers = []
         self.sensor_warning_observers = []
 
+    def ToDict(self):
+        """
+        Return the water tank fields without the observer objects
+        """
+        d = self.__dict__.copy()
+        d.pop("state_change_observers", None)
+        d.pop("percentage_change_observers", None)
+        d.pop("sensor_warning_observers", None)
+        d.pop("state_bands", None)
+        return d
+
     def RegisterStateChangeObserver(self, observer):
         self.state_change_observers.append(observer)
     
@@ -165,9 +392,10 @@ class WaterTank(ABC):
         warning_stations = {}
         critical_stations = {}
                 
-        #check if this dictionary came from file where fields are stored as dictionary objects
+        #check if this dictionary came from file where fields are stored as dictionary objects.
+        #Only configured reactions are stored, missing programs and stations do nothing
         if("overflow_programs" in d or "warning_programs" in d or "critical_programs" in d):
-            for id, program in d['overflow_programs'].items():
+            for id, program in d.get('overflow_programs', {}).items():
                 overflow_programs[id] = WaterTankProgram(
                     id = id,
                     run = program["run"],
@@ -177,7 +405,7 @@ class WaterTank(ABC):
                     end_datetime = program["end_datetime"],
                     original_enabled = program["original_enabled"]
                 )
-            for id, program in d['warning_programs'].items():            
+            for id, program in d.get('warning_programs', {}).items():            
                 warning_programs[id] = WaterTankProgram(
                     id = id,
                     run = program["run"],
@@ -187,7 +415,7 @@ class WaterTank(ABC):
                     end_datetime = program["end_datetime"],
                     original_enabled = program["original_enabled"]
                 )
-            for id, program in d['critical_programs'].items():                        
+            for id, program in d.get('critical_programs', {}).items():                        
                 critical_programs[id] = WaterTankProgram(
                     id = id,
                     run = program["run"],
@@ -197,7 +425,7 @@ class WaterTank(ABC):
                     end_datetime = program["end_datetime"],
                     original_enabled = program["original_enabled"]
                 )
-            for id, station in d['overflow_stations'].items():
+            for id, station in d.get('overflow_stations', {}).items():
                 overflow_stations[id] = WaterTankStation(
                     station_id = id,
                     run = station["run"],
@@ -207,7 +435,7 @@ class WaterTank(ABC):
                     start_datetime = station["start_datetime"],
                     end_datetime = station["end_datetime"]
                 )
-            for id, station in d['warning_stations'].items():
+            for id, station in d.get('warning_stations', {}).items():
                 warning_stations[id] = WaterTankStation(
                     station_id = id,
                     run = station["run"],
@@ -217,7 +445,7 @@ class WaterTank(ABC):
                     start_datetime = station["start_datetime"],
                     end_datetime = station["end_datetime"]
                 )
-            for id, station in d['critical_stations'].items():
+            for id, station in d.get('critical_stations', {}).items():
                 critical_stations[id] = WaterTankStation(
                     station_id = id,
                     run = station["run"],
@@ -229,56 +457,30 @@ class WaterTank(ABC):
                 )
         else:   #this dictionary came from form submission, fields are like overflow_pr_run_#
             for i in range(0, len(gv.pnames)):
-                overflow_programs[i] = WaterTankProgram(
-                    id = i,
-                    run = ('overflow_pr_run_' + str(i) in d and str(d['overflow_pr_run_' + str(i)]) in ["on", "true", "True"]),
-                    enable = ('overflow_pr_enable_' + str(i) in d and str(d['overflow_pr_enable_' + str(i)]) in ["on", "true", "True"]),
-                    suspend = ('overflow_pr_suspend_' + str(i) in d and str(d['overflow_pr_suspend_' + str(i)]) in ["on", "true", "True"]),
-                    original_enabled = None if 'overflow_original_enabled_pr' + str(i) not in d else d['overflow_original_enabled_pr' + str(i)]
-                )
-            
-                warning_programs[i] = WaterTankProgram(
-                    id = i,
-                    run = ('warning_pr_run_' + str(i) in d and str(d['warning_pr_run_' + str(i)]) in ["on", "true", "True"]),
-                    enable = ('warning_pr_enable_' + str(i) in d and str(d['warning_pr_enable_' + str(i)]) in ["on", "true", "True"]),
-                    suspend = ('warning_pr_suspend_' + str(i) in d and str(d['warning_pr_suspend_' + str(i)]) in ["on", "true", "True"]),
-                    original_enabled = None if 'warning_original_enabled_pr' + str(i) not in d else d['warning_original_enabled_pr' + str(i)]
-                )
-            
-                critical_programs[i] = WaterTankProgram(
-                    id = i,
-                    run = ('critical_pr_run_' + str(i) in d and str(d['critical_pr_run_' + str(i)]) in ["on", "true", "True"]),
-                    enable = ('critical_pr_enable_' + str(i) in d and str(d['critical_pr_enable_' + str(i)]) in ["on", "true", "True"]),
-                    suspend = ('critical_pr_suspend_' + str(i) in d and str(d['critical_pr_suspend_' + str(i)]) in ["on", "true", "True"]),
-                    original_enabled = None if 'critical_original_enabled_pr' + str(i) not in d else d['critical_original_enabled_pr' + str(i)]
-                )
+                for state, programs in [("overflow", overflow_programs), ("warning", warning_programs), ("critical", critical_programs)]:
+                    program = WaterTankProgram(
+                        id = i,
+                        run = (state + '_pr_run_' + str(i) in d and str(d[state + '_pr_run_' + str(i)]) in ["on", "true", "True"]),
+                        enable = (state + '_pr_enable_' + str(i) in d and str(d[state + '_pr_enable_' + str(i)]) in ["on", "true", "True"]),
+                        suspend = (state + '_pr_suspend_' + str(i) in d and str(d[state + '_pr_suspend_' + str(i)]) in ["on", "true", "True"]),
+                        original_enabled = None if state + '_original_enabled_pr' + str(i) not in d else d[state + '_original_enabled_pr' + str(i)]
+                    )
+                    if program.IsConfigured():
+                        programs[i] = program
 
             for i in range(0, len(gv.snames)):
                 station_enabled = (gv.sd['show'][i//8]>>(i%8))&1
-                if station_enabled == 1:                        
-                    overflow_stations[i] = WaterTankStation(
-                        station_id = i,
-                        run = ('overflow_sn_run_' + str(i) in d and str(d['overflow_sn_run_' + str(i)]) in ["on", "true", "True"]),
-                        minutes = None if not d["overflow_sn_minutes_" + str(i)] else int(d["overflow_sn_minutes_" + str(i)]),
-                        percentage = None if not d["overflow_sn_percentage_" + str(i)] else int(d["overflow_sn_percentage_" + str(i)]),
-                        stop_on_exit = ('overflow_sn_stop_on_exit_' + str(i) in d and str(d['overflow_sn_stop_on_exit_' + str(i)]) in ["on", "true", "True"]),
-                    )
-
-                    warning_stations[i] = WaterTankStation(
-                        station_id = i,
-                        run = ('warning_sn_run_' + str(i) in d and str(d['warning_sn_run_' + str(i)]) in ["on", "true", "True"]),
-                        minutes = None if not d["warning_sn_minutes_" + str(i)] else int(d["warning_sn_minutes_" + str(i)]),
-                        percentage = None if not d["warning_sn_percentage_" + str(i)] else int(d["warning_sn_percentage_" + str(i)]),
-                        stop_on_exit = ('warning_sn_stop_on_exit_' + str(i) in d and str(d['warning_sn_stop_on_exit_' + str(i)]) in ["on", "true", "True"]),
-                    )
-
-                    critical_stations[i] = WaterTankStation(
-                        station_id = i,
-                        run = ('critical_sn_run_' + str(i) in d and str(d['critical_sn_run_' + str(i)]) in ["on", "true", "True"]),
-                        minutes = None if not d["critical_sn_minutes_" + str(i)] else int(d["critical_sn_minutes_" + str(i)]),
-                        percentage = None if not d["critical_sn_percentage_" + str(i)] else int(d["critical_sn_percentage_" + str(i)]),
-                        stop_on_exit = ('critical_sn_stop_on_exit_' + str(i) in d and str(d['critical_sn_stop_on_exit_' + str(i)]) in ["on", "true", "True"]),
-                    )
+                if station_enabled == 1:
+                    for state, stations in [("overflow", overflow_stations), ("warning", warning_stations), ("critical", critical_stations)]:
+                        station = WaterTankStation(
+                            station_id = i,
+                            run = (state + '_sn_run_' + str(i) in d and str(d[state + '_sn_run_' + str(i)]) in ["on", "true", "True"]),
+                            minutes = None if not d.get(state + "_sn_minutes_" + str(i)) else int(d[state + "_sn_minutes_" + str(i)]),
+                            percentage = None if not d.get(state + "_sn_percentage_" + str(i)) else int(d[state + "_sn_percentage_" + str(i)]),
+                            stop_on_exit = (state + '_sn_stop_on_exit_' + str(i) in d and str(d[state + '_sn_stop_on_exit_' + str(i)]) in ["on", "true", "True"]),
+                        )
+                        if station.IsConfigured():
+                            stations[i] = station
 
         self.id = d["id"]
         self.label = d["label"]
@@ -323,22 +525,72 @@ class WaterTank(ABC):
             self.percentage = None if 'percentage' not in d or d["percentage"] is None or not d["percentage"] else float(d["percentage"])
         except:
             self.percentage = None
+        self.fill_fraction = d.get("fill_fraction")
+        self.volume_litres = d.get("volume_litres")
         self.order = None if "order" not in d else int( d["order"])
         self.state = None if "state" not in d or d["state"] is None or d["state"] == "null" else WaterTankState( int(d["state"]) )
+        self.predictive_lead_minutes = None if not d.get("predictive_lead_minutes") else float(d["predictive_lead_minutes"])
+        self.predicted_state = None if d.get("predicted_state") in (None, "null") else WaterTankState( int(d["predicted_state"]) )
+
+    def ToMeters(self, length):
+        return LengthUnit.ConvertToMeters(self.water_tank_units, length)
+
+    def Compile(self):
+        """
+        Build the compiled model from the configured dimensions, units and limits.
+        A measurement is valid if it is not negative, within the configured min/max
+        and the water level it implies is not below the bottom of the tank.
+        """
+        height = self.GetHeight()
+        volume = self.CalculateVolume()
+        if height is None or height <= 0 or volume is None:
+            return WaterTankModel()
+
+        height = self.ToMeters(height)
+        offset = self.ToMeters(self.sensor_offset_from_top)
+        sensor_scale = LengthUnit.ConvertToMeters(self.sensor_units, 1.0)
+        min_measurement = 0.0
+        if self.min_valid_sensor_measurement is not None:
+            min_measurement = max(min_measurement, self.min_valid_sensor_measurement)
+        max_measurement = (height + offset) / sensor_scale
+        if self.max_valid_sensor_measurement is not None:
+            max_measurement = min(max_measurement, self.max_valid_sensor_measurement)
+
+        return WaterTankModel(
+            height = height,
+            offset = offset,
+            volume = volume,
+            sensor_scale = sensor_scale,
+            min_measurement = min_measurement,
+            max_measurement = max_measurement,
+            fill_at_zero = (height + offset) / height,
+            fill_per_sensor_unit = sensor_scale / height
+        )
 
     def MeasurementIsValid(self, measurement):
-        h = LengthUnit.ConvertToMeters(self.water_tank_units, self.GetHeight())
-        m = LengthUnit.ConvertToMeters(self.sensor_units, measurement)
-        o = LengthUnit.ConvertToMeters(self.water_tank_units, self.sensor_offset_from_top)
-        print( "Validating h:{}, m: {}, offset:{}".format(h, m, o))
-        if( (self.min_valid_sensor_measurement is not None and measurement < self.min_valid_sensor_measurement) or 
-            (self.max_valid_sensor_measurement is not None and measurement > self.max_valid_sensor_measurement) or
-            (h < (m - o)) or
-            (measurement < 0)
-        ):
-            return False
-         
-        return True
+        return self.model.IsValid(measurement)
+
+    def LevelThresholds(self):
+        """
+        Return the sorted percentages at which the state of the water tank or of its stations may change
+        """
+        levels = [self.overflow_level, self.overflow_safe_level, self.warning_level, self.warning_safe_level, self.critical_level, self.critical_safe_level]
+        for stations in [self.overflow_stations, self.warning_stations, self.critical_stations]:
+            levels += [station.percentage for station in (stations or {}).values()]
+        return sorted(level for level in levels if level is not None)
+
+    def LevelBand(self, measurement, thresholds):
+        """
+        Return where measurement falls between thresholds, None if it is invalid.
+        Measurements in the same band lead to the same state.
+        """
+        if not self.MeasurementIsValid(measurement):
+            return None
+        fraction = self.CalculateFraction(measurement)
+        if fraction is None:
+            return None
+        percentage = 100.0 * fraction
+        return (bisect_left(thresholds, percentage), bisect_right(thresholds, percentage))
     
     def UpdateSensorWarning(self, sensor_id, warning):
         if(sensor_id != self.sensor_id):
@@ -356,22 +608,23 @@ class WaterTank(ABC):
         self.sensor_measurement = measurement
         if( not self.MeasurementIsValid(measurement) ):
             self.invalid_sensor_measurement = True
-            self.percentage = None
+            self.SetFillFraction(None)
             send_invalid_measurement_msg(self, self.AdditionalInfo4Msg())
             return
 
-        percentageBefore = self.percentage
+        percentageBefore = self.FillPercentage()
         self.invalid_sensor_measurement = False
-        percentage = self.CalculatePercentage(measurement)
-        if percentage is None:
+        fraction = self.CalculateFraction(measurement)
+        if fraction is None:
             self.invalid_sensor_measurement = True
-            self.percentage = None
+            self.SetFillFraction(None)
             return
         
-        self.percentage = percentage
+        self.SetFillFraction(fraction)
         self.StopStationsOnPercentageChange(percentageBefore)
         self.SignalPercentageChanged() # in order to let parent class call observers
         self.SetState()
+        self.SetPredictedState()
         # return True
 
     def AdditionalInfo4Msg(self):
@@ -386,68 +639,73 @@ class WaterTank(ABC):
         pass
         
     @abstractmethod
-    def CalculatePercentage(self, measurement):
+    def CalculateVolume(self):
+        """
+        Should return the volume of the tank in cubic meters, or None if its dimensions are not set.
+        """
+        pass
+
+    @abstractmethod
+    def CalculateFraction(self, measurement):
         """
-        Return the percentage at which the tank is filled.
+        Return the unrounded fraction, 0 to 1, of the volume that is filled, or None.
         """
         pass
 
+    def CalculatePercentage(self, measurement):
+        """
+        Return the percentage at which the tank is filled, rounded as it is published.
+        """
+        fraction = self.CalculateFraction(measurement)
+        return None if fraction is None else round(100.0 * fraction)
+
+    def SetFillFraction(self, fraction):
+        """
+        Set the filled fraction and what is published from it: the rounded percentage and the volume in litres
+        """
+        self.fill_fraction = fraction
+        self.percentage = None if fraction is None else round(100.0 * fraction)
+        self.volume_litres = None if fraction is None or self.capacity_litres is None else round(fraction * self.capacity_litres, 1)
+
+    def FillPercentage(self):
+        """
+        Return the unrounded percentage to compare with the levels
+        """
+        if self.fill_fraction is not None:
+            return 100.0 * self.fill_fraction
+        return self.percentage
+
+    def StateBands(self):
+        """
+        Return the state levels compiled into a StateBandTable, compiled on first use
+        """
+        if self.state_bands is None:
+            self.state_bands = StateBandTable(self.overflow_level, self.overflow_safe_level, self.warning_level,
+                                              self.warning_safe_level, self.critical_level, self.critical_safe_level)
+        return self.state_bands
+
     def CalculateNewState(self):
-        print("Existing state:{}".format("None" if self.state is None else WaterTankState(self.state).name))
+        log.debug("Existing state:%s", "None" if self.state is None else WaterTankState(self.state).name)
 
-        if(self.percentage is None):
-            print("New state is None")
+        percentage = self.FillPercentage()
+        if(percentage is None):
+            log.debug("New state is None")
             return None
-        
-        if(self.overflow_level is not None and self.percentage >= self.overflow_level):
-            print("New state is OVERFLOW")
-            return WaterTankState.OVERFLOW
-        
-        if(self.overflow_safe_level is not None and 
-           (self.state in [WaterTankState.OVERFLOW, WaterTankState.OVERFLOW_UNSAFE]) and
-           self.percentage >= self.overflow_safe_level and self.percentage < self.overflow_level
-        ):
-            print("New state is OVERFLOW_UNSAFE")
-            return WaterTankState.OVERFLOW_UNSAFE
-    
-        if(self.critical_level is not None and self.percentage <= self.critical_level):
-            print("New state is CRITICAL")
-            return WaterTankState.CRITICAL
-        
-        if(self.critical_safe_level is not None and 
-           (self.state in [WaterTankState.CRITICAL, WaterTankState.CRITICAL_UNSAFE]) and
-           self.percentage <= self.critical_safe_level and self.percentage > self.critical_level
-        ):
-            print("New state is CRITICAL_UNSAFE")
-            return WaterTankState.CRITICAL_UNSAFE
-
-        # Tank is not in OVERFLOW, OVERFLOW_UNSAFE, CRITICAL, CRITICAL_UNSAFE
-        if(self.warning_level is not None and self.percentage <= self.warning_level):
-            print("New state is WARNING")
-            return WaterTankState.WARNING
-        
-        # Tank is not in OVERFLOW, OVERFLOW_UNSAFE, CRITICAL, CRITICAL_UNSAFE, WARNING
-        if(self.warning_safe_level is not None and 
-           (self.state in [WaterTankState.WARNING, WaterTankState.WARNING_UNSAFE]) and
-           self.percentage <= self.warning_safe_level and self.percentage > self.warning_level
-        ):
-            print("New state is WARNING_UNSAFE")
-            return WaterTankState.WARNING_UNSAFE
 
-        # Tank is not in OVERFLOW, OVERFLOW_UNSAFE, CRITICAL, CRITICAL_UNSAFE, WARNING, WARNING_UNSAFE
-        # and there is a valid percentage
-        print("New state is NORMAL")
-        return WaterTankState.NORMAL
+        new_state = self.StateBands().State(percentage, self.state)
+        log.debug("New state is %s", new_state.name)
+        return new_state
 
     def StopSignleStationOnPercentageChange(self, percentageBefore, station, station_mask, board_index, station_board_index,
                                             overall_station_index):
-        if(station.run and station.percentage is not None and
+        if(station is not None and station.run and station.percentage is not None and
             station.start_datetime is not None and station.end_datetime is None
         ):
-            if( (percentageBefore <= station.percentage and self.percentage > station.percentage) or
-                (percentageBefore >= station.percentage and self.percentage < station.percentage)
+            percentage = self.FillPercentage()
+            if( (percentageBefore <= station.percentage and percentage > station.percentage) or
+                (percentageBefore >= station.percentage and percentage < station.percentage)
             ):                           
-                print("Stopping on percentage change running station {}. {}".format(overall_station_index, gv.snames[overall_station_index]))
+                log.info("Stopping on percentage change running station %s. %s", overall_station_index, gv.snames[overall_station_index])
                 station_mask[board_index] = station_mask[board_index] | (1 << station_board_index);
                 station.end_datetime = datetime.now().replace(microsecond=0)                
                 gv.rs[overall_station_index][2] = 0         #set duration to 0
@@ -466,17 +724,17 @@ class WaterTank(ABC):
                     key_i = str(i)
                     if i + 1 == gv.sd["mas"]:
                         continue  # skip if this is master valve
-                    station_changed = self.StopSignleStationOnPercentageChange(percentageBefore, self.overflow_stations[key_i],
+                    station_changed = self.StopSignleStationOnPercentageChange(percentageBefore, self.overflow_stations.get(key_i),
                         station_mask, b, s, i ) or station_changed
-                    station_changed = self.StopSignleStationOnPercentageChange(percentageBefore, self.warning_stations[key_i],
+                    station_changed = self.StopSignleStationOnPercentageChange(percentageBefore, self.warning_stations.get(key_i),
                         station_mask, b, s, i ) or station_changed
-                    station_changed = self.StopSignleStationOnPercentageChange(percentageBefore, self.critical_stations[key_i],
+                    station_changed = self.StopSignleStationOnPercentageChange(percentageBefore, self.critical_stations.get(key_i),
                         station_mask, b, s, i ) or station_changed
 
             if(station_changed):
                 report_stations_scheduled()
         except Exception as e:
-            print("Exception in StopStationsOnPercentageChange", e)
+            log.exception("Exception in StopStationsOnPercentageChange %s", e)
 
     def StopStationsOnEventExit(self, state):
         valid_states = [WaterTankState.OVERFLOW, WaterTankState.WARNING, WaterTankState.CRITICAL, WaterTankState.OVERFLOW_UNSAFE, WaterTankState.WARNING_UNSAFE, WaterTankState.CRITICAL_UNSAFE]
@@ -497,13 +755,14 @@ class WaterTank(ABC):
                 for s in range(8): # for each station in the board
                     i = b*8 + s
                     key_i = str(i)
+                    station = stations.get(key_i)
                     station_enabled = (gv.sd['show'][b]>>s)&1
-                    if( station_enabled == 1 and
-                        stations[key_i].run and stations[key_i].stop_on_exit and
-                        stations[key_i].start_datetime is not None and stations[key_i].end_datetime is None ):
-                        print("Stopping on event exit running station {}. {}".format(i, gv.snames[i]))
+                    if( station_enabled == 1 and station is not None and
+                        station.run and station.stop_on_exit and
+                        station.start_datetime is not None and station.end_datetime is None ):
+                        log.info("Stopping on event exit running station %s. %s", i, gv.snames[i])
                         station_mask[b] = station_mask[b] | (1 << s);
-                        stations[key_i].end_datetime = datetime.now().replace(microsecond=0)
+                        station.end_datetime = datetime.now().replace(microsecond=0)
                         if i + 1 == gv.sd["mas"]:
                             continue  # skip if this is master valve
                         gv.rs[i][2] = 0         #set duration to 0
@@ -513,7 +772,7 @@ class WaterTank(ABC):
             if(station_changed):
                 report_stations_scheduled()
         except Exception as e:
-            print("Exception in StopStationsOnEventExit", e)
+            log.exception("Exception in StopStationsOnEventExit %s", e)
             
     def RevertPrograms(self, state):
         """
@@ -525,7 +784,7 @@ class WaterTank(ABC):
             raise Exception("Invalid state: '{}'. Only states {} allowed in ActivatePrograms".
                             format(state.name, ", ".join([v.name for v in valid_states])))
         
-        print("Reverting {} programs".format(state.name))
+        log.info("Reverting %s programs", state.name)
         prs = self.overflow_programs
         if(state in [WaterTankState.WARNING, WaterTankState.WARNING_UNSAFE]):
             prs = self.warning_programs
@@ -535,25 +794,26 @@ class WaterTank(ABC):
         program_changed = False
         for i in range(0, len(gv.pd) ):
             key_i = str(i)
-            if(prs[key_i].original_enabled is not None and gv.pd[i]["enabled"] != prs[key_i].original_enabled):
-                print("{} program {}. {}"
-                      .format(('Enabling' if prs[key_i].original_enabled else 'Disabling'), i, gv.pnames[i]))
-                gv.pd[i]["enabled"] = prs[key_i].original_enabled
+            program = prs.get(key_i)
+            if(program is None):
+                continue    # program is not configured for this state
+            if(program.original_enabled is not None and gv.pd[i]["enabled"] != program.original_enabled):
+                log.info("%s program %s. %s", 'Enabling' if program.original_enabled else 'Disabling', i, gv.pnames[i])
+                gv.pd[i]["enabled"] = program.original_enabled
                 program_changed = True
             
             # if a program is still running
-            # print("Checking gv.pon:{} against running program:{}".format(gv.pon, json.dumps(prs[key_i], default=serialize_datetime)))
-            if(self.CheckAndMarkProgramEnd(prs[key_i])):
+            # print("Checking gv.pon:{} against running program:{}".format(gv.pon, json.dumps(program, default=json_default)))
+            if(self.CheckAndMarkProgramEnd(program)):
                 # stop it
                 # actually stop all running stations as all can only belong to the same program
                 # since only one program can run at a time
-                print("Program {} was still running, stopping it now".format(gv.pnames[i]))
+                log.info("Program %s was still running, stopping it now", gv.pnames[i])
                 stop_stations()
 
         if(program_changed):
-            jsave(gv.pd, "programData")
-            report_program_toggle()
-        print("RevertPrograms finished")
+            program_data_changed()
+        log.debug("RevertPrograms finished")
 
     def ActivateStations(self, state):
         """
@@ -565,7 +825,7 @@ class WaterTank(ABC):
             raise Exception("Invalid state: '{}'. Only states {} allowed in ActivatePrograms".
                             format(state.name, ", ".join([v.name for v in valid_states])))
         
-        print("Activating {} stations".format(state.name))
+        log.info("Activating %s stations", state.name)
         sns = self.overflow_stations
         if(state == WaterTankState.WARNING):
             sns = self.warning_stations
@@ -580,22 +840,23 @@ class WaterTank(ABC):
                 for s in range(8): # for each station in the board
                     i = b*8 + s
                     key_i = str(i)
+                    station = sns.get(key_i)
                     station_enabled = (gv.sd['show'][b]>>s)&1
-                    if( station_enabled == 1 and sns[key_i].run):
-                        print("Running station {}. {}".format(i, gv.snames[i]))
+                    if( station_enabled == 1 and station is not None and station.run):
+                        log.info("Running station %s. %s", i, gv.snames[i])
                         station_mask[b] = station_mask[b] | (1 << s);
-                        sns[key_i].start_datetime = datetime.now().replace(microsecond=0)
-                        sns[key_i].end_datetime = None
+                        station.start_datetime = datetime.now().replace(microsecond=0)
+                        station.end_datetime = None
                         if i + 1 == gv.sd["mas"]:
                             continue  # skip if this is master valve
-                        duration = sns[key_i].minutes*60 if sns[key_i].minutes is not None else settings[MAX_STATION_DURATION]
+                        duration = station.minutes*60 if station.minutes is not None else settings[MAX_STATION_DURATION]
                         gv.rs[i][2] = duration
                         station_changed = True                                    
 
             if(station_changed):
                 schedule_stations(station_mask)
         except Exception as e:
-            print("Exception in ActivatePrograms state", e)
+            log.exception("Exception in ActivatePrograms state %s", e)
 
     def ActivatePrograms(self, state):
         """
@@ -607,7 +868,7 @@ class WaterTank(ABC):
             raise Exception("Invalid state: '{}'. Only states {} allowed in ActivatePrograms".
                             format(state.name, ", ".join([v.name for v in valid_states])))
         
-        print("Activating {} programs".format(state.name))
+        log.info("Activating %s programs", state.name)
         prs = self.overflow_programs
         if(state == WaterTankState.WARNING):
             prs = self.warning_programs
@@ -618,41 +879,43 @@ class WaterTank(ABC):
         try:
             for i in range(0, len(gv.pd) ):
                 key_i = str(i)
-                if(prs[key_i].run):
-                    print("Running program {}. {}".format(i, gv.pnames[i]))
-                    prs[key_i].start_datetime = datetime.now().replace(microsecond=0)
-                    prs[key_i].end_datetime = None
+                program = prs.get(key_i)
+                if(program is None):
+                    continue    # program is not configured for this state
+                if(program.run):
+                    log.info("Running program %s. %s", i, gv.pnames[i])
+                    program.start_datetime = datetime.now().replace(microsecond=0)
+                    program.end_datetime = None
                     run_program(i)
-                if(prs[key_i].suspend and gv.pd[i]["enabled"] == 1):
-                    print("Disabling previously enabled program {}. {}".format(i, gv.pnames[i]))
-                    prs[key_i].original_enabled = gv.pd[i]["enabled"]
+                if(program.suspend and gv.pd[i]["enabled"] == 1):
+                    log.info("Disabling previously enabled program %s. %s", i, gv.pnames[i])
+                    program.original_enabled = gv.pd[i]["enabled"]
                     gv.pd[i]["enabled"] = 0
                     program_changed = True
-                if(prs[key_i].enable and gv.pd[i]["enabled"] == 0):
-                    print("Enabling previously disabled program {}. {}".format(i, gv.pnames[i]))
-                    prs[key_i].original_enabled = gv.pd[i]["enabled"]
+                if(program.enable and gv.pd[i]["enabled"] == 0):
+                    log.info("Enabling previously disabled program %s. %s", i, gv.pnames[i])
+                    program.original_enabled = gv.pd[i]["enabled"]
                     gv.pd[i]["enabled"] = 1
                     program_changed = True
 
             if(program_changed):
-                jsave(gv.pd, "programData")
-                report_program_toggle()
+                program_data_changed()
         except Exception as e:
-            print("Exception in ActivatePrograms state", e)
+            log.exception("Exception in ActivatePrograms state %s", e)
 
     @staticmethod
     def CheckAndMarkProgramEnd(program, except_same_id_program = False):
-        # print("Comparing gv.pon: {} against program:{}".format(gv.pon, json.dumps(program, default=serialize_datetime)))
+        # print("Comparing gv.pon: {} against program:{}".format(gv.pon, json.dumps(program, default=json_default)))
         if(except_same_id_program):
             if((gv.pon is None or (gv.pon-1) != int(program.id)) and 
                 program.start_datetime is not None and program.end_datetime is None
             ):
-                print("except_same_id_program:{}, gv.pon:{}, Program ({}) {} was still running, marking it stopped now".format(except_same_id_program, gv.pon, program.id, gv.pnames[int(program.id)]))
+                log.info("except_same_id_program:%s, gv.pon:%s, Program (%s) %s was still running, marking it stopped now", except_same_id_program, gv.pon, program.id, gv.pnames[int(program.id)])
                 program.end_datetime = datetime.now().replace(microsecond=0)
                 return True
         else:
             if(program.start_datetime is not None and program.end_datetime is None):
-                print("except_same_id_program:{}, gv.pon:{}, Program ({}) {} was still running, marking it stopped now".format(except_same_id_program, gv.pon, program.id, gv.pnames[int(program.id)]))
+                log.info("except_same_id_program:%s, gv.pon:%s, Program (%s) %s was still running, marking it stopped now", except_same_id_program, gv.pon, program.id, gv.pnames[int(program.id)])
                 program.end_datetime = datetime.now().replace(microsecond=0)
                 return True
         
@@ -660,14 +923,14 @@ class WaterTank(ABC):
     
     @staticmethod
     def CheckAndMarkStationEnd(station):
-        # print("CheckAndMarkStationEnd gv.srvals:".format(json.dumps(gv.srvals, default=serialize_datetime)))
+        # print("CheckAndMarkStationEnd gv.srvals:".format(json.dumps(gv.srvals, default=json_default)))
         # print(gv.srvals)
         #    
         # mark end_datetime for stopped stations
         station_index = int(station.station_id)
         if( gv.srvals[station_index] == 0 and station.run and 
            station.start_datetime is not None and station.end_datetime is None):
-            print("Marking ended station {}. {}".format(station_index, gv.snames[station_index]))
+            log.info("Marking ended station %s. %s", station_index, gv.snames[station_index])
             station.end_datetime = datetime.now().replace(microsecond=0)
             return True
         
@@ -678,13 +941,13 @@ class WaterTank(ABC):
         programUpdated = False
         # print("Doing OVERFLOW programs.")
         for p_id, program in self.overflow_programs.items():
-            programUpdated = self.CheckAndMarkProgramEnd(program, self.state in [WaterTankState.OVERFLOW, WaterTankState.OVERFLOW_UNSAFE] ) or programUpdated
+            programUpdated = self.CheckAndMarkProgramEnd(program, self.state in [WaterTankState.OVERFLOW, WaterTankState.OVERFLOW_UNSAFE] or self.predicted_state == WaterTankState.OVERFLOW ) or programUpdated
         # print("Doing WARNING programs.")
         for p_id, program in self.warning_programs.items():
             programUpdated = self.CheckAndMarkProgramEnd(program, self.state in [WaterTankState.WARNING, WaterTankState.WARNING_UNSAFE]) or programUpdated
         # print("Doing CRITICAL programs.")
         for p_id, program in self.critical_programs.items():
-            programUpdated = self.CheckAndMarkProgramEnd(program, self.state in [WaterTankState.CRITICAL, WaterTankState.CRITICAL_UNSAFE]) or programUpdated
+            programUpdated = self.CheckAndMarkProgramEnd(program, self.state in [WaterTankState.CRITICAL, WaterTankState.CRITICAL_UNSAFE] or self.predicted_state == WaterTankState.CRITICAL) or programUpdated
 
         return programUpdated
     
@@ -726,33 +989,77 @@ class WaterTank(ABC):
             return
         
         # water tank is definitely entering a new state
-        #
+        exit_event, enter_event = STATE_TRANSITIONS[(self.state, new_state)]
         # Revert activated programs
-        if( (self.state == WaterTankState.OVERFLOW and new_state != WaterTankState.OVERFLOW_UNSAFE) or
-            (self.state == WaterTankState.OVERFLOW_UNSAFE and new_state != WaterTankState.OVERFLOW) or
-            (self.state == WaterTankState.CRITICAL and new_state != WaterTankState.CRITICAL_UNSAFE) or
-            (self.state == WaterTankState.CRITICAL_UNSAFE and new_state != WaterTankState.CRITICAL) or
-            (self.state == WaterTankState.WARNING and new_state != WaterTankState.WARNING_UNSAFE) or
-            (self.state == WaterTankState.WARNING_UNSAFE and new_state != WaterTankState.WARNING)
-        ):
-            if(self.enabled):
-                self.RevertPrograms(self.state)
-                self.StopStationsOnEventExit(self.state)
-
-        #
-        # Activate programs for entering new state
-        if( (new_state == WaterTankState.OVERFLOW and self.state != WaterTankState.OVERFLOW_UNSAFE) or
-            (new_state == WaterTankState.CRITICAL and self.state != WaterTankState.CRITICAL_UNSAFE) or
-            (new_state == WaterTankState.WARNING and self.state != WaterTankState.WARNING_UNSAFE)
-        ):
-            if(self.enabled):            
-                self.ActivatePrograms(new_state)
-                self.ActivateStations(new_state)
+        if(exit_event and self.enabled):
+            self.RevertPrograms(self.state)
+            self.StopStationsOnEventExit(self.state)
+
+        # Activate programs for entering new state, unless they were activated ahead of time
+        if(enter_event and self.enabled and new_state == self.predicted_state):
+            log.info("Entering %s, its reactions were activated ahead of time", new_state.name)
+            self.predicted_state = None
+        elif(enter_event and self.enabled):
+            self.ActivatePrograms(new_state)
+            self.ActivateStations(new_state)
 
         self.state = new_state
 
         for o in self.state_change_observers:
             o.WaterTankStateChanged()
+
+    def PredictState(self, percentage, rate, state, predicted_state):
+        """
+        Return OVERFLOW or CRITICAL if at rate, in percent per second, percentage is projected to
+        reach its level within the lead time, None otherwise. The state predicted_state, already
+        predicted, is kept like the event itself until percentage is past its safe level, and
+        while the level is projected to be reached within twice the lead time.
+        """
+        if not self.predictive_lead_minutes or percentage is None:
+            return None
+        lead = self.predictive_lead_minutes * 60
+        predictions = [
+            (WaterTankState.OVERFLOW, self.overflow_level, self.overflow_safe_level, 1),
+            (WaterTankState.CRITICAL, self.critical_level, self.critical_safe_level, -1)
+        ]
+        for event, level, safe_level, direction in predictions:
+            if level is None or STATE_EVENTS[state] == event:
+                continue
+            if event == predicted_state:
+                safe_level = level if safe_level is None else safe_level
+                if direction * (percentage - safe_level) >= 0:
+                    return event
+            if rate is None or direction * rate <= 0:
+                continue
+            seconds = (level - percentage) / rate
+            if 0 <= seconds <= (2 * lead if event == predicted_state else lead):
+                return event
+        return None
+
+    def SetPredictedState(self):
+        """
+        Activate the reactions of OVERFLOW or CRITICAL ahead of time when the fill or drain rate of
+        the recent readings projects the level to be reached within the lead time, and revert them
+        when that is no longer the case
+        """
+        if self.enabled and self.predictive_lead_minutes and self.fill_fraction is not None:
+            fill_trend.Add(self.id, self.fill_fraction)
+            rate = fill_trend.SignificantRate(self.id)
+            predicted_state = self.PredictState(self.FillPercentage(), None if rate is None else 100.0 * rate, self.state, self.predicted_state)
+        else:
+            predicted_state = None
+        if predicted_state == self.predicted_state:
+            return
+
+        if self.predicted_state is not None:
+            log.info("%s is no longer projected for water tank %s, reverting its reactions", self.predicted_state.name, self.id)
+            self.RevertPrograms(self.predicted_state)
+            self.StopStationsOnEventExit(self.predicted_state)
+        if predicted_state is not None:
+            log.info("%s is projected within %s minutes for water tank %s, activating its reactions", predicted_state.name, self.predictive_lead_minutes, self.id)
+            self.ActivatePrograms(predicted_state)
+            self.ActivateStations(predicted_state)
+        self.predicted_state = predicted_state
     
 
 class WaterTankRectangular(WaterTank):
@@ -770,20 +1077,15 @@ class WaterTankRectangular(WaterTank):
         wt.height = None if not d["height"] else float(d["height"])
         return wt
                 
-    def MeasurementIsValid(self, measurement):
-        if( not super().MeasurementIsValid(measurement)):
-            return False
-        
-        if( LengthUnit.ConvertToMeters(self.water_tank_units, self.height) < (LengthUnit.ConvertToMeters(self.sensor_units, measurement) - LengthUnit.ConvertToMeters(self.water_tank_units, self.sensor_offset_from_top)) ):
-            return False
-        
-        return True
+    def CalculateVolume(self):
+        if self.width is not None and self.length is not None and self.height is not None:
+            return self.ToMeters(self.width) * self.ToMeters(self.length) * self.ToMeters(self.height)
 
-    def CalculatePercentage(self, measurement):
-        if self.width is not None and self.length is not None and self.height is not None and self.height > 0:
-            h = LengthUnit.ConvertToMeters(self.water_tank_units, self.height)
-            d = LengthUnit.ConvertToMeters(self.sensor_units, measurement) - LengthUnit.ConvertToMeters(self.water_tank_units, self.sensor_offset_from_top)
-            return round(100.0 * (h -d) / h)
+        return None
+
+    def CalculateFraction(self, measurement):
+        if self.model.volume is not None:
+            return self.model.FillRatio(measurement)
         
         return None
 
@@ -804,24 +1106,20 @@ class WaterTankCylindricalHorizontal(WaterTank):
         wt.diameter = None if not d["diameter"] else float(d["diameter"])
         return wt
 
-    def MeasurementIsValid(self, measurement):
-        if( not super().MeasurementIsValid(measurement)):
-            return False
-        
-        if( LengthUnit.ConvertToMeters(self.water_tank_units, self.diameter) < (LengthUnit.ConvertToMeters(self.sensor_units, measurement) - LengthUnit.ConvertToMeters(self.water_tank_units, self.sensor_offset_from_top))):
-            return False
-        
-        return True
-    
-    def CalculatePercentage(self, measurement):
+    def CalculateVolume(self):
         if self.diameter is not None and self.length is not None:
-            volume = LengthUnit.ConvertToMeters(self.water_tank_units, self.diameter) * LengthUnit.ConvertToMeters(self.water_tank_units, self.length)
-            r = LengthUnit.ConvertToMeters(self.water_tank_units, self.diameter) / 2.0
-            h = LengthUnit.ConvertToMeters(self.water_tank_units, self.diameter) - (LengthUnit.ConvertToMeters(self.sensor_units, measurement) - LengthUnit.ConvertToMeters(self.water_tank_units, self.sensor_offset_from_top))
+            r = self.ToMeters(self.diameter) / 2.0
+            return pi * (r**2) * self.ToMeters(self.length)
+
+        return None
+
+    def CalculateFraction(self, measurement):
+        if self.model.volume is not None:
+            # circular segment area over the circle area, x is (r - h) / r
+            x = 1.0 - 2.0 * self.model.FillRatio(measurement)
             try:
-                liquid_volume = acos((r-h)/r)*(r**2) - (r-h)*sqrt(2*r*h - (h**2))
-                return round(100.0 * liquid_volume / volume)
-            except:
+                return (acos(x) - x*sqrt(1.0 - (x**2))) / pi
+            except ValueError:
                 return None
         
         return None
@@ -843,22 +1141,16 @@ class WaterTankCylindricalVertical(WaterTank):
         wt.diameter = None if not d["diameter"] else float(d["diameter"])
         return wt
 
-    def MeasurementIsValid(self, measurement):
-        if( not super().MeasurementIsValid(measurement)):
-            return False
-        
-        if( LengthUnit.ConvertToMeters(self.water_tank_units, self.height) < (LengthUnit.ConvertToMeters(self.sensor_units, measurement) - LengthUnit.ConvertToMeters(self.water_tank_units, self.sensor_offset_from_top) ) ):
-            return False
-        
-        return True
-    
-    def CalculatePercentage(self, measurement):
-        if self.diameter is not None and self.height is not None and self.height > 0:
-            h = LengthUnit.ConvertToMeters(self.water_tank_units, self.height)
-            d = LengthUnit.ConvertToMeters(self.water_tank_units, self.diameter)
-            x = LengthUnit.ConvertToMeters(self.sensor_units, measurement) - LengthUnit.ConvertToMeters(self.water_tank_units, self.sensor_offset_from_top)
-            volume = d * h
-            return round(100.0 * (h - x) / h)
+    def CalculateVolume(self):
+        if self.diameter is not None and self.height is not None:
+            r = self.ToMeters(self.diameter) / 2.0
+            return pi * (r**2) * self.ToMeters(self.height)
+
+        return None
+
+    def CalculateFraction(self, measurement):
+        if self.model.volume is not None:
+            return self.model.FillRatio(measurement)
         
         return None
 
@@ -881,27 +1173,20 @@ class WaterTankElliptical(WaterTank):
         wt.vertical_axis = None if not d["vertical_axis"] else float(d["vertical_axis"])
         return wt
 
-    def MeasurementIsValid(self, measurement):
-        if( not super().MeasurementIsValid(measurement)):
-            return False
-        
-        if( LengthUnit.ConvertToMeters(self.water_tank_units, self.vertical_axis) < (LengthUnit.ConvertToMeters(self.sensor_units, measurement) - LengthUnit.ConvertToMeters(self.water_tank_units, self.sensor_offset_from_top) ) ):
-            return False
-        
-        return True
-    
-    def CalculatePercentage(self, measurement):
-        if self.length is not None and self.horizontal_axis is not None and self.vertical_axis is not None and self.vertical_axis > 0:
+    def CalculateVolume(self):
+        if self.length is not None and self.horizontal_axis is not None and self.vertical_axis is not None:
+            return self.ToMeters(self.horizontal_axis)/2.0 * self.ToMeters(self.vertical_axis)/2.0 * self.ToMeters(self.length) * pi
+
+        return None
+
+    def CalculateFraction(self, measurement):
+        if self.model.volume is not None:
             # from https://www.had2know.org/academics/ellipse-segment-tank-volume-calculator.html
-            A = LengthUnit.ConvertToMeters(self.water_tank_units, self.vertical_axis)
-            B = LengthUnit.ConvertToMeters(self.water_tank_units, self.horizontal_axis)
-            H = LengthUnit.ConvertToMeters(self.water_tank_units, self.vertical_axis) - (LengthUnit.ConvertToMeters(self.sensor_units, measurement) - LengthUnit.ConvertToMeters(self.water_tank_units, self.sensor_offset_from_top) )
-            L = LengthUnit.ConvertToMeters(self.water_tank_units, self.length)
-            volume = B/2.0 * A/2.0 * L * pi
+            # liquid_volume / volume reduces to the same expression as a circular segment, x is 1 - 2H/A
+            x = 1.0 - 2.0 * self.model.FillRatio(measurement)
             try:
-                liquid_volume = ((A*B*L)/4)*( acos(1.0 - 2.0*H/A) - (1.0 - 2.0*H/A)*sqrt(4*H/A - 4*(H**2)/(A**2)) )
-                return round(100.0 * liquid_volume / volume)
-            except:
+                return (acos(x) - x*sqrt(1.0 - (x**2))) / pi
+            except ValueError:
                 return None
             
         return None
@@ -910,6 +1195,72 @@ class WaterTankElliptical(WaterTank):
         return self.vertical_axis
 
 
+class WaterTankCalibrationTable(WaterTank):
+    """
+    An irregular tank described by a table of water levels, measured from the bottom in
+    water tank units, and the volume in litres at each level, e.g. from a strapping table
+    """
+    def __init__(self, id = None, label = None, calibration_levels = None, calibration_volumes = None, sensor_mqtt_topic = None, invalid_sensor_measurement_email = None, invalid_sensor_measurement_xmpp = None, sensor_id = None, sensor_offset_from_top = None, max_sensor_no_signal_time = None, min_valid_sensor_measurement = None,max_valid_sensor_measurement = None, sensor_warning = None, sensor_warning_email = None, sensor_warning_xmpp = None, water_tank_units = None, sensor_units = None, enabled = None, overflow_level = None, overflow_email = None, overflow_xmpp = None, overflow_safe_level = None, overflow_programs = None, warning_level = None, warning_safe_level = None, warning_email = None, warning_xmpp = None, warning_programs = None, critical_level = None, critical_safe_level = None, critical_email = None, critical_xmpp = None, critical_programs = None, loss_email = None, loss_xmpp = None):
+        super().__init__(id, label, WaterTankType.CALIBRATION_TABLE.value, sensor_mqtt_topic, invalid_sensor_measurement_email, invalid_sensor_measurement_xmpp, sensor_id, sensor_offset_from_top, max_sensor_no_signal_time, min_valid_sensor_measurement, max_valid_sensor_measurement, sensor_warning, sensor_warning_email, sensor_warning_xmpp, water_tank_units, sensor_units, enabled, overflow_level, overflow_email, overflow_xmpp, overflow_safe_level, overflow_programs, warning_level, warning_safe_level, warning_email, warning_xmpp, warning_programs, critical_level, critical_safe_level, critical_email, critical_xmpp, critical_programs, loss_email, loss_xmpp)
+        self.calibration_levels = calibration_levels or []
+        self.calibration_volumes = calibration_volumes or []
+
+    def FromDict(d):
+        wt = WaterTankCalibrationTable()
+        wt.InitFromDict(d)
+        if "calibration_table" in d:   # form submission, one "level volume" row per line
+            rows = WaterTankCalibrationTable.ParseTable(d["calibration_table"])
+        else:
+            rows = zip(d.get("calibration_levels", []), d.get("calibration_volumes", []))
+        # keep one volume per level, sorted by level
+        rows = sorted(dict((float(level), float(volume)) for level, volume in rows).items())
+        wt.calibration_levels = [level for level, volume in rows]
+        wt.calibration_volumes = [volume for level, volume in rows]
+        return wt
+
+    @staticmethod
+    def ParseTable(text):
+        rows = []
+        for line in text.splitlines():
+            values = line.replace(",", " ").replace(";", " ").split()
+            if not values:
+                continue
+            try:
+                level, volume = (float(v) for v in values)
+            except ValueError:
+                log.warning(u"Ignoring calibration table row '%s', expected a level and a volume", line)
+                continue
+            rows.append((level, volume))
+        return rows
+
+    def Compile(self):
+        """
+        Also store the table as fractions of the height and of the volume, so that
+        a reading is turned into a percentage by bisection and linear interpolation
+        """
+        model = super().Compile()
+        if model.volume is not None:
+            height = self.GetHeight()
+            model.calibration_levels = [level / height for level in self.calibration_levels]
+            model.calibration_fractions = [volume / self.calibration_volumes[-1] for volume in self.calibration_volumes]
+        return model
+
+    def CalculateVolume(self):
+        if len(self.calibration_levels) >= 2 and self.calibration_volumes[-1] > 0:
+            return self.calibration_volumes[-1] / 1000.0
+
+        return None
+
+    def CalculateFraction(self, measurement):
+        if self.model.volume is not None:
+            return self.model.CalibratedFraction(measurement)
+
+        return None
+
+    def GetHeight(self):
+        return self.calibration_levels[-1] if self.calibration_levels else None
+
+
 class WaterTankFactory():
     def FromDict(d, addSettingsProperties = True):
         wt = None
@@ -922,7 +1273,13 @@ class WaterTankFactory():
             wt = WaterTankCylindricalVertical.FromDict(d)
         elif type == WaterTankType.ELLIPTICAL.value:
             wt = WaterTankElliptical.FromDict(d)
+        elif type == WaterTankType.CALIBRATION_TABLE.value:
+            wt = WaterTankCalibrationTable.FromDict(d)
 
+        # the model is compiled when a water tank is configured and saved along with it
+        if wt is not None:
+            wt.model = WaterTankModel.FromDict(d["model"]) if isinstance(d.get("model"), dict) else wt.Compile()
+            wt.capacity_litres = None if wt.model.volume is None else round(wt.model.volume * 1000.0, 1)
         return wt
 
 
@@ -930,14 +1287,13 @@ class MessageSender():
     def __init__(self, mqtt_msg, water_tank):
         self.mqtt_msg = mqtt_msg
         self.water_tank = water_tank
-        self.percentage_mark = None
 
         self.water_tank.RegisterStateChangeObserver(self)
         self.water_tank.RegisterPercentageChangeObserver(self)
         self.water_tank.RegisterSensorWarningUpdateObserver(self)
 
     def WaterTankStateChanged(self):
-        print("WaterTankStateChanged. water_tank id:{}, state:{}".format(self.water_tank.id, self.water_tank.state.name))
+        log.info("WaterTankStateChanged. water_tank id:%s, state:%s", self.water_tank.id, self.water_tank.state.name)
         
         if(not self.water_tank.enabled):
             return
@@ -945,87 +1301,85 @@ class MessageSender():
         settings = get_settings()
 
         if( self.water_tank.state == WaterTankState.OVERFLOW ):
-            print("Will send overflow message")
+            log.info("Will send overflow message")
             msg = settings[XMPP_OVERFLOW_MSG].format(
                 water_tank_id = self.water_tank.id,
                 water_tank_label = self.water_tank.label,
                 sensor_id = self.water_tank.sensor_id,
                 percentage = self.water_tank.percentage,
+                volume = self.water_tank.volume_litres,
+                capacity = self.water_tank.capacity_litres,
                 measurement = self.water_tank.sensor_measurement,
                 last_updated = self.water_tank.last_updated,
                 mqtt_topic = self.mqtt_msg.topic,
                 additional_info = self.water_tank.AdditionalInfo4Msg()
             )
-            print("Overflow email:{}, xmpp:{}".format(self.water_tank.overflow_email, self.water_tank.overflow_xmpp))
-            if( self.water_tank.overflow_xmpp ):
-                xmpp_send_msg( msg )
-            if( self.water_tank.overflow_email ):
-                email_send_msg( msg, "Overflow" )
+            log.debug("Overflow email:%s, xmpp:%s", self.water_tank.overflow_email, self.water_tank.overflow_xmpp)
+            send_state_notification("Overflow", msg, self.water_tank.overflow_xmpp, self.water_tank.overflow_email)
         elif( self.water_tank.state == WaterTankState.CRITICAL ):
-            print("Will send xmpp critical message")
+            log.info("Will send xmpp critical message")
             msg = settings[XMPP_CRITICAL_MSG].format(
                 water_tank_id = self.water_tank.id,
                 water_tank_label = self.water_tank.label,
                 sensor_id = self.water_tank.sensor_id,
                 percentage = self.water_tank.percentage,
+                volume = self.water_tank.volume_litres,
+                capacity = self.water_tank.capacity_litres,
                 measurement = self.water_tank.sensor_measurement,
                 last_updated = self.water_tank.last_updated,
                 mqtt_topic = self.mqtt_msg.topic,
                 additional_info = self.water_tank.AdditionalInfo4Msg()
             )
-            print("Critical email:{}, xmpp:{}".format(self.water_tank.critical_email, self.water_tank.critical_xmpp))
-            if( self.water_tank.critical_xmpp ):
-                xmpp_send_msg( msg )
-            if( self.water_tank.critical_email ):
-                email_send_msg( msg, "Critical" )
+            log.debug("Critical email:%s, xmpp:%s", self.water_tank.critical_email, self.water_tank.critical_xmpp)
+            send_state_notification("Critical", msg, self.water_tank.critical_xmpp, self.water_tank.critical_email)
         elif( self.water_tank.state == WaterTankState.WARNING ):
-            print("Will send xmpp warning message")
+            log.info("Will send xmpp warning message")
             msg = settings[XMPP_WARNING_MSG].format(
                 water_tank_id = self.water_tank.id,
                 water_tank_label = self.water_tank.label,
                 sensor_id = self.water_tank.sensor_id,
                 percentage = self.water_tank.percentage,
+                volume = self.water_tank.volume_litres,
+                capacity = self.water_tank.capacity_litres,
                 measurement = self.water_tank.sensor_measurement,
                 last_updated = self.water_tank.last_updated,
                 mqtt_topic = self.mqtt_msg.topic,
                 additional_info = self.water_tank.AdditionalInfo4Msg()
             )
-            print("Warning email:{}, xmpp:{}".format(self.water_tank.warning_email, self.water_tank.warning_xmpp))
-            if( self.water_tank.warning_xmpp ):
-                xmpp_send_msg( msg )
-            if( self.water_tank.warning_email ):
-                email_send_msg( msg, "Warning" )
-
-    def MarkPercentage(self):
-        self.percentage_mark = self.water_tank.percentage
+            log.debug("Warning email:%s, xmpp:%s", self.water_tank.warning_email, self.water_tank.warning_xmpp)
+            send_state_notification("Warning", msg, self.water_tank.warning_xmpp, self.water_tank.warning_email)
 
     def WaterTankPercentageChanged(self):
-        print("WaterTankPercentageChanged. water_tank id:{}, state:{}".format(self.water_tank.id, ('None' if self.water_tank.state is None else self.water_tank.state.name)))
-        if(not self.water_tank.enabled):
+        log.debug("WaterTankPercentageChanged. water_tank id:%s, state:%s", self.water_tank.id, 'None' if self.water_tank.state is None else self.water_tank.state.name)
+        if(not self.water_tank.enabled or self.water_tank.fill_fraction is None):
             return
 
-        settings = get_settings()
+        if( not no_stations_are_on() ):
+            # water drained through open valves is not a leak
+            leak_detector.Reset()
+            return
 
-        if( self.water_tank.percentage is not None and 
-        (self.percentage_mark is not None and self.percentage_mark > self.water_tank.percentage) and
-        no_stations_are_on()
-        ):
-            print("Will send xmpp water loss message")
+        leak_detector.Add(self.water_tank.id, self.water_tank.fill_fraction)
+        leak = leak_detector.Leak(self.water_tank.id, self.water_tank.capacity_litres)
+        if( leak is not None ):
+            percent_per_hour, litres_per_hour = leak
+            settings = get_settings()
+            log.info("Will send xmpp water loss message. water_tank id:%s, %s%%/h, %s l/h", self.water_tank.id, percent_per_hour, litres_per_hour)
             msg = settings[XMPP_WATER_LOSS_MSG].format(
                 water_tank_id = self.water_tank.id,
                 water_tank_label = self.water_tank.label,
                 sensor_id = self.water_tank.sensor_id,
                 percentage = self.water_tank.percentage,
+                volume = self.water_tank.volume_litres,
+                capacity = self.water_tank.capacity_litres,
+                leak_rate = u"{} %/h".format(percent_per_hour) if litres_per_hour is None else u"{} l/h".format(litres_per_hour),
                 measurement = self.water_tank.sensor_measurement,
                 last_updated = self.water_tank.last_updated,
                 mqtt_topic = self.mqtt_msg.topic,
                 additional_info = self.water_tank.AdditionalInfo4Msg()
             )
-            print("Water Loss email:{}, xmpp:{}".format(self.water_tank.loss_email, self.water_tank.loss_xmpp))
-            if( self.water_tank.loss_xmpp ):
-                xmpp_send_msg( msg )
-            if( self.water_tank.loss_email ):
-                email_send_msg( msg, "Water Loss" )
+            log.debug("Water Loss email:%s, xmpp:%s", self.water_tank.loss_email, self.water_tank.loss_xmpp)
+            send_notification(self.water_tank.id, "Water Loss", msg, self.water_tank.loss_xmpp, self.water_tank.loss_email, urgent = True)
 
     def DeadSensorDetected(self):
         if(not self.water_tank.enabled):
@@ -1036,22 +1390,21 @@ class MessageSender():
             and self.water_tank.last_updated is not None 
             and (settings[DEAD_SENSOR_EMAIL] or settings[DEAD_SENSOR_XMPP])
         ):
-            print("Will send dead-sensor message")
+            log.info("Will send dead-sensor message")
             msg = settings[DEAD_SENSOR_MSG].format(
                 water_tank_id = self.water_tank.id,
                 water_tank_label = self.water_tank.label,
                 sensor_id = self.water_tank.sensor_id,
                 percentage = self.water_tank.percentage,
+                volume = self.water_tank.volume_litres,
+                capacity = self.water_tank.capacity_litres,
                 measurement = self.water_tank.sensor_measurement,
                 last_updated = self.water_tank.last_updated,
                 mqtt_topic = self.water_tank.sensor_mqtt_topic,
                 additional_info = self.water_tank.AdditionalInfo4Msg()
             )
-            print("Dead-sensor email:{}, xmpp:{}".format(settings[DEAD_SENSOR_EMAIL], settings[DEAD_SENSOR_XMPP]))
-            if( settings[DEAD_SENSOR_XMPP] ):
-                xmpp_send_msg( msg )
-            if( settings[DEAD_SENSOR_EMAIL] ):
-                email_send_msg( msg, "Dead Sensor" )
+            log.debug("Dead-sensor email:%s, xmpp:%s", settings[DEAD_SENSOR_EMAIL], settings[DEAD_SENSOR_XMPP])
+            send_notification(self.water_tank.id, "Dead Sensor", msg, settings[DEAD_SENSOR_XMPP], settings[DEAD_SENSOR_EMAIL])
 
     def SensorWarningUpdated(self):
         if(not self.water_tank.enabled):
@@ -1060,7 +1413,7 @@ class MessageSender():
         if(not self.water_tank.sensor_warning):
             return
         
-        print("Will send sensor warning message")
+        log.info("Will send sensor warning message")
         settings = get_settings()
         msg = settings[SENSOR_WARNING_MSG].format(
             sensor_warning = self.water_tank.sensor_warning, 
@@ -1068,21 +1421,108 @@ class MessageSender():
             water_tank_label = self.water_tank.label,
             sensor_id = self.water_tank.sensor_id,
             percentage = self.water_tank.percentage,
+            volume = self.water_tank.volume_litres,
+            capacity = self.water_tank.capacity_litres,
             measurement = self.water_tank.sensor_measurement,
             last_updated = self.water_tank.last_updated,
             mqtt_topic = self.water_tank.sensor_mqtt_topic,
             additional_info = self.water_tank.AdditionalInfo4Msg()
         )
 
-        if(self.water_tank.sensor_warning_xmpp):
-            xmpp_send_msg( msg )
-        if(self.water_tank.sensor_warning_email):
-            email_send_msg( msg, "Sensor Warning" )
+        send_notification(self.water_tank.id, "Sensor Warning", msg, self.water_tank.sensor_warning_xmpp, self.water_tank.sensor_warning_email)
+
+
+class _Completion(th.Event):
+    def __init__(self):
+        super().__init__()
+        self.result = None
+        self.error = None
+
+
+class StateActor(th.Thread):
+    """
+    The single owner of the water tank state. Every read-modify-write of the settings,
+    the water tanks and the sensor log runs on this thread one command at a time, whether
+    it comes from mqtt, the web pages, SIP signals or timers, so no update can be lost.
+    Readers call get_settings() and get their own copy of the last saved state.
+    """
+    def __init__(self):
+        super().__init__(name=u"water_tank_state", daemon=True)
+        self.commands = queue.Queue()
+
+    def run(self):
+        while True:
+            command, args, kwargs, completion = self.commands.get()
+            try:
+                result = command(*args, **kwargs)
+                if completion is not None:
+                    completion.result = result
+            except Exception as e:
+                if completion is not None:
+                    completion.error = e
+                else:
+                    log.exception("Exception in water tank state command %s. %s", getattr(command, "__name__", command), e)
+            finally:
+                flush_program_data()
+                if completion is not None:
+                    completion.set()
+
+    def Call(self, command, *args, **kwargs):
+        """
+        Run command on the state thread, wait for it and return its result or raise its exception.
+        Commands calling other commands run them directly.
+        """
+        if th.current_thread() is self:
+            return command(*args, **kwargs)
+        completion = _Completion()
+        self.commands.put((command, args, kwargs, completion))
+        completion.wait()
+        if completion.error is not None:
+            raise completion.error
+        return completion.result
+
+    def Post(self, command, *args, **kwargs):
+        """
+        Queue command to run on the state thread after the commands already queued, without waiting for it
+        """
+        self.commands.put((command, args, kwargs, None))
+
+
+state_actor = StateActor()   # started by start_plugin
+_program_data_dirty = False
+
+
+def program_data_changed():
+    """
+    Note that programs were enabled or disabled in gv.pd. On the state thread programData
+    is saved and the toggle reported once, after the current command, however many water
+    tanks changed programs in it; elsewhere right away.
+    """
+    global _program_data_dirty
+    _program_data_dirty = True
+    if th.current_thread() is not state_actor:
+        flush_program_data()
+
+
+def flush_program_data():
+    global _program_data_dirty
+    if not _program_data_dirty:
+        return
+    _program_data_dirty = False
+    try:
+        jsave(gv.pd, "programData")
+        report_program_toggle()
+    except Exception as e:
+        log.exception("Could not save program data. %s", e)
 
 
 ### Station Completed ###
 def notify_zone_change(name, **kw):
-    print(u"Zone change signal received")
+    state_actor.Post(zone_changed)
+
+
+def zone_changed():
+    log.debug(u"Zone change signal received")
     settings = get_settings()
     for swt_id, swt in settings["water_tanks"].items():
         wt = WaterTankFactory.FromDict(swt)
@@ -1094,33 +1534,62 @@ complete.connect(notify_zone_change)
 
 ### program change ##
 def notify_running_program_change(name, **kw):
-    print("Programs changed")
+    # when fired while a command runs on the state thread this runs after it
+    state_actor.Post(running_program_changed)
+
+
+def running_program_changed():
+    log.debug("Programs changed")
     #  Programs are in gv.pd and /data/programs.json
     settings = get_settings()
-    water_tank_updated = False
+    updated_ids = []
     for swt_id, swt in settings["water_tanks"].items():
         wt = WaterTankFactory.FromDict(swt)
-        water_tank_updated = wt.RunningProgramChanged()
-        if(water_tank_updated):
-            settings["water_tanks"][wt.id] = wt.__dict__
+        if(wt.RunningProgramChanged()):
+            settings["water_tanks"][wt.id] = wt.ToDict()
+            updated_ids.append(wt.id)
 
-    if(water_tank_updated):
-        print("Programs were updated, saving settings to file")
-        with open(DATA_FILE, u"w") as f:
-            json.dump(settings, f, default=serialize_datetime, indent=4)  # save to file
+    if(updated_ids):
+        log.debug("Programs were updated, saving settings to file")
+        write_settings(settings, updated_ids)
 
 running_program_change = signal("running_program_change")
 running_program_change.connect(notify_running_program_change)
 
 
 DATA_FILE = u"./data/water_tank.json"
+BASE_HTML_MARKER_FILE = u"./data/water_tank.base_html.json"   # stat of templates/base.html once it was checked
 LOG_FILE = u"./data/water_tank.sensor_log.json"
+SQLITE_FILE = u"./data/water_tank.db"
+SENSOR_LOG_ARCHIVE_DIR = u"./data/water_tank.sensor_log"
+SENSOR_LOG_BINARY_FILE = u"./data/water_tank.sensor_log.bin"
+DATA_FILE_VERSION = 2   # 2: only configured program/station reactions are stored
+VERSION = u"version"
+HUMAN_READABLE_JSON = u"human_readable_json"
+STORAGE_BACKEND = u"storage_backend"
+STORAGE_JSON = u"json"
+STORAGE_SQLITE = u"sqlite"
+LOG_LEVEL = u"log_level"
+LOG_LEVELS = [u"DEBUG", u"INFO", u"WARNING", u"ERROR"]
+LOG_RATE_LIMIT_SECONDS = u"log_rate_limit_seconds"
+NOTIFICATION_COOLDOWN_SECONDS = u"notification_cooldown_seconds"
+NOTIFICATION_MAX_COOLDOWN_SECONDS = u"notification_max_cooldown_seconds"
+NOTIFICATION_MAX_PER_HOUR = u"notification_max_per_hour"
+LEAK_WINDOW_MINUTES = u"leak_window_minutes"
+LEAK_MIN_LITRES_PER_HOUR = u"leak_min_litres_per_hour"
+PREDICTION_WINDOW_MINUTES = u"prediction_window_minutes"
 MQTT_BROKER_WS_PORT = u"mqtt_broker_ws_port"
 WATER_PLUGIN_REQUEST_MQTT_TOPIC = u"request_subscribe_mqtt_topic"
 WATER_PLUGIN_DATA_PUBLISH_MQTT_TOPIC = u"data_publish_mqtt_topic"
+SENSOR_MQTT_WILDCARD_TOPICS = u"sensor_mqtt_wildcard_topics"
+SENSOR_MQTT_QOS = u"sensor_mqtt_qos"
 MAX_STATION_DURATION = "max_station_duration"
 MAX_SENSOR_LOG_RECORDS = "max_sensor_log_records"
 SENSOR_LOG_ENABLED = "sensor_log_enabled"
+SENSOR_LOG_ARCHIVE = u"sensor_log_archive"
+SENSOR_LOG_BINARY = u"sensor_log_binary"
+SENSOR_LOG_RETENTION_DAYS = u"sensor_log_retention_days"
+SENSOR_LOG_RETENTION_MB = u"sensor_log_retention_mb"
 DEAD_SENSOR_MSG = "dead_sensor_msg"
 DEAD_SENSOR_EMAIL = "dead_sensor_email"
 DEAD_SENSOR_XMPP = "dead_sensor_xmpp"
@@ -1149,14 +1618,31 @@ XMPP_OVERFLOW_MSG = u"xmpp_overflow_msg"
 XMPP_WARNING_MSG = u"xmpp_warning_msg"
 XMPP_CRITICAL_MSG = u"xmpp_critical_msg"
 XMPP_WATER_LOSS_MSG = u"water_loss_msg"
-xmpp_msg_placeholders = ["water_tank_id", "water_tank_label", "sensor_id", "measurement", "last_updated", "mqtt_topic", "sensor_warning"]
+xmpp_msg_placeholders = ["water_tank_id", "water_tank_label", "sensor_id", "measurement", "last_updated", "mqtt_topic", "sensor_warning", "volume", "capacity"]
 _settings = {
+    VERSION: DATA_FILE_VERSION,
     MQTT_BROKER_WS_PORT: 8080,
     WATER_PLUGIN_REQUEST_MQTT_TOPIC: "WaterTankDataRequest",
     WATER_PLUGIN_DATA_PUBLISH_MQTT_TOPIC: "WaterTankData",
+    SENSOR_MQTT_WILDCARD_TOPICS: u"",
+    SENSOR_MQTT_QOS: 2,
     MAX_STATION_DURATION: 60,
     MAX_SENSOR_LOG_RECORDS: 1000,
     SENSOR_LOG_ENABLED: True,
+    SENSOR_LOG_ARCHIVE: False,
+    SENSOR_LOG_BINARY: False,
+    SENSOR_LOG_RETENTION_DAYS: 90,
+    SENSOR_LOG_RETENTION_MB: 0,
+    HUMAN_READABLE_JSON: False,
+    STORAGE_BACKEND: STORAGE_JSON,
+    LOG_LEVEL: u"INFO",
+    LOG_RATE_LIMIT_SECONDS: 10,
+    NOTIFICATION_COOLDOWN_SECONDS: 300,
+    NOTIFICATION_MAX_COOLDOWN_SECONDS: 21600,
+    NOTIFICATION_MAX_PER_HOUR: 60,
+    LEAK_WINDOW_MINUTES: 60,
+    LEAK_MIN_LITRES_PER_HOUR: 0,
+    PREDICTION_WINDOW_MINUTES: 10,
     DEAD_SENSOR_EMAIL: True,
     DEAD_SENSOR_XMPP: True,
     DEAD_SENSOR_MSG: u"Sensor '{sensor_id}' of water tank:'{water_tank_id}'/'{water_tank_label}' may be dead. Last update was on '{last_updated}'. Listening for sensor messages on MQTT topic:'{mqtt_topic}'.",
@@ -1182,7 +1668,7 @@ _settings = {
     XMPP_OVERFLOW_MSG: u"Overflow! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]",
     XMPP_WARNING_MSG: u"Warning! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]",
     XMPP_CRITICAL_MSG: u"Critical! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]",
-    XMPP_WATER_LOSS_MSG: u"Water loss! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]",
+    XMPP_WATER_LOSS_MSG: u"Water loss! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, estimated leak: {leak_rate}, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]",
     
     u"water_tanks": {}
         # {
@@ -1446,7 +1932,7 @@ defaults = {
     XMPP_OVERFLOW_MSG: u"Overflow! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]",
     XMPP_WARNING_MSG: u"Warning! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]",
     XMPP_CRITICAL_MSG: u"Critical! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]",
-    XMPP_WATER_LOSS_MSG: u"Water loss! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]"
+    XMPP_WATER_LOSS_MSG: u"Water loss! water tank:'{water_tank_id}'/'{water_tank_label}', sensor_id:'{sensor_id}', percentage: {percentage}%, estimated leak: {leak_rate}, measurement:'{measurement}', date:'{last_updated}', mqtt topic:'{mqtt_topic}'. Additional info:[{additional_info}]"
 }
 
 
@@ -1458,13 +1944,18 @@ urls.extend([
     u"/water-tank-save-water-tanks", u"plugins.water_tank.save_water_tanks",
     u"/water-tank-get-all", u"plugins.water_tank.get_all",
     u"/water-tank-get_mqtt_settings", u"plugins.water_tank.get_mqtt_settings",
+    u"/water-tank-bootstrap", u"plugins.water_tank.bootstrap",
     u"/water_tank_get_settings_json", u"plugins.water_tank.get_settings_json",
     u"/water-tank-delete", u"plugins.water_tank.delete",
     u"/water-tank-save-order", u"plugins.water_tank.save_order",
     u"/water-tank-revert-programs", u"plugins.water_tank.revert_programs",
     u"/water_plugin_sensor_log", u"plugins.water_tank.sensor_log",
     u"/water_plugin_clear_sensor_log", u"plugins.water_tank.clear_sensor_log",
-    u"/water_plugin_download_sensor_log", u"plugins.water_tank.csv_sensor_log"
+    u"/water_plugin_download_sensor_log", u"plugins.water_tank.csv_sensor_log",
+    u"/water-tank-migrate-storage", u"plugins.water_tank.migrate_storage_command",
+    u"/water-tank-ingest-stats", u"plugins.water_tank.ingest_stats",
+    u"/water-tank-query-sensor-log", u"plugins.water_tank.query_sensor_log_records",
+    u"/water-tank-simulate", u"plugins.water_tank.simulate"
     ])
 # fmt: on
 
@@ -1472,77 +1963,1065 @@ urls.extend([
 gv.plugin_menu.append([_(u"Water Tank Plugin"), u"/water-tank-sp"])
 
 
-# Define a custom function to serialize datetime objects 
-def serialize_datetime(obj): 
-    # print('Serializing: {}'.format(obj))
-    if isinstance(obj, datetime): 
-        return obj.isoformat(sep=' ', timespec='seconds')
-    elif isinstance(obj, WaterTankType):
-        return obj.value
-    elif isinstance(obj, WaterTankState):
-        return obj.value
-    elif  isinstance(obj, WaterTankProgram):
-        return obj.__dict__
-    elif  isinstance(obj, WaterTankStation):
-        return obj.__dict__
-    elif  isinstance(obj, WaterTank):
-        val = obj.__dict__.copy()
-        val.pop("state_change_observers")  # do not serialze observer objects
-        return val
-    elif isinstance(obj, MessageSender):
-        return
-    raise TypeError("Type {} not serializable".format(type(obj))) 
+# Converters for the non-primitive objects of the water tank model, looked up by exact type
+_json_converters = {
+    datetime: lambda obj: obj.isoformat(sep=' ', timespec='seconds'),
+    WaterTankType: int,
+    WaterTankState: int,
+    LengthUnit: int,
+    WaterTankProgram: vars,
+    WaterTankStation: vars,
+    WaterTankModel: vars,
+    WaterTankRectangular: WaterTank.ToDict,
+    WaterTankCylindricalHorizontal: WaterTank.ToDict,
+    WaterTankCylindricalVertical: WaterTank.ToDict,
+    WaterTankElliptical: WaterTank.ToDict,
+    WaterTankCalibrationTable: WaterTank.ToDict
+}
 
 
-def get_settings():
-    global _settings
-    try:
-        fh = open(DATA_FILE, "r")
-        try:
-            settings = json.load(fh)
-            _settings = settings
-        except ValueError as e:
-            print(u"Water Tank pluging couldn't parse data file:", e)
-        finally:
-            fh.close()
-    except IOError as e:
-        print(u"Water-Tank Plugin couldn't open data file:", e)
-    # print( 'get_settings() returns : {}'.format(json.dumps(_settings, default=serialize_datetime, indent=4)))
-    return _settings
+def json_default(obj):
+    """
+    Serialize the water tank model objects that json cannot handle natively
+    """
+    converter = _json_converters.get(type(obj))
+    if converter is not None:
+        return converter(obj)
+    if isinstance(obj, WaterTank):
+        return obj.ToDict()
+    raise TypeError("Type {} not serializable".format(type(obj)))
 
 
-def detect_water_tank_js():
+def to_json(obj, human_readable = False):
     """
-    Search base.html for the line that includes the water_tank.js script
+    Serialize water tank data. Output is compact unless human_readable
+    is set, in which case it is indented as it used to be.
+    orjson is used for compact output if it is installed.
     """
-    path = os.getcwd()
-    print('Current dir is {}'.format(path))
-    file_path = path + '/templates/base.html'
-    mqtt_line = '\t<script src="static/scripts/mqttws31.js"></script>\n'
-    validation_line = '\t<script src="static/scripts/jquery.validate.min.js"></script>\n'
-    additional_validation_line = '\t<script src="static/scripts/additional-methods.min.js"></script>\n'
-    script_line = '\t<script src="static/scripts/water_tank.js"></script>\n'
-    css_line = '\t<link href="static/css/water_tank.css" rel="stylesheet" type="text/css"/>\n'
-    header_end_word = '</head>'
-    header_end_word_index = 0
-    found = False
-    contents = []
-    with open(file_path, 'r') as file:
-        for(i, line) in enumerate(file):
-            contents.append(line)
+    if human_readable:
+        return json.dumps(obj, default=json_default, indent=4)
+    if orjson is not None:
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, default=json_default, separators=(",", ":"))
+
+
+def write_data_file(text):
+    """
+    Replace DATA_FILE atomically, so that a reader sees either the previous
+    or the new contents but never a partially written file
+    """
+    tmp_file = DATA_FILE + u".tmp"
+    with io.open(tmp_file, u"w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_file, DATA_FILE)
+
+
+class WaterTankStorage(ABC):
+    """
+    Where water tanks and the sensor log are kept.
+    Plugin settings are always kept in DATA_FILE.
+    """
+    @abstractmethod
+    def LoadWaterTanks(self, settings):
+        """
+        Return the water tanks dictionary. settings is what was read from DATA_FILE.
+        """
+        pass
+
+    @abstractmethod
+    def Save(self, settings, water_tank_ids = None):
+        """
+        Save settings and water tanks. If water_tank_ids is given only
+        these water tanks have changed and the rest of the settings have not.
+        """
+        pass
+
+    @abstractmethod
+    def ReadSensorLog(self):
+        """
+        Return sensor log records, newest first
+        """
+        pass
+
+    @abstractmethod
+    def AppendSensorLog(self, record, max_records):
+        pass
+
+    @abstractmethod
+    def ReplaceSensorLog(self, records):
+        pass
+
+    def ClearSensorLog(self):
+        self.ReplaceSensorLog([])
+
+    def QuerySensorLog(self, topic = None, date_from = None, date_to = None, sensor_id = None, limit = None):
+        """
+        Iterate over up to limit sensor log records of topic and sensor_id logged from date_from
+        up to and including date_to (strings like the record dates), newest first, any of them
+        None for no filter
+        """
+        records = (
+            r for r in self.ReadSensorLog()
+            if (topic is None or r["mqtt_topic"] == topic) and
+                (date_from is None or r["date"] >= date_from) and (date_to is None or r["date"] <= date_to) and
+                (sensor_id is None or sensor_id in payload_sensor_ids(r["mqtt_payload"]))
+        )
+        return itertools.islice(records, limit or None)
+
+
+class JsonStorage(WaterTankStorage):
+    """
+    Water tanks are stored with the settings in DATA_FILE and the sensor log in LOG_FILE
+    """
+    def LoadWaterTanks(self, settings):
+        return settings.get(u"water_tanks", {})
+
+    def Save(self, settings, water_tank_ids = None):
+        write_data_file(to_json(settings, settings.get(HUMAN_READABLE_JSON, False)))
+
+    def ReadSensorLog(self):
+        result = []
+        try:
+            with io.open(LOG_FILE) as logf:
+                records = logf.readlines()
+                for i in records:
+                    try:
+                        rec = ast.literal_eval(json.loads(i))
+                    except ValueError:
+                        rec = json.loads(i)
+                    result.append(rec)
+            return result
+        except IOError:
+            return result
+
+    def AppendSensorLog(self, record, max_records):
+        lines = []
+        lines.append(json.dumps(record) + "\n")
+        log = self.ReadSensorLog()
+        for r in log:
+            lines.append(json.dumps(r) + "\n")
+        self.WriteLines(lines[: max_records] if max_records else lines)
+
+    def ReplaceSensorLog(self, records):
+        self.WriteLines([json.dumps(r) + "\n" for r in records])
+
+    def WriteLines(self, lines):
+        with codecs.open(LOG_FILE, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+
+
+class SqliteStorage(WaterTankStorage):
+    """
+    Water tanks, their program/station reactions and the sensor log are stored
+    in SQLITE_FILE in WAL mode. Updating a water tank updates only its own row
+    and the reaction rows that actually changed.
+    """
+    # water tank fields that get their own column, the rest are stored as json in config
+    COLUMNS = ["order", "sensor_id", "sensor_mqtt_topic", "state", "percentage", "sensor_measurement",
+               "invalid_sensor_measurement", "sensor_warning", "last_updated"]
+    REACTIONS = [("overflow", "program"), ("warning", "program"), ("critical", "program"),
+                 ("overflow", "station"), ("warning", "station"), ("critical", "station")]
+    REACTION_FIELDS = ["run", "enable", "suspend", "minutes", "percentage", "stop_on_exit",
+                       "original_enabled", "start_datetime", "end_datetime"]
+
+    def __init__(self, file_name):
+        import sqlite3  # imported on first use, only needed with this backend
+        self.lock = th.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # reaction rows last read or written per water tank, to write only the changed ones
+        self.written_reactions = {}
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS water_tanks (
+                    id TEXT PRIMARY KEY,
+                    sort_order INTEGER,
+                    sensor_id TEXT,
+                    sensor_mqtt_topic TEXT,
+                    state INTEGER,
+                    percentage REAL,
+                    sensor_measurement REAL,
+                    invalid_sensor_measurement INTEGER,
+                    sensor_warning TEXT,
+                    last_updated TEXT,
+                    config TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS water_tanks_sensor_id ON water_tanks(sensor_id);
+                CREATE INDEX IF NOT EXISTS water_tanks_sensor_mqtt_topic ON water_tanks(sensor_mqtt_topic);
+                CREATE TABLE IF NOT EXISTS reactions (
+                    water_tank_id TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    item_id TEXT NOT NULL,
+                    run INTEGER,
+                    enable INTEGER,
+                    suspend INTEGER,
+                    minutes INTEGER,
+                    percentage INTEGER,
+                    stop_on_exit INTEGER,
+                    original_enabled INTEGER,
+                    start_datetime TEXT,
+                    end_datetime TEXT,
+                    PRIMARY KEY (water_tank_id, state, kind, item_id)
+                );
+                CREATE TABLE IF NOT EXISTS sensor_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date TEXT NOT NULL,
+                    mqtt_topic TEXT,
+                    mqtt_payload TEXT
+                );
+                CREATE INDEX IF NOT EXISTS sensor_log_date ON sensor_log(date);
+                CREATE INDEX IF NOT EXISTS sensor_log_mqtt_topic ON sensor_log(mqtt_topic);
+            """)
+            # the sensor ids of every record, a list payload has several; added later, so the
+            # records logged before are indexed when the table is created
+            indexed = self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sensor_log_sensors'").fetchone()
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS sensor_log_sensors (
+                    log_id INTEGER NOT NULL,
+                    sensor_id TEXT NOT NULL,
+                    PRIMARY KEY (log_id, sensor_id)
+                );
+                CREATE INDEX IF NOT EXISTS sensor_log_sensors_sensor_id ON sensor_log_sensors(sensor_id, log_id);
+                DROP INDEX IF EXISTS sensor_log_sensor_id;
+            """)
+            if not indexed:
+                for row in self.connection.execute("SELECT id, mqtt_payload FROM sensor_log").fetchall():
+                    self.IndexSensorIds(row["id"], row["mqtt_payload"])
+
+    def LoadWaterTanks(self, settings):
+        water_tanks = {}
+        with self.lock:
+            for row in self.connection.execute("SELECT * FROM water_tanks"):
+                water_tank = json.loads(row["config"])
+                water_tank["id"] = row["id"]
+                for column in self.COLUMNS:
+                    water_tank[column] = row["sort_order" if column == "order" else column]
+                water_tank["invalid_sensor_measurement"] = None if row["invalid_sensor_measurement"] is None else bool(row["invalid_sensor_measurement"])
+                for state, kind in self.REACTIONS:
+                    water_tank[state + "_" + kind + "s"] = {}
+                water_tanks[row["id"]] = water_tank
+
+            self.written_reactions = {}
+            for row in self.connection.execute("SELECT * FROM reactions"):
+                water_tank = water_tanks.get(row["water_tank_id"])
+                if water_tank is None:
+                    continue
+                values = tuple(row[f] for f in self.REACTION_FIELDS)
+                self.written_reactions.setdefault(row["water_tank_id"], {})[(row["state"], row["kind"], row["item_id"])] = values
+                water_tank[row["state"] + "_" + row["kind"] + "s"][row["item_id"]] = self.ReactionToDict(row["kind"], row["item_id"], values)
+        return water_tanks
+
+    @staticmethod
+    def ReactionToDict(kind, item_id, values):
+        r = dict(zip(SqliteStorage.REACTION_FIELDS, values))
+        if kind == "program":
+            return {
+                "id": item_id, "original_enabled": r["original_enabled"],
+                "run": bool(r["run"]), "enable": bool(r["enable"]), "suspend": bool(r["suspend"]),
+                "start_datetime": r["start_datetime"], "end_datetime": r["end_datetime"]
+            }
+        return {
+            "station_id": item_id, "run": bool(r["run"]), "minutes": r["minutes"],
+            "percentage": r["percentage"], "stop_on_exit": bool(r["stop_on_exit"]),
+            "start_datetime": r["start_datetime"], "end_datetime": r["end_datetime"]
+        }
+
+    def Save(self, settings, water_tank_ids = None):
+        water_tanks = settings.get(u"water_tanks", {})
+        save_all = water_tank_ids is None
+        if save_all:
+            # settings may have changed too, water tanks are not kept in DATA_FILE
+            file_settings = dict(settings)
+            file_settings[u"water_tanks"] = {}
+            write_data_file(to_json(file_settings, settings.get(HUMAN_READABLE_JSON, False)))
+            water_tank_ids = list(water_tanks.keys())
+
+        with self.lock, self.connection:
+            if save_all:
+                # delete water tanks that are no longer there
+                existing = [row["id"] for row in self.connection.execute("SELECT id FROM water_tanks")]
+                for id in existing:
+                    if id not in water_tanks:
+                        self.connection.execute("DELETE FROM water_tanks WHERE id = ?", (id,))
+                        self.connection.execute("DELETE FROM reactions WHERE water_tank_id = ?", (id,))
+                        self.written_reactions.pop(id, None)
+
+            for id in water_tank_ids:
+                if id in water_tanks:
+                    self.SaveWaterTank(json.loads(to_json(water_tanks[id])))
+
+    def SaveWaterTank(self, water_tank):
+        id = water_tank["id"]
+        config = {k: v for k, v in water_tank.items() if k != "id" and k not in self.COLUMNS and
+                  k not in [state + "_" + kind + "s" for state, kind in self.REACTIONS]}
+        values = [water_tank.get(column) for column in self.COLUMNS]
+        self.connection.execute(
+            "INSERT INTO water_tanks (id, sort_order, sensor_id, sensor_mqtt_topic, state, percentage, sensor_measurement, "
+            "invalid_sensor_measurement, sensor_warning, last_updated, config) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET sort_order = excluded.sort_order, sensor_id = excluded.sensor_id, "
+            "sensor_mqtt_topic = excluded.sensor_mqtt_topic, state = excluded.state, percentage = excluded.percentage, "
+            "sensor_measurement = excluded.sensor_measurement, invalid_sensor_measurement = excluded.invalid_sensor_measurement, "
+            "sensor_warning = excluded.sensor_warning, last_updated = excluded.last_updated, config = excluded.config",
+            [id] + values + [json.dumps(config)]
+        )
+
+        reactions = {}
+        for state, kind in self.REACTIONS:
+            for item_id, r in (water_tank.get(state + "_" + kind + "s") or {}).items():
+                reactions[(state, kind, str(item_id))] = tuple(r.get(f) for f in self.REACTION_FIELDS)
+
+        written = self.written_reactions.get(id)
+        if written is None:
+            self.connection.execute("DELETE FROM reactions WHERE water_tank_id = ?", (id,))
+            written = {}
+        for key in written:
+            if key not in reactions:
+                self.connection.execute("DELETE FROM reactions WHERE water_tank_id = ? AND state = ? AND kind = ? AND item_id = ?", (id,) + key)
+        for key, values in reactions.items():
+            if written.get(key) != values:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO reactions (water_tank_id, state, kind, item_id, " + ", ".join(self.REACTION_FIELDS) +
+                    ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (id,) + key + values
+                )
+        self.written_reactions[id] = reactions
+
+    def ReadSensorLog(self):
+        with self.lock:
+            return [
+                {"date": row["date"], "mqtt_topic": row["mqtt_topic"], "mqtt_payload": row["mqtt_payload"]}
+                for row in self.connection.execute("SELECT date, mqtt_topic, mqtt_payload FROM sensor_log ORDER BY id DESC")
+            ]
+
+    def IndexSensorIds(self, log_id, payload):
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO sensor_log_sensors (log_id, sensor_id) VALUES (?, ?)",
+            [(log_id, sensor_id) for sensor_id in payload_sensor_ids(payload)]
+        )
+
+    def InsertSensorLog(self, record):
+        cursor = self.connection.execute(
+            "INSERT INTO sensor_log (date, mqtt_topic, mqtt_payload) VALUES (?, ?, ?)",
+            (record["date"], record["mqtt_topic"], record["mqtt_payload"])
+        )
+        self.IndexSensorIds(cursor.lastrowid, record["mqtt_payload"])
+
+    def AppendSensorLog(self, record, max_records):
+        with self.lock, self.connection:
+            self.InsertSensorLog(record)
+            if max_records:
+                row = self.connection.execute("SELECT id FROM sensor_log ORDER BY id DESC LIMIT 1 OFFSET ?", (max_records,)).fetchone()
+                if row is not None:
+                    self.connection.execute("DELETE FROM sensor_log WHERE id <= ?", (row["id"],))
+                    self.connection.execute("DELETE FROM sensor_log_sensors WHERE log_id <= ?", (row["id"],))
+
+    def QuerySensorLog(self, topic = None, date_from = None, date_to = None, sensor_id = None, limit = None):
+        conditions = []
+        parameters = []
+        for condition, value in (("l.mqtt_topic = ?", topic), ("s.sensor_id = ?", sensor_id), ("l.date >= ?", date_from), ("l.date <= ?", date_to)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        # by sensor the records are walked in the order of the sensor_id index
+        source = "sensor_log l" if sensor_id is None else "sensor_log_sensors s JOIN sensor_log l ON l.id = s.log_id"
+        order = "l.id" if sensor_id is None else "s.log_id"
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT l.date, l.mqtt_topic, l.mqtt_payload FROM " + source +
+                (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY " + order + " DESC" +
+                (" LIMIT ?" if limit else ""),
+                parameters + ([limit] if limit else [])
+            ).fetchall()
+        return ({"date": row["date"], "mqtt_topic": row["mqtt_topic"], "mqtt_payload": row["mqtt_payload"]} for row in rows)
+
+    def ReplaceSensorLog(self, records):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM sensor_log")
+            self.connection.execute("DELETE FROM sensor_log_sensors")
+            for r in reversed(records):
+                self.InsertSensorLog(r)
+
+
+_storages = {}
+
+
+def get_storage(settings = None):
+    """
+    Return the storage backend selected in settings
+    """
+    if settings is None:
+        settings = _settings
+    backend = settings.get(STORAGE_BACKEND, STORAGE_JSON)
+    if backend not in _storages:
+        if backend == STORAGE_SQLITE:
+            _storages[backend] = SqliteStorage(SQLITE_FILE)
+        else:
+            _storages[backend] = JsonStorage()
+    return _storages[backend]
+
+
+def migrate_storage(settings, backend):
+    """
+    Copy water tanks and the sensor log to another storage backend and switch to it
+    """
+    source = get_storage(settings)
+    if settings.get(STORAGE_BACKEND, STORAGE_JSON) == backend:
+        return
+    log.info(u"Water Tank plugin migrating storage from %s to %s", settings.get(STORAGE_BACKEND, STORAGE_JSON), backend)
+    records = source.ReadSensorLog()
+    settings[STORAGE_BACKEND] = backend
+    target = get_storage(settings)
+    target.Save(settings)
+    target.ReplaceSensorLog(records)
+    invalidate_payload_cache()
+
+
+class SensorLogArchive():
+    """
+    Long term sensor log, kept in a gzip compressed segment file per day in a directory.
+    Records are buffered and appended to the segment of their day in batches, so logging
+    a message costs no file I/O. Segments older than retention_days are deleted and the
+    oldest ones are deleted while all of them take more than retention_bytes, 0 for no limit.
+    """
+    SEGMENT_PREFIX = u"sensor_log-"
+    SEGMENT_SUFFIX = u".jsonl.gz"
+
+    def __init__(self, directory, flush_records = 100, flush_seconds = 60):
+        self.directory = directory
+        self.flush_records = flush_records
+        self.flush_seconds = flush_seconds
+        self.retention_days = 90
+        self.retention_bytes = 0
+        self.pending = []           # records not written yet, oldest first
+        self.pending_since = None   # monotonic time of the oldest pending record
+        self.lock = th.Lock()
+
+    def Configure(self, retention_days, retention_bytes):
+        with self.lock:
+            self.retention_days = retention_days
+            self.retention_bytes = retention_bytes
+            self.PruneLocked()
+
+    def Append(self, record):
+        with self.lock:
+            if self.pending and self.pending[-1]["date"][:10] != record["date"][:10]:
+                self.FlushLocked()  # the day changed, close the previous segment
+                self.PruneLocked()
+            if not self.pending:
+                self.pending_since = time.monotonic()
+            self.pending.append(record)
+            if len(self.pending) >= self.flush_records or time.monotonic() - self.pending_since >= self.flush_seconds:
+                self.FlushLocked()
+
+    def Flush(self):
+        with self.lock:
+            self.FlushLocked()
+
+    def FlushIfDue(self):
+        """
+        Write the pending records once the oldest has waited flush_seconds, even if no
+        further record arrives. Called periodically.
+        """
+        with self.lock:
+            if self.pending and time.monotonic() - self.pending_since >= self.flush_seconds:
+                self.FlushLocked()
+
+    def FlushLocked(self):
+        if not self.pending:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        segments = {}
+        for r in self.pending:
+            segments.setdefault(r["date"][:10], []).append(json.dumps(r) + "\n")
+        for day, lines in segments.items():
+            # every flush appends a gzip member, readers see the members as one stream
+            with gzip.open(self.SegmentPath(day), "at", encoding="utf-8") as f:
+                f.writelines(lines)
+        self.pending = []
+
+    def PruneLocked(self):
+        days = self.Days()
+        if self.retention_days:
+            oldest = (datetime.now() - timedelta(days=self.retention_days)).date().isoformat()
+            for day in [d for d in days if d < oldest]:
+                os.remove(self.SegmentPath(day))
+                days.remove(day)
+        if self.retention_bytes:
+            sizes = [os.path.getsize(self.SegmentPath(d)) for d in days]
+            while len(days) > 1 and sum(sizes) > self.retention_bytes:
+                os.remove(self.SegmentPath(days.pop(0)))
+                sizes.pop(0)
+
+    def SegmentPath(self, day):
+        return os.path.join(self.directory, self.SEGMENT_PREFIX + day + self.SEGMENT_SUFFIX)
+
+    def Days(self):
+        """Return the days that have a segment, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(
+            n[len(self.SEGMENT_PREFIX): -len(self.SEGMENT_SUFFIX)] for n in names
+            if n.startswith(self.SEGMENT_PREFIX) and n.endswith(self.SEGMENT_SUFFIX)
+        )
+
+    def Read(self, date_from = None, date_to = None):
+        """
+        Iterate over the archived records logged from date_from up to and including date_to
+        (strings like the record dates, None for no limit), newest first. Segments are read
+        one at a time and only those of the days in range, so callers that stop early do not
+        decompress the older ones.
+        """
+        with self.lock:
+            pending = list(self.pending)
+            days = self.Days()
+        in_range = lambda r: (date_from is None or r["date"] >= date_from) and (date_to is None or r["date"] <= date_to)
+        for r in reversed(pending):
+            if in_range(r):
+                yield r
+        for day in reversed(days):
+            if date_to is not None and day > date_to[:10]:
+                continue
+            if date_from is not None and day < date_from[:10]:
+                break
+            try:
+                with gzip.open(self.SegmentPath(day), "rt", encoding="utf-8") as f:
+                    lines = f.readlines()
+            except (IOError, EOFError) as e:   # pruned meanwhile or truncated by a crash
+                log.warning(u"Could not read sensor log segment %s: %s", day, e)
+                continue
+            for line in reversed(lines):
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue
+                if in_range(r):
+                    yield r
+
+    def Clear(self):
+        with self.lock:
+            self.pending = []
+            for day in self.Days():
+                os.remove(self.SegmentPath(day))
+
+
+sensor_log_archive = SensorLogArchive(SENSOR_LOG_ARCHIVE_DIR)
+
+
+class BinarySensorLog():
+    """
+    Sensor log of fixed width binary records: a header of timestamp, topic id and
+    payload length followed by the raw payload bytes. Topics and sensor ids are stored
+    once in dictionary files. Sidecar files hold, per record, its offset and its topic
+    and sensor ids, one entry per sensor id of a list payload, so the n-th newest record
+    is found without reading the ones before it and queries by topic, sensor and time only
+    read the records they return. Once there are twice max_records the newest max_records
+    are kept.
+    A record is written to the data, keys and index files in that order, its index entry
+    makes it part of the log. Compaction writes new files and a marker, then replaces the
+    files. On first use a compaction the marker shows as done is finished, and the files
+    are cut back to the records that are complete in all of them, so a crash in between
+    leaves no index entry that points at the wrong record.
+    """
+    HEADER = struct.Struct("<dHI")  # timestamp, topic id, payload length
+    OFFSET = struct.Struct("<Q")
+    KEYS = struct.Struct("<IHI")    # record number, topic id, sensor id + 1 or 0 for none
+    MAX_TOPICS = 65536              # topic ids are 16 bit
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.index_file_name = file_name + u".idx"
+        self.keys_file_name = file_name + u".sensor_keys"
+        self.old_keys_file_name = file_name + u".keys"     # one sensor id per record, rebuilt as keys_file_name
+        self.names_file_names = {u"topics": file_name + u".topics.json", u"sensors": file_name + u".sensors.json"}
+        self.names = None       # {"topics": [topic], "sensors": [sensor id]}, loaded on first use
+        self.name_ids = None    # {"topics": {topic: id}, "sensors": {sensor id: id}}
+        self.postings = None    # {("topics" or "sensors", id): [record numbers]}, built on first query
+        self.compaction_file_name = file_name + u".compacting"
+        self.recovered = False
+        self.lock = th.Lock()
+
+    def LoadNames(self):
+        if self.names is None:
+            self.names = {}
+            for kind, file_name in self.names_file_names.items():
+                try:
+                    with io.open(file_name, "r", encoding="utf-8") as f:
+                        self.names[kind] = json.load(f)
+                except (IOError, ValueError):
+                    self.names[kind] = []
+            self.name_ids = {kind: {n: i for i, n in enumerate(names)} for kind, names in self.names.items()}
+
+    def NameId(self, kind, name):
+        self.LoadNames()
+        ids = self.name_ids[kind]
+        if name not in ids:
+            ids[name] = len(self.names[kind])
+            self.names[kind].append(name)
+            self.WriteFile(self.names_file_names[kind], json.dumps(self.names[kind]).encode("utf-8"))
+        return ids[name]
+
+    @staticmethod
+    def WriteFile(file_name, contents):
+        """Replace file_name with contents through a temporary file"""
+        with open(file_name + u".tmp", "wb") as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(file_name + u".tmp", file_name)
+
+    def RecoverLocked(self):
+        """
+        Finish or undo a compaction a crash interrupted and cut the files back to the
+        records complete in all of them, once before the log is first used
+        """
+        if self.recovered:
+            return
+        self.recovered = True
+        compacted = [self.file_name, self.keys_file_name, self.index_file_name]
+        if os.path.exists(self.compaction_file_name):
+            # the new files were complete, replace the ones that are left
+            for file_name in compacted:
+                if os.path.exists(file_name + u".tmp"):
+                    os.replace(file_name + u".tmp", file_name)
+            os.remove(self.compaction_file_name)
+        for file_name in compacted:
+            if os.path.exists(file_name + u".tmp"):
+                os.remove(file_name + u".tmp")
+        if not os.path.exists(self.index_file_name):
+            return
+
+        with open(self.index_file_name, "rb") as f:
+            index = f.read()
+        try:
+            with open(self.file_name, "rb") as f:
+                data = f.read()
+        except IOError:
+            data = b""
+        offsets = [o for (o,) in self.OFFSET.iter_unpack(index[: len(index) - len(index) % self.OFFSET.size])]
+        # the last records may point past the data that made it to disk
+        end = 0
+        count = len(offsets)
+        while count:
+            offset = offsets[count - 1]
+            if offset + self.HEADER.size <= len(data):
+                end = offset + self.HEADER.size + self.HEADER.unpack_from(data, offset)[2]
+                if end <= len(data):
+                    break
+            count -= 1
+            end = 0
+        if count * self.OFFSET.size != len(index) or end != len(data):
+            log.warning("Sensor log '%s' was not closed cleanly, keeping its %s complete records", self.file_name, count)
+            for file_name, size in ((self.index_file_name, count * self.OFFSET.size), (self.file_name, end)):
+                with open(file_name, "r+b") as f:
+                    f.truncate(size)
+
+        if not os.path.exists(self.keys_file_name):
+            return
+        with open(self.keys_file_name, "rb") as f:
+            keys = f.read()
+        entries = list(self.KEYS.iter_unpack(keys[: len(keys) - len(keys) % self.KEYS.size]))
+        # entries are in record order, the ones of records not in the index are dropped
+        complete = bisect_left([entry[0] for entry in entries], count)
+        if count and (not complete or entries[complete - 1][0] != count - 1):
+            # keys are written before the index, they can only miss records if a crash lost them
+            self.RebuildKeysLocked()
+        elif complete * self.KEYS.size != len(keys):
+            with open(self.keys_file_name, "r+b") as f:
+                f.truncate(complete * self.KEYS.size)
+
+    def Keys(self, number, topic_id, payload):
+        """Return the keys entries of record number, one per sensor id of its payload"""
+        sensor_keys = [self.NameId(u"sensors", sensor_id) + 1 for sensor_id in payload_sensor_ids(payload)] or [0]
+        return b"".join(self.KEYS.pack(number, topic_id, sensor_key) for sensor_key in sensor_keys)
+
+    def RebuildKeysLocked(self):
+        """Write the keys file from the records, e.g. of a log written with the old keys file"""
+        keys = []
+        files = self.Open()
+        if files is not None:
+            index_file, data_file = files
+            with index_file, data_file:
+                offsets = [o for (o,) in self.OFFSET.iter_unpack(index_file.read())]
+                data = data_file.read()
+            for number, offset in enumerate(offsets):
+                timestamp, topic_id, length = self.HEADER.unpack_from(data, offset)
+                keys.append(self.Keys(number, topic_id, data[offset + self.HEADER.size: offset + self.HEADER.size + length]))
+        self.WriteFile(self.keys_file_name, b"".join(keys))
+        if os.path.exists(self.old_keys_file_name):
+            os.remove(self.old_keys_file_name)
+
+    def Append(self, timestamp, topic, payload, max_records):
+        with self.lock:
+            self.RecoverLocked()
+            if not os.path.exists(self.keys_file_name):
+                self.RebuildKeysLocked()
+            self.LoadNames()
+            if topic not in self.name_ids[u"topics"] and len(self.names[u"topics"]) >= self.MAX_TOPICS:
+                log.error("Sensor log '%s' has %s topics, not logging the message of new topic '%s'", self.file_name, self.MAX_TOPICS, topic)
+                return
+            topic_id = self.NameId(u"topics", topic)
+            try:
+                number = os.path.getsize(self.index_file_name) // self.OFFSET.size
+            except OSError:
+                number = 0
+            keys = self.Keys(number, topic_id, payload)
+            with open(self.file_name, "ab") as f:
+                offset = f.tell()
+                f.write(self.HEADER.pack(timestamp, topic_id, len(payload)) + payload)
+            with open(self.keys_file_name, "ab") as f:
+                f.write(keys)
+            with open(self.index_file_name, "ab") as f:
+                f.write(self.OFFSET.pack(offset))
+                count = f.tell() // self.OFFSET.size
+            if self.postings is not None:
+                self.AddPostings(keys)
+            if max_records and count >= 2 * max_records:
+                self.KeepLocked(max_records)
+
+    def KeepLocked(self, n):
+        """Rewrite the log with only its newest n records"""
+        with open(self.index_file_name, "rb") as f:
+            f.seek(-n * self.OFFSET.size, os.SEEK_END)
+            offsets = [o for (o,) in self.OFFSET.iter_unpack(f.read())]
+        with open(self.file_name, "rb") as f:
+            f.seek(offsets[0])
+            data = f.read()
+        with open(self.keys_file_name, "rb") as f:
+            entries = list(self.KEYS.iter_unpack(f.read()))
+        first = os.path.getsize(self.index_file_name) // self.OFFSET.size - n
+        keys = b"".join(self.KEYS.pack(number - first, topic_id, sensor_key) for number, topic_id, sensor_key in entries if number >= first)
+        base = offsets[0]
+        compacted = ((self.file_name, data),
+                     (self.keys_file_name, keys),
+                     (self.index_file_name, b"".join(self.OFFSET.pack(o - base) for o in offsets)))
+        for file_name, contents in compacted:
+            with open(file_name + u".tmp", "wb") as f:
+                f.write(contents)
+                f.flush()
+                os.fsync(f.fileno())
+        # once the marker is there RecoverLocked completes the replacements after a crash
+        self.WriteFile(self.compaction_file_name, b"")
+        for file_name, contents in compacted:
+            os.replace(file_name + u".tmp", file_name)
+        os.remove(self.compaction_file_name)
+        self.postings = None    # record numbers have changed
+
+    def AddPostings(self, keys):
+        for number, topic_id, sensor_key in self.KEYS.iter_unpack(keys):
+            topic_postings = self.postings.setdefault((u"topics", topic_id), [])
+            if not topic_postings or topic_postings[-1] != number:
+                topic_postings.append(number)
+            if sensor_key:
+                self.postings.setdefault((u"sensors", sensor_key - 1), []).append(number)
+
+    def LoadPostings(self):
+        if self.postings is None:
+            if not os.path.exists(self.keys_file_name):
+                self.RebuildKeysLocked()
+            with open(self.keys_file_name, "rb") as f:
+                keys = f.read()
+            self.postings = {}
+            self.AddPostings(keys)
+
+    def Open(self):
+        """Return the open index and data files, None if there are no records"""
+        try:
+            index_file = open(self.index_file_name, "rb")
+        except IOError:
+            return None
+        if os.fstat(index_file.fileno()).st_size == 0:
+            index_file.close()
+            return None
+        return index_file, open(self.file_name, "rb")
+
+    def Records(self, files, numbers, topics):
+        """
+        Iterate over the records with the given record numbers of the open files.
+        Compaction replaces the files, so the ones opened stay as they were.
+        """
+        if files is None:
+            return
+        index_file, data_file = files
+        with index_file, data_file:
+            index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for i in numbers(index, data):
+                    (offset,) = self.OFFSET.unpack_from(index, i * self.OFFSET.size)
+                    timestamp, topic_id, length = self.HEADER.unpack_from(data, offset)
+                    payload = data[offset + self.HEADER.size: offset + self.HEADER.size + length]
+                    yield {
+                        "date": datetime.fromtimestamp(timestamp).isoformat(sep=' ', timespec='seconds'),
+                        "mqtt_topic": topics[topic_id] if topic_id < len(topics) else u"",
+                        "mqtt_payload": payload.decode("utf-8", "replace")
+                    }
+            finally:
+                index.close()
+                data.close()
+
+    def Read(self, start = 0):
+        """
+        Iterate over the records, newest first, skipping the newest start ones
+        """
+        with self.lock:
+            self.RecoverLocked()
+            self.LoadNames()
+            files = self.Open()
+            topics = list(self.names[u"topics"])
+        count = 0 if files is None else os.fstat(files[0].fileno()).st_size // self.OFFSET.size
+        return self.Records(files, lambda index, data: range(count - 1 - start, -1, -1), topics)
+
+    def Query(self, topic = None, sensor_id = None, date_from = None, date_to = None, limit = 1000):
+        """
+        Return up to limit records, newest first, of topic and/or sensor_id logged from
+        date_from up to and including date_to (datetimes), any of them None for no filter
+        """
+        with self.lock:
+            self.RecoverLocked()
+            self.LoadNames()
+            postings = []
+            for kind, name in ((u"topics", topic), (u"sensors", sensor_id)):
+                if name is not None:
+                    if name not in self.name_ids[kind]:
+                        return []
+                    self.LoadPostings()
+                    postings.append(self.postings.get((kind, self.name_ids[kind][name]), []))
+            postings.sort(key=len)
+            files = self.Open()
+            topics = list(self.names[u"topics"])
+            if files is None:
+                return []
+
+            def numbers(index, data):
+                count = len(index) // self.OFFSET.size
+                timestamp = lambda i: self.HEADER.unpack_from(data, self.OFFSET.unpack_from(index, i * self.OFFSET.size)[0])[0]
+                # records are appended in time order, find the range by bisection
+                first = 0 if date_from is None else self.Bisect(timestamp, count, date_from.timestamp(), False)
+                end = count if date_to is None else self.Bisect(timestamp, count, date_to.timestamp(), True)
+                if not postings:
+                    return range(end - 1, first - 1, -1)
+                # walk the shortest postings list and look the rest up
+                ranges = [p[bisect_left(p, first): bisect_left(p, end)] for p in postings]
+                others = [set(r) for r in ranges[1:]]
+                return (i for i in reversed(ranges[0]) if all(i in o for o in others))
+
+            records = self.Records(files, numbers, topics)
+            try:
+                return list(itertools.islice(records, limit or None))
+            finally:
+                records.close()
+
+    @staticmethod
+    def Bisect(timestamp, count, value, right):
+        """Return the first record number with a timestamp > value if right, >= value otherwise"""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if timestamp(mid) < value or (right and timestamp(mid) == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def Clear(self):
+        with self.lock:
+            for file_name in [self.file_name, self.index_file_name, self.keys_file_name, self.old_keys_file_name, self.compaction_file_name] + list(self.names_file_names.values()):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+            self.names = None
+            self.postings = None
+
+
+binary_sensor_log = BinarySensorLog(SENSOR_LOG_BINARY_FILE)
+
+
+def apply_sensor_log_settings(settings):
+    sensor_log_archive.Configure(
+        int(settings.get(SENSOR_LOG_RETENTION_DAYS, 90)),
+        int(settings.get(SENSOR_LOG_RETENTION_MB, 0)) * 1024 * 1024
+    )
+
+
+def write_settings(settings, water_tank_ids = None):
+    """
+    Save settings and water tanks. If water_tank_ids is given only these
+    water tanks have changed, which the storage backend may take advantage of.
+    """
+    get_storage(settings).Save(settings, water_tank_ids)
+    invalidate_payload_cache()
+
+
+# Serialized payloads of DATA_FILE based responses, see cached_payload
+_payload_cache = {}
+_payload_cache_lock = th.Lock()
+
+
+def invalidate_payload_cache():
+    with _payload_cache_lock:
+        _payload_cache.clear()
+
+
+def cached_payload(key, build, source = None):
+    """
+    Return the cached payload for key as a dictionary with "body", "etag" and "last_modified",
+    the time the body was first built.
+    build() is called to serialize the payload only if there is no cached one, or if
+    DATA_FILE or source (any other data the payload is built from) changed since.
+    """
+    try:
+        mtime = os.stat(DATA_FILE).st_mtime
+    except OSError:
+        mtime = None
+
+    with _payload_cache_lock:
+        entry = _payload_cache.get(key)
+    if entry is not None and entry["mtime"] == mtime and entry["source"] == source:
+        return entry
+
+    body = build()
+    etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+    entry = {
+        "mtime": mtime,
+        "source": source,
+        "body": body,
+        "etag": etag,
+        # when this body was first served, DATA_FILE does not change with every payload
+        "last_modified": entry["last_modified"] if entry is not None and entry["etag"] == etag else datetime.utcnow().replace(microsecond=0)
+    }
+    with _payload_cache_lock:
+        _payload_cache[key] = entry
+    return entry
+
+
+def json_response(key, build, source = None):
+    """
+    Return a cached json payload with ETag and Last-Modified headers.
+    Answers with 304 Not Modified if the browser already has it, judged by the ETag only:
+    Last-Modified has a resolution of a second and payloads may change within one.
+    """
+    entry = cached_payload(key, build, source)
+    web.header('Content-Type', 'application/json')
+    web.header('Cache-Control', 'no-cache')
+    web.lastmodified(entry["last_modified"])
+    web.modified(etag=entry["etag"])  # raises web.notmodified
+    return entry["body"]
+
+
+def compact_reactions(water_tank):
+    """
+    Remove from a water tank dictionary all program and station reactions
+    that do nothing i.e. run, enable, suspend and stop_on_exit are all false
+    and there is no run-time data stored in them
+    """
+    for key in ["overflow_programs", "warning_programs", "critical_programs"]:
+        programs = water_tank.get(key) or {}
+        water_tank[key] = {
+            id: p for id, p in programs.items()
+            if WaterTankProgram(id, p.get("run"), p.get("enable"), p.get("suspend"), p.get("start_datetime"), p.get("end_datetime"), p.get("original_enabled")).IsConfigured()
+        }
+    for key in ["overflow_stations", "warning_stations", "critical_stations"]:
+        stations = water_tank.get(key) or {}
+        water_tank[key] = {
+            id: st for id, st in stations.items()
+            if WaterTankStation(id, st.get("run"), st.get("minutes"), st.get("percentage"), st.get("stop_on_exit"), st.get("start_datetime"), st.get("end_datetime")).IsConfigured()
+        }
+
+
+def migrate_settings(settings):
+    """
+    Bring settings read from an older data file to DATA_FILE_VERSION.
+    Returns True if settings were changed and should be saved back to file.
+    """
+    version = settings.get(VERSION, 1)
+    if version >= DATA_FILE_VERSION:
+        return False
+
+    log.info(u"Water Tank plugin migrating data file from version %s to %s", version, DATA_FILE_VERSION)
+    if version < 2:
+        for water_tank in settings.get(u"water_tanks", {}).values():
+            compact_reactions(water_tank)
+
+    settings[VERSION] = DATA_FILE_VERSION
+    return True
+
+
+def get_settings():
+    global _settings
+    try:
+        fh = io.open(DATA_FILE, "r", encoding="utf-8")
+        try:
+            settings = json.load(fh)
+            settings[u"water_tanks"] = get_storage(settings).LoadWaterTanks(settings)
+            _settings = settings
+        except ValueError as e:
+            log.error(u"Water Tank pluging couldn't parse data file: %s", e)
+        finally:
+            fh.close()
+        if migrate_settings(_settings):
+            write_settings(_settings)
+    except IOError as e:
+        log.error(u"Water-Tank Plugin couldn't open data file: %s", e)
+    # print( 'get_settings() returns : {}'.format(json.dumps(_settings, default=json_default, indent=4)))
+    return _settings
+
+
+def apply_log_settings(settings):
+    """
+    Set the log level and the interval in which repeated log lines are dropped
+    """
+    level = settings.get(LOG_LEVEL, u"INFO")
+    log.setLevel(level if level in LOG_LEVELS else u"INFO")
+    log_rate_limit_filter.interval = int(settings.get(LOG_RATE_LIMIT_SECONDS, 10))
+
+
+def detect_water_tank_js():
+    """
+    Search base.html for the line that includes the water_tank.js script
+    """
+    path = os.getcwd()
+    log.debug('Current dir is %s', path)
+    file_path = path + '/templates/base.html'
+    try:
+        stat = os.stat(file_path)
+        signature = [stat.st_mtime, stat.st_size]
+        with io.open(BASE_HTML_MARKER_FILE, "r", encoding="utf-8") as f:
+            if json.load(f) == signature:
+                log.debug('%s was already checked', file_path)
+                return
+    except (IOError, ValueError):
+        pass
+
+    mqtt_line = '\t<script src="static/scripts/mqttws31.js"></script>\n'
+    validation_line = '\t<script src="static/scripts/jquery.validate.min.js"></script>\n'
+    additional_validation_line = '\t<script src="static/scripts/additional-methods.min.js"></script>\n'
+    script_line = '\t<script src="static/scripts/water_tank.js"></script>\n'
+    css_line = '\t<link href="static/css/water_tank.css" rel="stylesheet" type="text/css"/>\n'
+    header_end_word = '</head>'
+    header_end_word_index = 0
+    found = False
+    contents = []
+    with open(file_path, 'r') as file:
+        for(i, line) in enumerate(file):
+            contents.append(line)
             if script_line in line:
                 found = True
-                print('{} found in {}:{}'.format(script_line, file_path, i))
+                log.debug('%s found in %s:%s', script_line, file_path, i)
                 break
             if header_end_word in line:
-                print('{} found in {}:{}'.format(header_end_word, file_path, header_end_word_index))
+                log.debug('%s found in %s:%s', header_end_word, file_path, header_end_word_index)
                 header_end_word_index = i
 
     if not found:
         if header_end_word_index == 0:
-            print('{} was not found in {}. Water Tank plugin cannot work.')
+            log.error('%s was not found in %s. Water Tank plugin cannot work.', header_end_word, file_path)
         else:
-            print('{} not found in {}, will add it above {} to line {}'.format(script_line, file_path, header_end_word, header_end_word_index-1))
+            log.info('%s not found in %s, will add it above %s to line %s', script_line, file_path, header_end_word, header_end_word_index-1)
             contents.insert(header_end_word_index, script_line)
             contents.insert(header_end_word_index, additional_validation_line)
             contents.insert(header_end_word_index, validation_line)
@@ -1551,103 +3030,614 @@ def detect_water_tank_js():
             with open(file_path, 'w') as file:
                 contents = "".join(contents)
                 file.write(contents)
-            print('{} and {} were added to line {}. Please refresh the page in you browser.'.format(script_line, mqtt_line, header_end_word_index-1))
+            log.info('%s and %s were added to line %s. Please refresh the page in you browser.', script_line, mqtt_line, header_end_word_index-1)
+            write_base_html_marker(file_path)
         return
+    write_base_html_marker(file_path)
+
+
+def write_base_html_marker(file_path):
+    """Remember the stat of a checked base.html so that the next start can skip reading it"""
+    try:
+        stat = os.stat(file_path)
+        with io.open(BASE_HTML_MARKER_FILE, u"w", encoding="utf-8") as f:
+            f.write(json.dumps([stat.st_mtime, stat.st_size]))
+    except (IOError, OSError) as e:
+        log.warning('Could not write %s: %s', BASE_HTML_MARKER_FILE, e)
+
+
+def serialize_water_tanks():
+    settings = get_settings()
+    return to_json(readWaterTankData(settings), settings.get(HUMAN_READABLE_JSON, False))
+
+
+def serialize_settings():
+    settings = get_settings()
+    return to_json(settings, settings.get(HUMAN_READABLE_JSON, False))
+
+
+def serialize_mqtt_settings(mqtt_settings):
+    settings = get_settings()
+    return to_json(read_mqtt_settings(mqtt_settings, settings), settings.get(HUMAN_READABLE_JSON, False))
+
+
+def serialize_bootstrap(mqtt_settings):
+    """
+    Everything the homepage widget needs in one payload: the sorted water tanks
+    and the mqtt connection info. The widget needs no other settings.
+    """
+    settings = get_settings()
+    full_mqtt_settings = read_mqtt_settings(mqtt_settings, settings)
+    data = {
+        u"water_tanks": readWaterTankData(settings),
+        u"mqtt": {
+            u"broker_host": full_mqtt_settings[u"broker_host"],
+            MQTT_BROKER_WS_PORT: full_mqtt_settings[MQTT_BROKER_WS_PORT],
+            WATER_PLUGIN_DATA_PUBLISH_MQTT_TOPIC: full_mqtt_settings[WATER_PLUGIN_DATA_PUBLISH_MQTT_TOPIC]
+        }
+    }
+    return to_json(data, settings.get(HUMAN_READABLE_JSON, False))
+
+
+def water_tanks_payload():
+    """
+    Return the serialized sorted water tank data, as returned by readWaterTankData
+    """
+    return cached_payload(u"water_tanks", serialize_water_tanks)["body"]
 
 
-def readWaterTankData():
+def readWaterTankData(settings = None):
     water_tank_data = {}
     try:
-        settings = get_settings()
+        if settings is None:
+            settings = get_settings()
         water_tank_data = []
         if( len(settings[u"water_tanks"]) > 0):
             water_tank_data = sorted(list(settings[u"water_tanks"].values()), key= lambda wt : wt["order"])
-            # print("readWaterTankData returns sorted list: {}".format(json.dumps(water_tank_data, default=serialize_datetime, indent=4 )))
+            # print("readWaterTankData returns sorted list: {}".format(json.dumps(water_tank_data, default=json_default, indent=4 )))
     except IOError:  # If file does not exist return empty value
         water_tank_data = []
         
     return water_tank_data
 
 
-def no_stations_are_on():
-    print("gv.srvals: {}, open valve exists: {}".format(''.join(str(gv.srvals)), (1 in gv.srvals)))
-    return 1 not in gv.srvals
+def read_mqtt_settings(mqtt_settings, water_tank_settings = None):
+    """
+    Add the water tank mqtt settings to those of the mqtt plugin
+    """
+    if water_tank_settings is None:
+        water_tank_settings = get_settings()
+    settings = dict(mqtt_settings)
+    settings[MQTT_BROKER_WS_PORT] = int(water_tank_settings[MQTT_BROKER_WS_PORT])
+    settings[WATER_PLUGIN_REQUEST_MQTT_TOPIC] = water_tank_settings[WATER_PLUGIN_REQUEST_MQTT_TOPIC]
+    settings[WATER_PLUGIN_DATA_PUBLISH_MQTT_TOPIC] = water_tank_settings[WATER_PLUGIN_DATA_PUBLISH_MQTT_TOPIC]
+    # Get the ip in case of localhost or 127.0.0.1
+    # from https://stackoverflow.com/a/28950776
+    if settings['broker_host'].lower() in ['localhost', '127.0.0.1']:
+        import socket
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(0)
+        try:
+            # doesn't even have to be reachable
+            s.connect(('10.254.254.254', 1))
+            IP = s.getsockname()[0]
+        except Exception:
+            IP = '127.0.0.1'
+        finally:
+            s.close()
+        settings['broker_host'] = IP
+
+    return settings
+
+
+def no_stations_are_on():
+    log.debug("gv.srvals: %s, open valve exists: %s", gv.srvals, 1 in gv.srvals)
+    return 1 not in gv.srvals
+
+
+class NotificationConfigError(Exception):
+    """
+    A notification cannot be delivered because its channel is not configured, retrying will not help
+    """
+    pass
+
+
+def email_send_msg(text, tank_event):
+    """
+    Queue an email in the outbox, it is delivered by the outbox sender
+    """
+    notification_outbox.Add(OUTBOX_EMAIL, text, tank_event)
+
+
+def email_deliver(text, tank_event):
+    """Send email, raises an exception if it could not be sent"""
+    import smtplib  # imported on first use
+    from email.mime.text import MIMEText
+    settings = get_settings()
+    log.info("Sending email [%s] for tank event: %s, with subject: '%s'", text, tank_event, settings[EMAIL_SUBJECT])
+
+    if not (settings[EMAIL_USERNAME] != "" and settings[EMAIL_PASSWORD] != "" and settings[EMAIL_SERVER] != "" and settings[EMAIL_SERVER_PORT] != "" and settings[EMAIL_RECIPIENTS] != ""):
+        raise NotificationConfigError(u"E-mail plug-in is not properly configured!")
+
+    mail_user = settings[EMAIL_USERNAME]  # SMTP username
+    mail_from = mail_user
+    mail_pwd = settings[EMAIL_PASSWORD]  # SMTP password
+    mail_server = settings[EMAIL_SERVER]  # SMTP server address
+    mail_port = settings[EMAIL_SERVER_PORT]  # SMTP port
+    # --------------
+    msg = MIMEText(text)
+    msg[u"From"] = mail_from
+    msg[u"To"] = settings[EMAIL_RECIPIENTS]
+    # print("Sending email to: {}".format(msg[u"To"]))
+    msg[u"Subject"] = settings[EMAIL_SUBJECT] + " " + tank_event
+
+    with smtplib.SMTP_SSL(mail_server, mail_port, timeout=OUTBOX_SEND_TIMEOUT) as smtp_server:
+        smtp_server.login(mail_user, mail_pwd)
+        smtp_server.sendmail(mail_user, [x.strip() for x in settings[EMAIL_RECIPIENTS].split(',')], msg.as_string())
+    log.info("Message sent!")
+
+
+def get_xmpp_receipients():
+    """
+    Returns a list of recipients for xmpp messages
+    """
+    settings = get_settings()
+    if "," not in settings[XMPP_RECIPIENTS]:
+        return [settings[XMPP_RECIPIENTS]]
+
+    return [s.strip() for s in settings[XMPP_RECIPIENTS].split(", ")]
+
+
+def xmpp_send_msg(message):
+    """
+    Queue an xmpp message in the outbox, it is delivered by the outbox sender
+    """
+    notification_outbox.Add(OUTBOX_XMPP, message)
+
+
+def xmpp_deliver(message):
+    """Send an xmpp message, raises an exception if it could not be sent"""
+    import xmpp     # imported on first use
+    # print("Will try to send message '{}'".format(message))
+    settings = get_settings()
+
+    if( (not(settings[XMPP_USERNAME] and not settings[XMPP_USERNAME].isspace())) or
+    (not(settings[XMPP_PASSWORD] and not settings[XMPP_PASSWORD].isspace())) or
+    (not(settings[XMPP_SERVER] and not settings[XMPP_SERVER].isspace()))
+    ):
+        raise NotificationConfigError("XMPP_USERNAME:'{}', or XMPP_SERVER:'{}' or the password are empty, cannot send xmpp message."
+                                      .format(settings[XMPP_USERNAME], settings[XMPP_SERVER]))
+
+    jid = xmpp.protocol.JID( settings[XMPP_USERNAME] )
+    cl = xmpp.Client( settings[XMPP_SERVER], debug=[] )
+    con = cl.connect()
+    if not con:
+        raise Exception('could not connect!')
+    # print('connected with {} to {} with user {}'.format(con, settings[XMPP_SERVER], settings[XMPP_USERNAME]))
+    auth = cl.auth( jid.getNode(), settings[XMPP_PASSWORD], resource = jid.getResource() )
+    if not auth:
+        raise Exception('could not authenticate!')
+    # print('authenticated using {}'.format(auth) )
+
+    #cl.SendInitPresence(requestRoster=0)   # you may need to uncomment this for old server
+    for r in get_xmpp_receipients():
+        id = cl.send(xmpp.protocol.Message( r, message ) )
+        # print('sent message with id {} to {}'.format(id, r) )
+
+
+OUTBOX_FILE = u"./data/water_tank.outbox.db"
+OUTBOX_EMAIL = u"email"
+OUTBOX_XMPP = u"xmpp"
+OUTBOX_SEND_TIMEOUT = 30         # seconds to wait for a mail server
+OUTBOX_RETRY_SECONDS = 30        # first retry, doubles with every attempt
+OUTBOX_MAX_RETRY_SECONDS = 3600
+OUTBOX_MAX_ATTEMPTS = 30         # about a day with the retry limits above
+
+
+class NotificationOutbox():
+    """
+    Notifications are recorded in OUTBOX_FILE before they are sent, so that none is lost
+    while a mail or xmpp server is down or the plugin restarts. OutboxSender delivers them.
+    """
+    def __init__(self, file_name):
+        import sqlite3  # imported on first use
+        self.lock = th.Lock()
+        self.wakeup = th.Event()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, text TEXT NOT NULL, event TEXT, "
+                "created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt)")
+
+    def Add(self, channel, text, event = None):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO outbox (channel, text, event, created, next_attempt) VALUES (?, ?, ?, ?, ?)",
+                (channel, text, event, now, now)
+            )
+        self.wakeup.set()
+
+    def Due(self, now):
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(
+                "SELECT * FROM outbox WHERE next_attempt <= ? ORDER BY id", (now,))]
+
+    def NextAttempt(self):
+        with self.lock:
+            row = self.connection.execute("SELECT MIN(next_attempt) FROM outbox").fetchone()
+            return row[0]
+
+    def Delivered(self, id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM outbox WHERE id = ?", (id,))
+
+    def Retry(self, id, attempts, next_attempt):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?", (attempts, next_attempt, id))
+
+
+class CircuitBreaker():
+    """
+    Stops delivery attempts on a channel that keeps failing. After failure_threshold
+    consecutive failures the circuit opens for open_seconds, then a single attempt
+    is let through: success closes it, failure opens it again for twice as long.
+    """
+    def __init__(self, failure_threshold = 3, open_seconds = 60, max_open_seconds = 3600):
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.open_until = None
+
+    def Allow(self, now):
+        return self.open_until is None or now >= self.open_until
+
+    def Success(self):
+        self.failures = 0
+        self.open_until = None
+        self.open_seconds = self.base_open_seconds
+
+    def Failure(self, now):
+        self.failures += 1
+        if self.open_until is not None:
+            # the trial attempt failed
+            self.open_seconds = min(self.open_seconds * 2, self.max_open_seconds)
+            self.open_until = now + self.open_seconds
+        elif self.failures >= self.failure_threshold:
+            self.open_until = now + self.open_seconds
+        if self.open_until is not None:
+            log.warning("Notification channel is down, next attempt in %s seconds", self.open_seconds)
+
+
+class OutboxSender(th.Thread):
+    """
+    Delivers the notifications of the outbox, retrying failed ones with exponential backoff
+    """
+    def __init__(self, outbox, deliverers):
+        super().__init__(name=u"water_tank_outbox", daemon=True)
+        self.outbox = outbox
+        self.deliverers = deliverers    # channel -> function(text, event)
+        self.breakers = {channel: CircuitBreaker() for channel in deliverers}
+
+    def run(self):
+        while True:
+            try:
+                self.SendDue()
+                next_attempt = self.outbox.NextAttempt()
+            except Exception as e:
+                log.exception("Exception in the notification outbox sender. %s", e)
+                next_attempt = None
+            timeout = OUTBOX_RETRY_SECONDS if next_attempt is None else max(0, next_attempt - time.time())
+            self.outbox.wakeup.wait(min(timeout, OUTBOX_RETRY_SECONDS))
+            self.outbox.wakeup.clear()
+
+    def SendDue(self):
+        now = time.time()
+        for notification in self.outbox.Due(now):
+            channel = notification["channel"]
+            breaker = self.breakers.get(channel)
+            if breaker is None:
+                log.error("Dropping notification for unknown channel '%s'", channel)
+                self.outbox.Delivered(notification["id"])
+                continue
+            if not breaker.Allow(time.time()):
+                # wait for the breaker instead of finding the notification due again right away
+                self.outbox.Retry(notification["id"], notification["attempts"], breaker.open_until)
+                continue
+            try:
+                if channel == OUTBOX_EMAIL:
+                    self.deliverers[channel](notification["text"], notification["event"])
+                else:
+                    self.deliverers[channel](notification["text"])
+                breaker.Success()
+                self.outbox.Delivered(notification["id"])
+            except NotificationConfigError as e:
+                log.error("Dropping %s notification. %s", channel, e)
+                self.outbox.Delivered(notification["id"])
+            except Exception as e:
+                breaker.Failure(time.time())
+                attempts = notification["attempts"] + 1
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    log.error("Giving up %s notification after %s attempts: %s", channel, attempts, notification["text"])
+                    self.outbox.Delivered(notification["id"])
+                    continue
+                retry = min(OUTBOX_RETRY_SECONDS * (2 ** (attempts - 1)), OUTBOX_MAX_RETRY_SECONDS)
+                log.warning("Could not send %s notification, retrying in %s seconds. %s", channel, retry, e)
+                self.outbox.Retry(notification["id"], attempts, time.time() + retry)
+
+
+notification_outbox = None  # created by start_plugin
+outbox_sender = None
+
+
+class NotificationGovernor():
+    """
+    Bounds the xmpp and e-mail notifications sent per (water tank or sensor, event).
+    After a notification the same key is silent for a cooldown that doubles with every
+    notification sent while the event keeps occurring, up to max_cooldown; it resets once
+    the event has not occurred for max_cooldown. The next notification let through reports
+    how many were suppressed, and if none follows the last suppressed one is due as a summary
+    once the cooldown is over. On top of that at most max_per_hour notifications are sent in
+    total, except for urgent ones, of water loss, which only have the cooldown.
+    Water tank state events do not go through the governor, see send_state_notification.
+    """
+    def __init__(self, cooldown = 300, max_cooldown = 21600, max_per_hour = 60):
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_per_hour = max_per_hour
+        self.keys = {}      # key -> {"next": monotonic time, "cooldown": seconds, "suppressed": count, "last": monotonic time, "pending": last suppressed, "urgent": bool}
+        self.sent = deque() # monotonic times of the not urgent notifications sent in the last hour
+        self.lock = th.Lock()
+
+    def Configure(self, cooldown, max_cooldown, max_per_hour):
+        with self.lock:
+            self.cooldown = cooldown
+            self.max_cooldown = max(cooldown, max_cooldown)
+            self.max_per_hour = max_per_hour
+
+    def _OverBudget(self, now, urgent):
+        while self.sent and now - self.sent[0] >= 3600:
+            self.sent.popleft()
+        return not urgent and self.max_per_hour and len(self.sent) >= self.max_per_hour
+
+    def _Send(self, state, now, urgent, cooldown):
+        suppressed = state["suppressed"]
+        state.update({"next": now + cooldown, "cooldown": cooldown, "suppressed": 0, "pending": None})
+        if not urgent:
+            self.sent.append(now)
+        return suppressed
+
+    def Allow(self, key, urgent = False, pending = None):
+        """
+        Return (True, number of suppressed notifications since the last one) if a notification
+        for key may be sent now, (False, 0) otherwise, keeping pending to be sent by Due later
+        """
+        now = time.monotonic()
+        with self.lock:
+            state = self.keys.setdefault(key, {"next": 0, "cooldown": 0, "suppressed": 0, "last": now, "pending": None, "urgent": urgent})
+            quiet = now - state["last"] >= self.max_cooldown
+            state["last"] = now
+            if now < state["next"] or self._OverBudget(now, urgent):
+                state.update({"suppressed": state["suppressed"] + 1, "pending": pending, "urgent": urgent})
+                return (False, 0)
+
+            if quiet or state["cooldown"] == 0:
+                cooldown = self.cooldown
+            else:
+                cooldown = min(state["cooldown"] * 2, self.max_cooldown)
+            suppressed = self._Send(state, now, urgent, cooldown)
+            if len(self.keys) > 1000:
+                self.keys = {k: v for k, v in self.keys.items() if v["suppressed"] or now - v["last"] < self.max_cooldown}
+            return (True, suppressed)
+
+    def Due(self):
+        """
+        Return [(key, number suppressed, pending)] of the keys whose last notification was
+        suppressed and not followed by another one, whose cooldown is over and that fit the budget
+        """
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            for key, state in self.keys.items():
+                if state["pending"] is None or now < state["next"] or self._OverBudget(now, state["urgent"]):
+                    continue
+                pending = state["pending"]
+                cooldown = min(max(state["cooldown"], self.cooldown) * 2, self.max_cooldown)
+                due.append((key, self._Send(state, now, state["urgent"], cooldown), pending))
+        return due
+
+
+notification_governor = NotificationGovernor()
+
+
+def apply_notification_settings(settings):
+    notification_governor.Configure(
+        int(settings.get(NOTIFICATION_COOLDOWN_SECONDS, 300)),
+        int(settings.get(NOTIFICATION_MAX_COOLDOWN_SECONDS, 21600)),
+        int(settings.get(NOTIFICATION_MAX_PER_HOUR, 60))
+    )
+
+
+class FillTrend():
+    """
+    Fits per water tank a least squares line to the filled fraction over the readings of the
+    last window seconds. The running sums of the fit are updated as readings enter and leave
+    the window, so each reading costs O(1). A rate is significant when it is t_statistic
+    standard errors away from zero and the readings span at least half the window.
+    """
+    MIN_SAMPLES = 6
+
+    def __init__(self, window = 600, t_statistic = 3.0):
+        self.window = window
+        self.t_statistic = t_statistic
+        self.windows = {}   # water tank id -> {"origin", "samples": deque of (t, fraction), "sums": [t, y, tt, ty, yy]}
+
+    def Configure(self, window):
+        if window != self.window:
+            self.windows = {}
+        self.window = window
+
+    def Reset(self, water_tank_id = None):
+        if water_tank_id is None:
+            self.windows = {}
+        else:
+            self.windows.pop(water_tank_id, None)
+
+    @staticmethod
+    def _Accumulate(sums, t, y, sign):
+        sums[0] += sign * t
+        sums[1] += sign * y
+        sums[2] += sign * t * t
+        sums[3] += sign * t * y
+        sums[4] += sign * y * y
+
+    def Add(self, water_tank_id, fraction, now = None):
+        """
+        Add a reading of the filled fraction of water_tank_id taken at monotonic time now
+        """
+        now = time.monotonic() if now is None else now
+        w = self.windows.get(water_tank_id)
+        if w is None:
+            w = self.windows[water_tank_id] = {"origin": now, "samples": deque(), "sums": [0.0] * 5}
+        samples = w["samples"]
+        sums = w["sums"]
+        while samples and now - samples[0][0] > self.window:
+            t, y = samples.popleft()
+            self._Accumulate(sums, t - w["origin"], y, -1)
+
+        # times are kept relative to an origin that is moved up once per window, which keeps the
+        # sums small and drops the rounding errors the subtractions have accumulated
+        if now - w["origin"] > 2 * self.window:
+            w["origin"] = samples[0][0] if samples else now
+            w["sums"] = sums = [0.0] * 5
+            for t, y in samples:
+                self._Accumulate(sums, t - w["origin"], y, 1)
+        samples.append((now, fraction))
+        self._Accumulate(sums, now - w["origin"], fraction, 1)
+
+    def Rate(self, water_tank_id):
+        """
+        Return (slope, standard error) of the filled fraction per second over the window,
+        None if there are too few readings to fit
+        """
+        w = self.windows.get(water_tank_id)
+        if w is None or len(w["samples"]) < self.MIN_SAMPLES:
+            return None
+        n = len(w["samples"])
+        st, sy, stt, sty, syy = w["sums"]
+        ctt = stt - st * st / n
+        cty = sty - st * sy / n
+        cyy = syy - sy * sy / n
+        if ctt <= 0:
+            return None
+        slope = cty / ctt
+        sse = max(cyy - slope * cty, 0.0)
+        return (slope, sqrt(sse / (n - 2) / ctt))
+
+    def SignificantRate(self, water_tank_id):
+        """
+        Return the slope of the filled fraction per second if it is significant, None otherwise
+        """
+        w = self.windows.get(water_tank_id)
+        rate = self.Rate(water_tank_id)
+        if rate is None or w["samples"][-1][0] - w["samples"][0][0] < self.window / 2:
+            return None
+        slope, stderr = rate
+        if abs(slope) < self.t_statistic * stderr or slope == 0:
+            return None
+        return slope
+
+
+class LeakDetector(FillTrend):
+    """
+    Estimates per water tank the net drain rate while no valves are open. A leak is reported
+    only when the rate is a significant drop of at least min_litres_per_hour.
+    Opening a valve restarts the window of every water tank.
+    """
+    def __init__(self, window = 3600, min_litres_per_hour = 0.0, t_statistic = 3.0):
+        super().__init__(window, t_statistic)
+        self.min_litres_per_hour = min_litres_per_hour
+
+    def Configure(self, window, min_litres_per_hour):
+        super().Configure(window)
+        self.min_litres_per_hour = min_litres_per_hour
+
+    def Leak(self, water_tank_id, capacity_litres):
+        """
+        Return (percent per hour, litres per hour) of a significant leak, None if there is none.
+        Litres per hour is None, and min_litres_per_hour is not applied, when the capacity is unknown
+        """
+        slope = self.SignificantRate(water_tank_id)
+        if slope is None or slope > 0:
+            return None
+        litres_per_hour = None if capacity_litres is None else round(-slope * 3600 * capacity_litres, 1)
+        if litres_per_hour is not None and litres_per_hour < self.min_litres_per_hour:
+            return None
+        return (round(-slope * 360000, 2), litres_per_hour)
+
+
+leak_detector = LeakDetector()
+fill_trend = FillTrend()    # the fill/drain rate of every water tank, valves open or not, for predictive reactions
 
 
-def email_send_msg(text, tank_event):
-    """Send email"""
-    settings = get_settings()
-    print("Sending email [{}] for tank event: {}, with subject: '{}'".format(text, tank_event,settings[EMAIL_SUBJECT]))
-    
-    try:  #put the code in a try catch or else the entire plugin will crash if for example the email password is wrong
-        if settings[EMAIL_USERNAME] != "" and settings[EMAIL_PASSWORD] != "" and settings[EMAIL_SERVER] != "" and settings[EMAIL_SERVER_PORT] != "" and settings[EMAIL_RECIPIENTS] != "":
-            mail_user = settings[EMAIL_USERNAME]  # SMTP username
-            mail_from = mail_user
-            mail_pwd = settings[EMAIL_PASSWORD]  # SMTP password
-            mail_server = settings[EMAIL_SERVER]  # SMTP server address
-            mail_port = settings[EMAIL_SERVER_PORT]  # SMTP port
-            # --------------
-            msg = MIMEText(text)
-            msg[u"From"] = mail_from
-            msg[u"To"] = settings[EMAIL_RECIPIENTS]
-            # print("Sending email to: {}".format(msg[u"To"]))
-            msg[u"Subject"] = settings[EMAIL_SUBJECT] + " " + tank_event
-            
-            with smtplib.SMTP_SSL(mail_server, mail_port) as smtp_server:
-                smtp_server.login(mail_user, mail_pwd)
-                smtp_server.sendmail(mail_user, [x.strip() for x in settings[EMAIL_RECIPIENTS].split(',')], msg.as_string())
-            print("Message sent!")
-        else:
-            raise Exception(u"E-mail plug-in is not properly configured!")
-    except Exception as e:
-        print("Could not send email.", e)
-        traceback.print_exc()
+def apply_fill_trend_settings(settings):
+    leak_detector.Configure(
+        int(settings.get(LEAK_WINDOW_MINUTES, 60)) * 60,
+        float(settings.get(LEAK_MIN_LITRES_PER_HOUR, 0))
+    )
+    fill_trend.Configure(int(settings.get(PREDICTION_WINDOW_MINUTES, 10)) * 60)
 
 
-def get_xmpp_receipients():
-    """
-    Returns a list of recipients for xmpp messages
-    """
-    settings = get_settings()
-    if "," not in settings[XMPP_RECIPIENTS]:
-        return [settings[XMPP_RECIPIENTS]]
+def deliver_notification(event, msg, xmpp, email):
+    if xmpp:
+        xmpp_send_msg( msg )
+    if email:
+        email_send_msg( msg, event )
 
-    return [s.strip() for s in settings[XMPP_RECIPIENTS].split(", ")]
 
+def send_state_notification(event, msg, xmpp, email):
+    """
+    Send msg of a water tank entering the state of event. These are never throttled, a
+    water tank enters a state once until it has left it past the safe level.
+    """
+    deliver_notification(event, msg, xmpp, email)
 
-def xmpp_send_msg(message):
-    # print("Will try to send message '{}'".format(message))
-    try:    #put the code inside a try except because if a setting is wrong and an exception occurs the entire plugin may crash
-        settings = get_settings()
 
-        if( (not(settings[XMPP_USERNAME] and not settings[XMPP_USERNAME].isspace())) or
-        (not(settings[XMPP_PASSWORD] and not settings[XMPP_PASSWORD].isspace())) or
-        (not(settings[XMPP_SERVER] and not settings[XMPP_SERVER].isspace()))
-        ):
-            print("XMPP_USERNAME:'{}', or XMPP_PASSWORD:'{}', or XMPP_SERVER:'{}' are empty, cannot send xmpp message."
-                    .format(settings[XMPP_USERNAME], settings[XMPP_PASSWORD], settings[XMPP_SERVER]))
-            return
+def send_notification(subject_id, event, msg, xmpp, email, urgent = False):
+    """
+    Send msg by xmpp and/or e-mail, unless the governor suppresses the event for subject_id
+    (a water tank id, sensor id or mqtt topic). Urgent notifications, of water loss, are
+    not held back by the hourly limit of the others.
+    """
+    if not (xmpp or email):
+        return
+    allowed, suppressed = notification_governor.Allow((subject_id, event), urgent, (msg, xmpp, email))
+    if not allowed:
+        log.debug("Suppressed '%s' notification for '%s'", event, subject_id)
+        return
+    if suppressed:
+        msg = u"{} (still occurring, {} similar notifications suppressed)".format(msg, suppressed)
+    deliver_notification(event, msg, xmpp, email)
 
-        jid = xmpp.protocol.JID( settings[XMPP_USERNAME] )
-        cl = xmpp.Client( settings[XMPP_SERVER], debug=[] )
-        con = cl.connect()
-        if not con:
-            print('could not connect!')
-            return False
-        # print('connected with {} to {} with user {}'.format(con, settings[XMPP_SERVER], settings[XMPP_USERNAME]))
-        auth = cl.auth( jid.getNode(), settings[XMPP_PASSWORD], resource = jid.getResource() )
-        if not auth:
-            print('could not authenticate!')
-            return False
-        # print('authenticated using {}'.format(auth) )
 
-        #cl.SendInitPresence(requestRoster=0)   # you may need to uncomment this for old server
-        for r in get_xmpp_receipients():
-            id = cl.send(xmpp.protocol.Message( r, message ) )
-            # print('sent message with id {} to {}'.format(id, r) )
+def send_suppressed_notifications():
+    """
+    Send the last suppressed notification of every event that has not occurred again since,
+    so that it is not lost. Called periodically.
+    """
+    try:
+        for (subject_id, event), suppressed, (msg, xmpp, email) in notification_governor.Due():
+            log.info("Sending suppressed '%s' notification for '%s'", event, subject_id)
+            deliver_notification(event, u"{} ({} similar notifications suppressed, this was the last one)".format(msg, suppressed), xmpp, email)
     except Exception as e:
-        print("Could not send xmpp message.", e)
-        traceback.print_exc()
+        log.exception("Could not send suppressed notifications. %s", e)
 
 
 def send_unrecognised_msg(mqtt_topic, date, message):
@@ -1658,13 +3648,9 @@ def send_unrecognised_msg(mqtt_topic, date, message):
             date = date,
             message = message
         )
-        if( settings[UNRECOGNISED_MSG_EMAIL] ):
-            email_send_msg( msg, "Unrecognised MQTT message!" )
-        if( settings[UNRECOGNISED_MSG_XMPP] ):
-            xmpp_send_msg( msg )
+        send_notification(mqtt_topic, "Unrecognised MQTT message!", msg, settings[UNRECOGNISED_MSG_XMPP], settings[UNRECOGNISED_MSG_EMAIL])
     except Exception as e:
-        print("Could not send xmpp unrecognised message.", e)
-        traceback.print_exc()
+        log.exception("Could not send xmpp unrecognised message. %s", e)
 
 
 def send_unassociated_sensor_msg(sensor_id, measurement, last_updated, mqtt_topic):
@@ -1676,13 +3662,9 @@ def send_unassociated_sensor_msg(sensor_id, measurement, last_updated, mqtt_topi
             last_updated = last_updated,
             mqtt_topic = mqtt_topic
         )
-        if( settings[UNASSOCIATED_SENSOR_XMPP] ):
-            xmpp_send_msg( msg )
-        if( settings[UNASSOCIATED_SENSOR_EMAIL] ):
-            email_send_msg( msg, "Unassociated sensor" )
+        send_notification(sensor_id, "Unassociated sensor", msg, settings[UNASSOCIATED_SENSOR_XMPP], settings[UNASSOCIATED_SENSOR_EMAIL])
     except Exception as e:
-        print("Could not send xmpp unassociated message.", e)
-        traceback.print_exc()
+        log.exception("Could not send xmpp unassociated message. %s", e)
 
 
 def send_invalid_measurement_msg(water_tank, additional_info):
@@ -1693,23 +3675,26 @@ def send_invalid_measurement_msg(water_tank, additional_info):
             water_tank_label = water_tank.label,
             sensor_id = water_tank.sensor_id,
             percentage = water_tank.percentage,
+            volume = water_tank.volume_litres,
+            capacity = water_tank.capacity_litres,
             measurement = water_tank.sensor_measurement,
             last_updated = water_tank.last_updated,
             mqtt_topic = water_tank.sensor_mqtt_topic,
             additional_info = additional_info
         )
-        print("Invalid measurement email:{}, xmpp:{}".format(water_tank.invalid_sensor_measurement_email, water_tank.invalid_sensor_measurement_xmpp))
-        if( water_tank.invalid_sensor_measurement_xmpp ):
-            xmpp_send_msg( msg )
-        if( water_tank.invalid_sensor_measurement_email ):
-            email_send_msg( msg, "Invalid measurement" )
+        log.debug("Invalid measurement email:%s, xmpp:%s", water_tank.invalid_sensor_measurement_email, water_tank.invalid_sensor_measurement_xmpp)
+        send_notification(water_tank.id, "Invalid measurement", msg, water_tank.invalid_sensor_measurement_xmpp, water_tank.invalid_sensor_measurement_email)
     except Exception as e:
-        print("Could not send xmpp invalid measurement message.", e)
-        traceback.print_exc()
+        log.exception("Could not send xmpp invalid measurement message. %s", e)
 
 
-def updateSensorMeasurementFromCmd(cmd, water_tanks, msg):
-    associated_wts = [ wt for wt in list(water_tanks.values()) if wt["sensor_id"] == cmd["sensor_id"]]
+def updateSensorMeasurementFromCmd(cmd, water_tanks, msg, sensors):
+    """
+    Update the water tanks associated with the sensor of cmd.
+    sensors are the water tank ids per sensor id of the topic the message came from.
+    Returns the ids of the updated water tanks.
+    """
+    associated_wts = [ water_tanks[id] for id in sensors.get(cmd["sensor_id"], []) if id in water_tanks ]
     if len(associated_wts) == 0:
         send_unassociated_sensor_msg(
             cmd[u"sensor_id"],
@@ -1717,124 +3702,433 @@ def updateSensorMeasurementFromCmd(cmd, water_tanks, msg):
             datetime.now().replace(microsecond=0),
             msg.topic
         )
-        return False
+        return []
     
-    water_tank_updated = False
+    updated_ids = []
     for awt in associated_wts:
         # print("Doing {}".format(awt["id"]))
         wt = WaterTankFactory.FromDict(awt)
-        # print("Wt from {}".format(json.dumps(wt, default=serialize_datetime, indent=4)))
+        # print("Wt from {}".format(json.dumps(wt, default=json_default, indent=4)))
         # print("Before UpdateSensorMeasurement. awt['enabled']:{}, wt.enabled:{}".format(awt['enabled'], wt.enabled))
-        msgSender = MessageSender(msg, wt)
-        msgSender.MarkPercentage()
+        MessageSender(msg, wt)
         sensor_warning = ""
         if( "warning" in cmd and cmd[u"warning"] ):
             sensor_warning = cmd[u"warning"]
         wt.UpdateSensorWarning(cmd[u"sensor_id"], sensor_warning)
         wt.UpdateSensorMeasurement(cmd[u"sensor_id"], cmd[u"measurement"])
-        print("updateSensorMeasurementFromCmd. A water tank was updated")
-        water_tanks[wt.id] = wt.__dict__
+        log.debug("updateSensorMeasurementFromCmd. A water tank was updated")
+        water_tanks[wt.id] = wt.ToDict()
         # print("After UpdateSensorMeasurement. water_tanks[wt.id]['enabled']:{}, wt.enabled:{}".format(water_tanks[wt.id]['enabled'], wt.enabled))        
-        # print("After wt.UpdateSensorMeasurement {}".format(json.dumps(wt, default=serialize_datetime, indent=4)))
+        # print("After wt.UpdateSensorMeasurement {}".format(json.dumps(wt, default=json_default, indent=4)))
         # check_events_and_send_msg(cmd, percentageBefore, wt, msg)
-        water_tank_updated = True
+        updated_ids.append(wt.id)
         # print("Update water tank '{}' with measurment: {}".format(wt.id, wt.sensor_measurement))
 
-    return water_tank_updated
+    return updated_ids
+
+
+def read_sensor_log(start = 0):
+    """
+    Iterate over the sensor log, newest record first, skipping the newest start records.
+    With the archive enabled this is the archive, else with the binary log enabled the
+    binary log, otherwise the log kept in the storage.
+    """
+    settings = get_settings()
+    if settings.get(SENSOR_LOG_ARCHIVE, False):
+        return itertools.islice(sensor_log_archive.Read(), start, None)
+    if settings.get(SENSOR_LOG_BINARY, False):
+        return binary_sensor_log.Read(start)
+    return iter(get_storage(settings).ReadSensorLog()[start:])
 
 
-def read_sensor_log():
+def payload_commands(payload):
     """
-    Read data from sensor log file.
+    Return the decoded commands of a logged sensor payload, which is bytes, their str()
+    as stored in the storage log, or text: its json object, or the json objects of a list
+    payload for several water tanks; [] if there are none
     """
-    result = []
     try:
-        with io.open(LOG_FILE) as logf:
-            records = logf.readlines()
-            for i in records:
-                try:
-                    rec = ast.literal_eval(json.loads(i))
-                except ValueError:
-                    rec = json.loads(i)
-                result.append(rec)
-        return result
-    except IOError:
-        return result
+        if isinstance(payload, str) and payload.startswith((u"b'", u'b"')):
+            payload = ast.literal_eval(payload)
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8")
+        cmd = json.loads(payload)
+    except (ValueError, SyntaxError):
+        return []
+    if isinstance(cmd, dict):
+        return [cmd]
+    if isinstance(cmd, list):
+        return [c for c in cmd if isinstance(c, dict)]
+    return []
+
+
+def payload_sensor_ids(payload):
+    """
+    Return the distinct sensor_ids of a logged sensor payload, in order
+    """
+    sensor_ids = []
+    for cmd in payload_commands(payload):
+        sensor_id = cmd.get(u"sensor_id")
+        if sensor_id is not None and str(sensor_id) not in sensor_ids:
+            sensor_ids.append(str(sensor_id))
+    return sensor_ids
 
 
-def log_sensor_msg(msg):
+def query_sensor_log(topic = None, sensor_id = None, date_from = None, date_to = None, limit = 1000):
+    """
+    Return up to limit sensor log records, newest first, of topic and/or sensor_id logged
+    from date_from up to and including date_to (datetimes), any of them None for no filter.
+    The binary log and the sqlite storage answer from their indexes, the sqlite storage
+    reads only the records returned.
+    """
     settings = get_settings()
+    if settings.get(SENSOR_LOG_BINARY, False) and not settings.get(SENSOR_LOG_ARCHIVE, False):
+        return binary_sensor_log.Query(topic, sensor_id, date_from, date_to, limit)
+
+    date_string = lambda d: None if d is None else d.isoformat(sep=' ', timespec='seconds')
+    if not settings.get(SENSOR_LOG_ARCHIVE, False):
+        return list(get_storage(settings).QuerySensorLog(topic, date_string(date_from), date_string(date_to), sensor_id, limit or None))
 
-    logline = (
-        '{' +
-        '"date":"' + datetime.now().isoformat(sep=' ', timespec='seconds') + '",' +
-        '"mqtt_topic":"' + str(msg.topic) + '",' +
-        '"mqtt_payload":' + json.dumps(str(msg.payload)) +
-        '}'
+    records = (
+        r for r in sensor_log_archive.Read(date_string(date_from), date_string(date_to))
+        if (topic is None or r["mqtt_topic"] == topic) and
+            (sensor_id is None or sensor_id in payload_sensor_ids(r["mqtt_payload"]))
     )
-    lines = []
-    lines.append(logline + "\n")
-    log = read_sensor_log()
-    for r in log:
-        lines.append(json.dumps(r) + "\n")
-    with codecs.open(LOG_FILE, "w", encoding="utf-8") as f:
-        if settings[MAX_SENSOR_LOG_RECORDS]:
-            f.writelines(lines[: settings[MAX_SENSOR_LOG_RECORDS]])
+    return list(itertools.islice(records, limit or None))
+
+
+class WaterTankSimulator():
+    """
+    Runs a trajectory of fill percentages through the state levels and the program and
+    station reactions of a water tank and reports what would happen, without touching gv.
+    The station stop percentages are compiled into the bands along with the state levels,
+    so only the samples where the band changes need to be looked at; the bands of all
+    samples are classified at once with numpy if it is installed.
+    Reactions activated ahead of time need the fill rate at every sample, so when they are
+    simulated all samples are looked at.
+    Water loss notifications are not simulated, they depend on the stations actually open.
+    """
+    EVENT_REACTIONS = {
+        WaterTankState.OVERFLOW: ("overflow", u"Overflow"),
+        WaterTankState.WARNING: ("warning", u"Warning"),
+        WaterTankState.CRITICAL: ("critical", u"Critical"),
+    }
+
+    def __init__(self, water_tank):
+        self.water_tank = water_tank
+        table = water_tank.StateBands()
+        # stations stop once the percentage goes past their percentage from either side
+        self.stop_points = sorted(set(
+            station.percentage for event, (name, title) in self.EVENT_REACTIONS.items()
+            for station in (getattr(water_tank, name + "_stations") or {}).values()
+            if station.run and station.percentage is not None
+        ))
+        self.boundaries = sorted(set(table.boundaries + [(p, k) for p in self.stop_points for k in (0, 2)]))
+        # the state row and, per stop point, whether the percentage is above / below it in every band
+        self.rows = []
+        self.sides = []
+        for band in range(len(self.boundaries) + 1):
+            upper = self.boundaries[band - 1] if band else None
+            self.rows.append(table.rows[0 if upper is None else bisect_right(table.boundaries, upper)])
+            self.sides.append({
+                p: (band > self.boundaries.index((p, 2)), band <= self.boundaries.index((p, 0)))
+                for p in self.stop_points
+            })
+
+    def Bands(self, percentages):
+        """Return the band of every percentage, and whether they came from numpy"""
+        try:
+            import numpy    # optional, imported on first use
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            values = numpy.asarray(percentages, dtype=float)
+            # a percentage is past (level, 0) if level <= percentage and past (level, 2) if level < percentage
+            at_least = numpy.array([b[0] for b in self.boundaries if b[1] == 0], dtype=float)
+            at_most = numpy.array([b[0] for b in self.boundaries if b[1] == 2], dtype=float)
+            return numpy.searchsorted(at_least, values, side="right") + numpy.searchsorted(at_most, values, side="left"), True
+        boundaries = self.boundaries
+        return [bisect_left(boundaries, (p, 1)) for p in percentages], False
+
+    def Run(self, percentages, state = None, max_events = 10000, times = None):
+        """
+        Return a report of the state transitions, program and station reactions and
+        notifications that the percentages, in time order, would cause starting from state.
+        With times, the seconds at which the percentages were read, the reactions activated
+        ahead of time by a predictive lead time are simulated too, sample by sample.
+        """
+        wt = self.water_tank
+        bands, vectorized = self.Bands(percentages)
+        predicting = bool(wt.enabled and wt.predictive_lead_minutes and times is not None)
+        if predicting:
+            changes = range(len(bands))
+            trend = FillTrend(fill_trend.window, fill_trend.t_statistic)
+        elif vectorized:
+            import numpy
+            changes = ([0] if len(bands) else []) + (numpy.flatnonzero(bands[1:] != bands[:-1]) + 1).tolist()
         else:
-            f.writelines(lines) 
+            changes = [i for i in range(len(bands)) if i == 0 or bands[i] != bands[i-1]]
+
+        events = []
+        counts = {}
+        running = {}    # stop percentage or None -> [(event name, station id)] of running stations
+
+        def report(sample, kind, **fields):
+            counts[kind] = counts.get(kind, 0) + 1
+            if len(events) < max_events:
+                event = {u"sample": sample, u"percentage": float(percentages[sample]), u"type": kind}
+                event.update(fields)
+                events.append(event)
+
+        def exit_reactions(i, event):
+            name = self.EVENT_REACTIONS[event][0]
+            programs = getattr(wt, name + "_programs") or {}
+            reverted = [id for id, program in programs.items() if program.suspend or program.enable]
+            if reverted:
+                report(i, u"revert_programs", programs = reverted, event = name)
+            # programs run on entering the event are stopped if they still run
+            stopped = [id for id, program in programs.items() if program.run]
+            if stopped:
+                report(i, u"stop_programs", programs = stopped, event = name)
+            stations = getattr(wt, name + "_stations") or {}
+            for key in list(running):
+                stopped = [(n, id) for n, id in running[key] if n == name and stations[id].stop_on_exit]
+                for n, id in stopped:
+                    running[key].remove((n, id))
+                    report(i, u"stop_station", station = id, event = name, reason = u"exit")
+
+        def enter_reactions(i, event):
+            name = self.EVENT_REACTIONS[event][0]
+            programs = getattr(wt, name + "_programs") or {}
+            for kind, attribute in ((u"run_programs", "run"), (u"suspend_programs", "suspend"), (u"enable_programs", "enable")):
+                ids = [id for id, program in programs.items() if getattr(program, attribute)]
+                if ids:
+                    report(i, kind, programs = ids, event = name)
+            for id, station in (getattr(wt, name + "_stations") or {}).items():
+                if station.run:
+                    if (name, id) not in running.setdefault(station.percentage, []):
+                        running[station.percentage].append((name, id))
+                    report(i, u"run_station", station = id, event = name, minutes = station.minutes)
+
+        previous = None
+        predicted = None
+        band_changes = 0
+        for i in changes:
+            band = int(bands[i])
+            if band != previous:
+                band_changes += 1
+            sides = self.sides[band]
+            # stations stop on percentage change before the state is updated, as in UpdateSensorMeasurement
+            if previous is not None and band != previous:
+                for p in self.stop_points:
+                    (above_before, below_before), (above, below) = self.sides[previous][p], sides[p]
+                    if (above and not above_before) or (below and not below_before):
+                        for name, station_id in running.pop(p, []):
+                            report(i, u"stop_station", station = station_id, event = name, reason = u"percentage")
+            previous = band
+
+            new_state = self.rows[band][STATE_EVENTS[state]]
+            if new_state != state:
+                report(i, u"state", old = None if state is None else state.name, new = new_state.name)
+                exit_event, enter_event = STATE_TRANSITIONS[(state, new_state)]
+                if exit_event and wt.enabled:
+                    exit_reactions(i, STATE_EVENTS[state])
+                if enter_event and wt.enabled and new_state == predicted:
+                    predicted = None    # already activated ahead of time
+                elif enter_event and wt.enabled:
+                    enter_reactions(i, new_state)
+                if new_state in self.EVENT_REACTIONS and wt.enabled:
+                    name, title = self.EVENT_REACTIONS[new_state]
+                    xmpp, email = getattr(wt, name + "_xmpp"), getattr(wt, name + "_email")
+                    if xmpp or email:
+                        report(i, u"notification", event = title, xmpp = bool(xmpp), email = bool(email))
+                state = new_state
+
+            # as SetPredictedState after SetState
+            if predicting:
+                percentage = float(percentages[i])
+                trend.Add(wt.id, percentage / 100.0, float(times[i]))
+                rate = trend.SignificantRate(wt.id)
+                new_predicted = wt.PredictState(percentage, None if rate is None else 100.0 * rate, state, predicted)
+                if new_predicted != predicted:
+                    if predicted is not None:
+                        report(i, u"unpredict", event = self.EVENT_REACTIONS[predicted][0])
+                        exit_reactions(i, predicted)
+                    if new_predicted is not None:
+                        report(i, u"predict", event = self.EVENT_REACTIONS[new_predicted][0],
+                               percent_per_minute = None if rate is None else round(100.0 * rate * 60, 3))
+                        enter_reactions(i, new_predicted)
+                    predicted = new_predicted
+
+        return {
+            u"samples": len(bands),
+            u"band_changes": band_changes,
+            u"vectorized": vectorized,
+            u"predictive": predicting,
+            u"final_state": None if state is None else state.name,
+            u"counts": counts,
+            u"events": events,
+            u"truncated": sum(counts.values()) > len(events)
+        }
+
+
+SIMULATION_SAMPLES = 10000        # default samples of a synthetic trajectory
+SIMULATION_MAX_SAMPLES = 100000   # simulations run on the web request thread
+
+
+def synthetic_trajectory(shape, samples, low, high, periods = 1):
+    """
+    Return samples fill percentages between low and high: a sine wave, or a ramp
+    from high down to low and back up, repeated periods times
+    """
+    if not 0 <= samples <= SIMULATION_MAX_SAMPLES:
+        raise ValueError(u"samples must be between 0 and {}".format(SIMULATION_MAX_SAMPLES))
+    try:
+        import numpy    # optional, imported on first use
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        t = numpy.linspace(0.0, periods, samples, endpoint=False) % 1.0
+        if shape == u"ramp":
+            return low + (high - low) * numpy.abs(1.0 - 2.0 * t)
+        return low + (high - low) * (0.5 + 0.5 * numpy.cos(2.0 * pi * t))
+    t = [(periods * i / float(samples)) % 1.0 for i in range(samples)]
+    if shape == u"ramp":
+        return [low + (high - low) * abs(1.0 - 2.0 * x) for x in t]
+    return [low + (high - low) * (0.5 + 0.5 * cos(2.0 * pi * x)) for x in t]
+
+
+def recorded_trajectory(water_tank):
+    """
+    Return the fill percentages of the valid measurements of the sensor of water_tank
+    in the sensor log and the seconds they were logged at, oldest first, of up to
+    SIMULATION_MAX_SAMPLES newest records
+    """
+    percentages = []
+    times = []
+    for r in reversed(query_sensor_log(sensor_id = water_tank.sensor_id, limit = SIMULATION_MAX_SAMPLES)):
+        # a list payload has the readings of several sensors
+        cmd = next((c for c in payload_commands(r["mqtt_payload"]) if str(c.get(u"sensor_id")) == str(water_tank.sensor_id)), {})
+        try:
+            measurement = float(cmd[u"measurement"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if water_tank.MeasurementIsValid(measurement):
+            fraction = water_tank.CalculateFraction(measurement)
+            if fraction is not None:
+                percentages.append(100.0 * fraction)
+                times.append(datetime.fromisoformat(r["date"]).timestamp())
+    return percentages, times
+
+
+def simulate_water_tank(d, overrides, trajectory, state = None, max_events = 10000, interval = 60):
+    """
+    Simulate the water tank of dictionary d with the levels, station percentages and predictive
+    lead time in overrides, e.g. {"overflow_level": 90, "warning_sn_percentage_3": 40}, over
+    trajectory, which is a list of percentages read every interval seconds or None for the
+    recorded sensor log of the water tank
+    """
+    d = json.loads(to_json(d))
+    for key, value in overrides.items():
+        value = None if value in (None, u"") else float(value)
+        if key in [u"overflow_level", u"overflow_safe_level", u"warning_level", u"warning_safe_level", u"critical_level", u"critical_safe_level", u"predictive_lead_minutes"]:
+            d[key] = value
+            continue
+        for name in [u"overflow", u"warning", u"critical"]:
+            prefix = name + u"_sn_percentage_"
+            if key.startswith(prefix) and key[len(prefix):] in (d.get(name + u"_stations") or {}):
+                d[name + u"_stations"][key[len(prefix):]][u"percentage"] = value
+    wt = WaterTankFactory.FromDict(d)
+    if trajectory is None:
+        trajectory, times = recorded_trajectory(wt)
+    else:
+        times = [i * interval for i in range(len(trajectory))] if wt.predictive_lead_minutes else None
+    return WaterTankSimulator(wt).Run(trajectory, state, max_events, times)
+
+
+def log_sensor_msg(msg):
+    settings = get_settings()
+    record = {
+        "date": datetime.now().isoformat(sep=' ', timespec='seconds'),
+        "mqtt_topic": str(msg.topic),
+        "mqtt_payload": str(msg.payload)
+    }
+    if settings.get(SENSOR_LOG_ARCHIVE, False):
+        sensor_log_archive.Append(record)
+    elif settings.get(SENSOR_LOG_BINARY, False):
+        payload = msg.payload if isinstance(msg.payload, bytes) else str(msg.payload).encode("utf-8")
+        binary_sensor_log.Append(time.time(), record["mqtt_topic"], payload, settings[MAX_SENSOR_LOG_RECORDS])
+    else:
+        get_storage(settings).AppendSensorLog(record, settings[MAX_SENSOR_LOG_RECORDS])
 
 
 def on_sensor_mqtt_message(client, msg):
     """
     Callback when MQTT message is received from sensor
     """
-    print('Received MQTT message: {}'.format(msg.payload))
-    settings = get_settings()
-    if settings[SENSOR_LOG_ENABLED]:
-        log_sensor_msg(msg)
-    try:
-        cmd = json.loads(msg.payload)
-        print('MQTT cmd: {}'.format(cmd))
-    except ValueError as e:
-        print(u"Water Tank plugin could not decode command: ", msg.payload, e)
-        send_unrecognised_msg(msg.topic, datetime.now().replace(microsecond=0), msg.payload)
+    log.debug('Received MQTT message: %s', msg.payload)
+    sensors = sensor_topic_router.Route(msg.topic)
+    if sensors is None:
+        log.debug("No water tank listens to topic '%s'", msg.topic)
         return
 
+    # logged before it is queued, so readings merged or dropped by the queue are in the log too
+    try:
+        if get_settings()[SENSOR_LOG_ENABLED]:
+            log_sensor_msg(msg)
+    except Exception as e:
+        log.exception("Exception logging sensor message. %s", e)
+    sensor_ingest_queue.Put(msg, sensors)
+
+
+def process_sensor_mqtt_message(msg, sensors, cmd = None):
+    """
+    Update the water tanks of sensors with the sensor message, which on_sensor_mqtt_message
+    has logged already. cmd is the already decoded payload, if any.
+    """
+    settings = get_settings()
+    if cmd is None:
+        try:
+            cmd = json.loads(msg.payload)
+        except ValueError as e:
+            log.warning(u"Water Tank plugin could not decode command: %s %s", msg.payload, e)
+            send_unrecognised_msg(msg.topic, datetime.now().replace(microsecond=0), msg.payload)
+            return
+    log.debug('MQTT cmd: %s', cmd)
+
     try:
         water_tanks = settings[u"water_tanks"]
-        water_tank_updated = False
-        # print("Before updateSensorMeasurementFromCmd water_tanks: {}".format(json.dumps(settings[u"water_tanks"], default=serialize_datetime, indent=4)))
+        updated_ids = []
+        # print("Before updateSensorMeasurementFromCmd water_tanks: {}".format(json.dumps(settings[u"water_tanks"], default=json_default, indent=4)))
         if isinstance(cmd, dict) and 'sensor_id' in cmd:
-            water_tank_updated = updateSensorMeasurementFromCmd(cmd, water_tanks, msg)
+            updated_ids = updateSensorMeasurementFromCmd(cmd, water_tanks, msg, sensors)
         elif isinstance(cmd, list):
-            print('Cmd is a list')
+            log.debug('Cmd is a list')
             for singleTankCmd in cmd:
-                print('Cmd item:{}'.format(json.dumps(singleTankCmd, default=serialize_datetime,indent=4)))
+                log.debug('Cmd item:%s', singleTankCmd)
                 if isinstance(singleTankCmd, dict) and 'sensor_id' in singleTankCmd:
-                    print("Will call updateSensorMeasurementFromCmd for sensor '{}'".format(singleTankCmd["sensor_id"]))
-                    water_tank_updated = updateSensorMeasurementFromCmd(singleTankCmd, water_tanks, msg) or water_tank_updated
+                    log.debug("Will call updateSensorMeasurementFromCmd for sensor '%s'", singleTankCmd["sensor_id"])
+                    updated_ids += updateSensorMeasurementFromCmd(singleTankCmd, water_tanks, msg, sensors)
                 else:
-                    print("Unknown mqtt command {}".format(repr(cmd)))
+                    log.warning("Unknown mqtt command %r", cmd)
                     send_unrecognised_msg(msg.topic, datetime.now().replace(microsecond=0), singleTankCmd)                    
         else:
-            print("Unknown mqtt command {}".format(repr(cmd)))
+            log.warning("Unknown mqtt command %r", cmd)
             send_unrecognised_msg(msg.topic, datetime.now().replace(microsecond=0), msg.payload)
             return
 
-        if not water_tank_updated:
-            print("No water tank with cmd '{}' was updated.".format(cmd))
+        if not updated_ids:
+            log.debug("No water tank with cmd '%s' was updated.", cmd)
             return
         
         settings[u"water_tanks"] = water_tanks
-        print("on_sensor_mqtt_message. Water tank update, saving settings to file")
-        # print("Saving water_tanks: {}".format(json.dumps(settings[u"water_tanks"], default=serialize_datetime, indent=4)))
-        with open(DATA_FILE, u"w") as f:
-                json.dump(settings, f, default=serialize_datetime, indent=4)  # save to file                
+        log.debug("on_sensor_mqtt_message. Water tank update, saving settings to file")
+        # print("Saving water_tanks: {}".format(json.dumps(settings[u"water_tanks"], default=json_default, indent=4)))
+        write_settings(settings, updated_ids)
 
         publish_water_tanks_mqtt()
     except Exception as e:
-        print("Exception in on_sensor_mqtt_message. ", e)
-        traceback.print_exc()
+        log.exception("Exception in on_sensor_mqtt_message. %s", e)
 
 
 def on_data_request_mqtt_message(client, msg):
@@ -1844,51 +4138,337 @@ def on_data_request_mqtt_message(client, msg):
     publish_water_tanks_mqtt()
 
 
-def subscribe_mqtt():
+def mqtt_topic_matches(subscription, topic):
     """
-    Start listening for mqtt messages
+    Return True if topic matches an mqtt subscription that may contain + and # wildcards
     """
-    settings = get_settings()
+    subscription_levels = subscription.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(subscription_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(subscription_levels) == len(topic_levels)
 
-    #subscribe to data-request topic
-    topic = settings[WATER_PLUGIN_REQUEST_MQTT_TOPIC]
-    if topic:
-        print("Subscribing to topic '{}'".format(topic))
-        mqtt.subscribe(topic, on_data_request_mqtt_message, 2)
 
-    #subscribe to sensor topics
+class SensorTopicRouter():
+    """
+    Maps the topic of an incoming sensor message to the water tanks listening to it,
+    as {sensor_id: [water tank ids]}. Topics are looked up in a dict; water tank topics
+    that contain wildcards are matched once per new topic and the result is remembered
+    for the MATCHED_TOPICS most recently routed topics.
+    """
+    MATCHED_TOPICS = 1000
+
+    def __init__(self, water_tanks = None):
+        self.exact = {}
+        self.wildcards = []
+        self.matched = OrderedDict()    # topic -> routing of Route, least recently routed first
+        self.levels = {}    # water tank id -> (water tank, level thresholds) for SensorIngestQueue
+        for wt in (water_tanks or {}).values():
+            topic = wt[u"sensor_mqtt_topic"]
+            if not topic:
+                continue
+            try:
+                water_tank = WaterTankFactory.FromDict(wt)
+                self.levels[wt[u"id"]] = (water_tank, water_tank.LevelThresholds())
+            except Exception as e:
+                log.warning("Water tank '%s' cannot be compiled for sensor ingest. %s", wt[u"id"], e)
+            levels = topic.split("/")
+            if "+" in levels or levels[-1] == "#":
+                self.wildcards.append((topic, wt[u"sensor_id"], wt[u"id"]))
+            else:
+                self.exact.setdefault(topic, {}).setdefault(wt[u"sensor_id"], []).append(wt[u"id"])
+
+    def Route(self, topic):
+        """
+        Return the water tank ids per sensor id for topic, or None if no water tank listens to it
+        """
+        if not self.wildcards:
+            return self.exact.get(topic)
+        if topic in self.matched:
+            self.matched.move_to_end(topic)
+            return self.matched[topic]
+        sensors = {sensor_id: list(ids) for sensor_id, ids in self.exact.get(topic, {}).items()}
+        for subscription, sensor_id, id in self.wildcards:
+            if mqtt_topic_matches(subscription, topic):
+                sensors.setdefault(sensor_id, []).append(id)
+        # a gateway may publish to ever new topics, so only the recent ones are kept
+        self.matched[topic] = sensors if sensors else None
+        if len(self.matched) > self.MATCHED_TOPICS:
+            self.matched.popitem(last = False)
+        return self.matched[topic]
+
+    def Band(self, ids, measurement):
+        """
+        Return the level bands of measurement for the water tanks with ids
+        """
+        bands = []
+        for id in ids:
+            if id in self.levels:
+                water_tank, thresholds = self.levels[id]
+                bands.append(water_tank.LevelBand(measurement, thresholds))
+        return tuple(bands)
+
+
+SENSOR_INGEST_QUEUE_SIZE = 1000  # readings waiting for the state thread, before routine ones are dropped
+SENSOR_INGEST_BATCH_SIZE = 50    # readings processed per state thread command
+
+
+class SensorIngestQueue():
+    """
+    Bounded stage between the mqtt thread and the state thread. A queued reading of a sensor
+    that has not been processed yet is replaced by a newer reading of the same sensor, so a
+    burst, e.g. the backlog after a broker reconnect, costs one update per sensor.
+    A reading is kept when it moves a water tank into another level band (see
+    WaterTank.LevelBand) or carries a sensor warning, since it may change a state or
+    trigger a message. The queue holds at most max_size entries. When it is full a new
+    routine reading is dropped, any other message takes the place of the oldest queued
+    routine reading, which is dropped instead. Only when no routine reading is queued is the
+    message dropped and counted as overflowed; if it would have changed the band of its
+    sensor, the next reading of the sensor changes the band in its place.
+    Readings are logged before they are queued, merged and dropped ones too.
+    """
+    def __init__(self, max_size = SENSOR_INGEST_QUEUE_SIZE):
+        self.max_size = max_size
+        self.queue = deque()
+        self.pending = {}       # (topic, sensor_id) -> queued entry not processed yet
+        self.last_band = {}     # (topic, sensor_id) -> band of the last accepted reading
+        self.lock = th.Lock()
+        self.scheduled = False
+        self.merged = 0
+        self.dropped = 0
+        self.overflowed = 0
+        self.processed = 0
+
+    def Put(self, msg, sensors):
+        cmd = None
+        key = None
+        band = None
+        try:
+            cmd = json.loads(msg.payload)
+            if isinstance(cmd, dict) and cmd.get("sensor_id") in sensors and isinstance(cmd.get("measurement"), (int, float)):
+                key = (msg.topic, cmd["sensor_id"])
+                band = (bool(cmd.get("warning")), sensor_topic_router.Band(sensors[cmd["sensor_id"]], cmd["measurement"]))
+        except ValueError:
+            pass    # process_sensor_mqtt_message reports it
+
+        with self.lock:
+            entry = self.pending.get(key) if key is not None else None
+            if entry is not None and entry["band"] == entry["previous_band"]:
+                # the queued reading is routine, the newer one replaces it
+                entry["msg"] = msg
+                entry["cmd"] = cmd
+                entry["band"] = band
+                self.last_band[key] = band
+                self.merged += 1
+                return
+
+            previous_band = self.last_band.get(key) if key is not None else None
+            if len(self.queue) >= self.max_size:
+                if key is not None and band == previous_band:
+                    self.dropped += 1
+                    log.warning("Sensor ingest queue is full, dropping routine reading from sensor '%s'", cmd["sensor_id"])
+                    return
+                if not self.EvictRoutine():
+                    # the band of the sensor is not updated, so its next reading is kept in its place
+                    self.overflowed += 1
+                    log.error("Sensor ingest queue is full, dropping message from topic '%s'", msg.topic)
+                    return
+
+            entry = {"msg": msg, "cmd": cmd, "sensors": sensors, "key": key, "band": band, "previous_band": previous_band}
+            self.queue.append(entry)
+            if key is not None:
+                self.pending[key] = entry
+                self.last_band[key] = band
+            if not self.scheduled:
+                self.scheduled = True
+                state_actor.Post(self.Drain)
+
+    def EvictRoutine(self):
+        """
+        Drop the oldest queued routine reading to make room, return False if there is none.
+        Called with the lock held.
+        """
+        for entry in self.queue:
+            if entry["key"] is not None and entry["band"] == entry["previous_band"]:
+                self.queue.remove(entry)
+                if self.pending.get(entry["key"]) is entry:
+                    del self.pending[entry["key"]]
+                self.dropped += 1
+                log.warning("Sensor ingest queue is full, dropping routine reading from sensor '%s'", entry["cmd"]["sensor_id"])
+                return True
+        return False
+
+    def Drain(self):
+        """
+        Process queued readings on the state thread, in batches so that other commands are not held up
+        """
+        for i in range(SENSOR_INGEST_BATCH_SIZE):
+            with self.lock:
+                if not self.queue:
+                    self.scheduled = False
+                    return
+                entry = self.queue.popleft()
+                if entry["key"] is not None and self.pending.get(entry["key"]) is entry:
+                    del self.pending[entry["key"]]
+                self.processed += 1
+            try:
+                process_sensor_mqtt_message(entry["msg"], entry["sensors"], entry["cmd"])
+            except Exception as e:
+                # the queue has to keep draining, or sensor ingest would stop for good
+                log.exception("Exception processing sensor message from topic '%s'. %s", entry["msg"].topic, e)
+        state_actor.Post(self.Drain)
+
+    def Reset(self):
+        """
+        Forget the bands of accepted readings, e.g. after water tank levels were changed
+        """
+        with self.lock:
+            self.last_band.clear()
+
+    def Stats(self):
+        with self.lock:
+            return {"queued": len(self.queue), "merged": self.merged, "dropped": self.dropped, "overflowed": self.overflowed, "processed": self.processed}
+
+
+sensor_ingest_queue = SensorIngestQueue()
+
+
+sensor_topic_router = SensorTopicRouter()
+
+
+def sensor_mqtt_topics(settings):
+    """
+    Return the topics to subscribe to for sensor messages. These are the configured
+    wildcard topics and the water tank topics that none of them covers.
+    """
+    wildcard_topics = [topic.strip() for topic in settings.get(SENSOR_MQTT_WILDCARD_TOPICS, u"").split(",") if topic.strip()]
+    topics = list(wildcard_topics)
     for wt in list( settings[u"water_tanks"].values() ):
         topic = wt[u"sensor_mqtt_topic"]
-        if topic and topic not in mqtt._subscriptions:
-            print("Subscribing to topic '{}'".format(topic))
-            mqtt.subscribe(topic, on_sensor_mqtt_message, 2)
+        if topic and topic not in topics and not any(mqtt_topic_matches(wildcard, topic) for wildcard in wildcard_topics):
+            topics.append(topic)
+    return topics
 
 
-def unsubscribe_mqtt():
-    settings = get_settings()
+_active_mqtt_subscriptions = {}   # topic -> (callback, qos)
+_desired_mqtt_subscriptions = {}  # topic -> (callback, qos) of the last reconcile, including those that failed
+_mqtt_subscriptions_lock = th.Lock()
+
+
+def desired_mqtt_subscriptions(settings):
+    """
+    Return the subscriptions the current settings need as {topic: (callback, qos)}
+    """
+    subscriptions = {}
     topic = settings[WATER_PLUGIN_REQUEST_MQTT_TOPIC]
     if topic:
-        mqtt.unsubscribe(topic)
+        subscriptions[topic] = (on_data_request_mqtt_message, 2)
 
-    for wt in list( settings[u"water_tanks"].values() ):
-        topic = wt[u"sensor_mqtt_topic"]
-        if topic:
+    qos = int(settings.get(SENSOR_MQTT_QOS, 2))
+    for topic in sensor_mqtt_topics(settings):
+        subscriptions.setdefault(topic, (on_sensor_mqtt_message, qos))
+    return subscriptions
+
+
+def mqtt_subscribe(topic, callback, qos):
+    """
+    Return True if topic was subscribed, False if there is no mqtt client yet or subscribing failed
+    """
+    if mqtt.get_client() is None:
+        return False
+    try:
+        result = mqtt.subscribe(topic, callback, qos)
+    except Exception as e:
+        log.warning("Could not subscribe to topic '%s'. %s", topic, e)
+        try:
+            mqtt.unsubscribe(topic) # drop a partial registration so that the retry starts clean
+        except Exception:
+            pass
+        return False
+    # paho's subscribe returns (result, mid), pass it on if the mqtt plugin does
+    return not (isinstance(result, tuple) and result and result[0] != 0)
+
+
+def reconcile_mqtt_subscriptions(desired):
+    """
+    Subscribe and unsubscribe only the topics that differ between desired and the
+    active subscriptions. New topics are subscribed before stale ones are dropped,
+    so topics that stay are never interrupted. A topic is active only once it was
+    subscribed successfully, failed ones are retried by the next reconcile.
+    """
+    global _desired_mqtt_subscriptions
+    with _mqtt_subscriptions_lock:
+        _desired_mqtt_subscriptions = dict(desired)
+        changed = [topic for topic, subscription in _active_mqtt_subscriptions.items()
+                   if topic in desired and desired[topic] != subscription]
+        for topic in changed:
             mqtt.unsubscribe(topic)
+            del _active_mqtt_subscriptions[topic]
+
+        for topic, (callback, qos) in desired.items():
+            if topic not in _active_mqtt_subscriptions:
+                log.info("Subscribing to topic '%s'", topic)
+                if mqtt_subscribe(topic, callback, qos):
+                    _active_mqtt_subscriptions[topic] = (callback, qos)
+                else:
+                    log.warning("Subscribing to topic '%s' failed, will retry", topic)
+
+        for topic in [topic for topic in _active_mqtt_subscriptions if topic not in desired]:
+            log.info("Unsubscribing from topic '%s'", topic)
+            mqtt.unsubscribe(topic)
+            del _active_mqtt_subscriptions[topic]
+
+
+def retry_mqtt_subscriptions():
+    """
+    Reconcile again if a desired topic could not be subscribed, e.g. because the mqtt client
+    did not exist yet at startup. Called periodically.
+    """
+    with _mqtt_subscriptions_lock:
+        desired = _desired_mqtt_subscriptions
+        failed = any(topic not in _active_mqtt_subscriptions for topic in desired)
+    if failed:
+        try:
+            reconcile_mqtt_subscriptions(desired)
+        except Exception as e:
+            log.exception("Could not retry mqtt subscriptions. %s", e)
+
+
+def subscribe_mqtt():
+    """
+    Start listening for mqtt messages
+    """
+    refresh_mqtt_subscriptions()
+
+
+def unsubscribe_mqtt():
+    reconcile_mqtt_subscriptions({})
 
 
 def refresh_mqtt_subscriptions():
-    unsubscribe_mqtt()
-    subscribe_mqtt()    
+    """
+    Bring the mqtt subscriptions and the sensor topic router in line with the settings.
+    The router is replaced in a single assignment, so messages being delivered
+    meanwhile use either the old or the new one.
+    """
+    global sensor_topic_router
+    settings = get_settings()
+    sensor_topic_router = SensorTopicRouter(settings[u"water_tanks"])
+    sensor_ingest_queue.Reset()
+    reconcile_mqtt_subscriptions(desired_mqtt_subscriptions(settings))
 
 
 def publish_water_tanks_mqtt():
     settings = get_settings()
     client = mqtt.get_client()
     if client:
-        # print("Publishing: {}".format(json.dumps(settings['water_tanks'], default=serialize_datetime, indent=4)))
+        # print("Publishing: {}".format(json.dumps(settings['water_tanks'], default=json_default, indent=4)))
         client.publish(
             settings[WATER_PLUGIN_DATA_PUBLISH_MQTT_TOPIC], 
-            json.dumps(readWaterTankData(), default=serialize_datetime, indent=4), 
+            water_tanks_payload(), 
             qos=1, 
             retain=True
         )
@@ -1900,11 +4480,7 @@ class settings(ProtectedPage):
     """
 
     def GET(self):
-        try:
-            with open(DATA_FILE, u"r") as f:  # Read settings from json file if it exists
-                settings = json.load(f)
-        except IOError:  # If file does not exist return empty value
-            settings = _settings
+        settings = dict(get_settings())
 
         show_settings = 'showSettings' in web.input()
         water_tank_id = None
@@ -1913,7 +4489,7 @@ class settings(ProtectedPage):
 
         if( len(settings[u"water_tanks"]) > 0 ):
             settings[u"water_tanks"] = sorted(list(settings[u"water_tanks"].values()), key= lambda wt : wt["order"])
-        # print("Sending settings: {}".format(json.dumps(settings, default=serialize_datetime, indent=4)))
+        # print("Sending settings: {}".format(json.dumps(settings, default=json_default, indent=4)))
         return template_render.water_tank(settings, json.dumps(defaults, ensure_ascii=False), gv.pnames, gv.snames, water_tank_id, show_settings)  # open settings page
 
 
@@ -1928,14 +4504,43 @@ class save_settings(ProtectedPage):
         d = (
             web.input()
         )  # Dictionary of values returned as query string from settings page.
-        print('Received: {}'.format(json.dumps(d, default=serialize_datetime, indent=4, sort_keys=True))) # for testing
+        log.debug('Received: %s', d)
+        state_actor.Call(self.Save, d)
+        raise web.seeother(u"/water-tank-sp?showSettings") 
+
+    def Save(self, d):
         settings = get_settings()
 
         settings[MQTT_BROKER_WS_PORT] = d[MQTT_BROKER_WS_PORT]
         settings[WATER_PLUGIN_REQUEST_MQTT_TOPIC] = d[WATER_PLUGIN_REQUEST_MQTT_TOPIC]
         settings[WATER_PLUGIN_REQUEST_MQTT_TOPIC] = d[WATER_PLUGIN_REQUEST_MQTT_TOPIC]
+        settings[SENSOR_MQTT_WILDCARD_TOPICS] = d.get(SENSOR_MQTT_WILDCARD_TOPICS, u"")
+        settings[SENSOR_MQTT_QOS] = int(d.get(SENSOR_MQTT_QOS, 2))
         settings[MAX_SENSOR_LOG_RECORDS] = int(d[MAX_SENSOR_LOG_RECORDS])
         settings[SENSOR_LOG_ENABLED] = (SENSOR_LOG_ENABLED in d)
+        if SENSOR_LOG_RETENTION_DAYS in d:
+            settings[SENSOR_LOG_ARCHIVE] = (SENSOR_LOG_ARCHIVE in d)
+            settings[SENSOR_LOG_BINARY] = (SENSOR_LOG_BINARY in d)
+            settings[SENSOR_LOG_RETENTION_DAYS] = int(d[SENSOR_LOG_RETENTION_DAYS])
+            settings[SENSOR_LOG_RETENTION_MB] = int(d[SENSOR_LOG_RETENTION_MB])
+            apply_sensor_log_settings(settings)
+        settings[HUMAN_READABLE_JSON] = (HUMAN_READABLE_JSON in d)
+        if LOG_LEVEL in d:
+            settings[LOG_LEVEL] = d[LOG_LEVEL]
+            settings[LOG_RATE_LIMIT_SECONDS] = int(d[LOG_RATE_LIMIT_SECONDS])
+            apply_log_settings(settings)
+        if NOTIFICATION_COOLDOWN_SECONDS in d:
+            settings[NOTIFICATION_COOLDOWN_SECONDS] = int(d[NOTIFICATION_COOLDOWN_SECONDS])
+            settings[NOTIFICATION_MAX_COOLDOWN_SECONDS] = int(d[NOTIFICATION_MAX_COOLDOWN_SECONDS])
+            settings[NOTIFICATION_MAX_PER_HOUR] = int(d[NOTIFICATION_MAX_PER_HOUR])
+            apply_notification_settings(settings)
+        if LEAK_WINDOW_MINUTES in d:
+            settings[LEAK_WINDOW_MINUTES] = int(d[LEAK_WINDOW_MINUTES])
+            settings[LEAK_MIN_LITRES_PER_HOUR] = float(d[LEAK_MIN_LITRES_PER_HOUR])
+            settings[PREDICTION_WINDOW_MINUTES] = int(d[PREDICTION_WINDOW_MINUTES])
+            apply_fill_trend_settings(settings)
+        if STORAGE_BACKEND in d:
+            migrate_storage(settings, d[STORAGE_BACKEND])
         settings[DEAD_SENSOR_EMAIL] = (DEAD_SENSOR_EMAIL in d)
         settings[DEAD_SENSOR_XMPP] = (DEAD_SENSOR_XMPP in d)
         settings[DEAD_SENSOR_MSG] = d[DEAD_SENSOR_MSG]
@@ -1964,11 +4569,9 @@ class save_settings(ProtectedPage):
         settings[EMAIL_SUBJECT] = d[EMAIL_SUBJECT]
         settings[EMAIL_RECIPIENTS] = d[EMAIL_RECIPIENTS]
 
-        with open(DATA_FILE, u"w") as f:
-            json.dump(settings, f, default=serialize_datetime, indent=4)  # save to file
-        # print('Saved settings: {}'.format(json.dumps(settings, default=serialize_datetime, indent=4)))
-
-        raise web.seeother(u"/water-tank-sp?showSettings") 
+        write_settings(settings)
+        # print('Saved settings: {}'.format(json.dumps(settings, default=json_default, indent=4)))
+        refresh_mqtt_subscriptions()
 
 
 class save_water_tanks(ProtectedPage):
@@ -1982,7 +4585,16 @@ class save_water_tanks(ProtectedPage):
         d = (
             web.input()
         )  # Dictionary of values returned as query string from settings page.
-        print('Received: {}'.format(json.dumps(d, default=serialize_datetime, indent=4, sort_keys=True))) # for testing
+        log.debug('Received: %s', d)
+        if state_actor.Call(self.Save, d):
+            raise web.seeother(u"/water-tank-sp?water_tank_id=" + d[u"id"])
+        else:
+            raise web.seeother(u"/water-tank-sp")
+
+    def Save(self, d):
+        """
+        Returns True if a water tank was added or updated
+        """
         settings = get_settings()
         
         water_tank = WaterTankFactory.FromDict(d)
@@ -1991,34 +4603,35 @@ class save_water_tanks(ProtectedPage):
         if d[u"id"]:
             if d[u"action"] == "add":
                 #add new water_Tank
-                # print('Adding new water tank: {}'.format(json.dumps(water_tank, default=serialize_datetime, indent=4)))
+                # print('Adding new water tank: {}'.format(json.dumps(water_tank, default=json_default, indent=4)))
                 water_tank.order = len(settings['water_tanks'])
                 settings['water_tanks'][water_tank.id] = water_tank
             elif d[u"action"] == "update" and original_water_tank_id:
-                # print('Updating water tank with id: "{}". New values: {}'.format(original_water_tank_id, json.dumps(water_tank, default=serialize_datetime, indent=4)))
+                # print('Updating water tank with id: "{}". New values: {}'.format(original_water_tank_id, json.dumps(water_tank, default=json_default, indent=4)))
                 wt = settings['water_tanks'][original_water_tank_id]
-                # print('Old values: {}'.format(json.dumps(wt, default=serialize_datetime, indent=4)))
+                # print('Old values: {}'.format(json.dumps(wt, default=json_default, indent=4)))
                 water_tank.last_updated = wt["last_updated"]
                 water_tank.order = wt["order"]
                 water_tank.state = wt["state"]
+                water_tank.predicted_state = wt.get("predicted_state")
                 # if wt["sensor_measurement"]:
                 #     water_tank.UpdateSensorMeasurement(wt["sensor_measurement"])
+                leak_detector.Reset(original_water_tank_id) # the levels it was measured with may have changed
+                fill_trend.Reset(original_water_tank_id)
                 if water_tank.id == original_water_tank_id:
                     settings['water_tanks'][original_water_tank_id] = water_tank
                 else:
                     del settings['water_tanks'][original_water_tank_id]
                     settings['water_tanks'][water_tank.id] = water_tank
                 
-        with open(DATA_FILE, u"w") as f:
-            json.dump(settings, f, default=serialize_datetime, indent=4)  # save to file
-        # print('Saved water tanks: {}'.format(json.dumps(settings, default=serialize_datetime, indent=4)))
+        write_settings(settings)
+        # print('Saved water tanks: {}'.format(json.dumps(settings, default=json_default, indent=4)))
 
         if d[u"id"] and (d[u"action"] == "add" or (d[u"action"] == "update" and original_water_tank_id)):
             refresh_mqtt_subscriptions()
             publish_water_tanks_mqtt()
-            raise web.seeother(u"/water-tank-sp?water_tank_id=" + d[u"id"])
-        else:
-            raise web.seeother(u"/water-tank-sp")
+            return True
+        return False
 
 
 class get_all(ProtectedPage):
@@ -2026,10 +4639,8 @@ class get_all(ProtectedPage):
     Read last saved water-tank data and return it as json
     """
     def GET(self):
-        print(u"Reading water tank data")
-        data = readWaterTankData()
-        web.header('Content-Type', 'application/json')
-        return json.dumps(data, default=serialize_datetime, indent=4)
+        log.debug(u"Reading water tank data")
+        return json_response(u"water_tanks", serialize_water_tanks)
     
 
 class get_mqtt_settings(ProtectedPage):
@@ -2039,28 +4650,26 @@ class get_mqtt_settings(ProtectedPage):
     widgets
     """
     def GET(self):
-        water_tank_settings = get_settings()
-        settings = mqtt.get_settings()
-        settings[MQTT_BROKER_WS_PORT] = int(water_tank_settings[MQTT_BROKER_WS_PORT])
-        settings[WATER_PLUGIN_REQUEST_MQTT_TOPIC] = water_tank_settings[WATER_PLUGIN_REQUEST_MQTT_TOPIC]
-        settings[WATER_PLUGIN_DATA_PUBLISH_MQTT_TOPIC] = water_tank_settings[WATER_PLUGIN_DATA_PUBLISH_MQTT_TOPIC]
-        # Get the ip in case of localhost or 127.0.0.1
-        # from https://stackoverflow.com/a/28950776
-        if settings['broker_host'].lower() in ['localhost', '127.0.0.1']:
-            import socket
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.settimeout(0)
-            try:
-                # doesn't even have to be reachable
-                s.connect(('10.254.254.254', 1))
-                IP = s.getsockname()[0]
-            except Exception:
-                IP = '127.0.0.1'
-            finally:
-                s.close()
-            settings['broker_host'] = IP
-    
-        return json.dumps(settings, default=serialize_datetime, indent=4)
+        mqtt_settings = mqtt.get_settings()
+        return json_response(
+            u"mqtt_settings",
+            lambda: serialize_mqtt_settings(mqtt_settings),
+            mqtt_settings
+        )
+
+
+class bootstrap(ProtectedPage):
+    """
+    Return water tanks and mqtt connection info in one response
+    for the homepage widget
+    """
+    def GET(self):
+        mqtt_settings = mqtt.get_settings()
+        return json_response(
+            u"bootstrap",
+            lambda: serialize_bootstrap(mqtt_settings),
+            mqtt_settings
+        )
 
 
 class get_settings_json(ProtectedPage):
@@ -2068,7 +4677,7 @@ class get_settings_json(ProtectedPage):
     Return the water_tank settings.
     """
     def GET(self):
-        return json.dumps(get_settings(), default=serialize_datetime, indent=4)
+        return json_response(u"settings", serialize_settings)
 
 
 class delete(ProtectedPage)    :
@@ -2078,16 +4687,19 @@ class delete(ProtectedPage)    :
     def POST(self):
         data = web.input()
         # print(repr(data))
-        id = data[u"original_water_tank_id"]
+        state_actor.Call(self.Delete, data[u"original_water_tank_id"])
+        raise web.seeother(u"/water-tank-sp")  # open settings page        
+
+    def Delete(self, id):
         # print('id: {}\n'.format(id))
         settings = get_settings()
         if id in settings[u"water_tanks"]:
             del settings[u"water_tanks"][id]
+            leak_detector.Reset(id)
+            fill_trend.Reset(id)
             # print('Settings after delete:{}'.format(repr(settings)))            
-            with open(DATA_FILE, u"w") as f:
-                json.dump(settings, f, default=serialize_datetime, indent=4)  # save to file
+            write_settings(settings)
             refresh_mqtt_subscriptions()
-        raise web.seeother(u"/water-tank-sp")  # open settings page        
 
 
 class save_order(ProtectedPage):
@@ -2095,13 +4707,15 @@ class save_order(ProtectedPage):
     Saves the order of a water tank
     """
     def POST(self):
-        data = web.input()
+        return state_actor.Call(self.Save, web.input())
+
+    def Save(self, data):
         try:
-            print(repr(data))
+            log.debug('%r', data)
             id = data["water_tank_id"]
             order = int(data["order"])
             move = data["move"]
-            print('id: {}, move: {}, order: {}'.format(id, move, order))
+            log.debug('id: %s, move: %s, order: %s', id, move, order)
             settings = get_settings()
             if id in settings[u"water_tanks"]:
                 previous_order = settings[u"water_tanks"][id]["order"]
@@ -2112,8 +4726,7 @@ class save_order(ProtectedPage):
                         settings[u"water_tanks"][x]["order"] += 1 
                     elif( move == "up" and settings[u"water_tanks"][x]["order"] <= order and settings[u"water_tanks"][x]["order"] > previous_order):
                         settings[u"water_tanks"][x]["order"] -= 1 
-                with open(DATA_FILE, u"w") as f:
-                    json.dump(settings, f, default=serialize_datetime, indent=4)  # save to file
+                write_settings(settings)
 
                 # publish all water-tank data for new order
                 publish_water_tanks_mqtt()
@@ -2125,11 +4738,13 @@ class save_order(ProtectedPage):
 
 class revert_programs(ProtectedPage):
     def GET(self):
-        data = web.input()
+        return state_actor.Call(self.Revert, web.input())
+
+    def Revert(self, data):
         try:
             id = data["water_tank_id"]
             state = WaterTankState( int(data["state"]) )
-            print('id: {}, state: {}'.format(id, state.name))
+            log.debug('id: %s, state: %s', id, state.name)
             settings = get_settings()
             if id in settings[u"water_tanks"]:
                 wt = WaterTankFactory.FromDict(settings[u"water_tanks"][id])
@@ -2140,40 +4755,130 @@ class revert_programs(ProtectedPage):
             return '{"success": false, "reason": "An exception occured: ' + e + '"}'
 
 
+class migrate_storage_command(ProtectedPage):
+    """
+    One-shot migration of water tanks and sensor log to another storage backend
+    e.g. /water-tank-migrate-storage?backend=sqlite
+    """
+    def GET(self):
+        data = web.input()
+        try:
+            backend = data["backend"]
+            if backend not in [STORAGE_JSON, STORAGE_SQLITE]:
+                return '{"success": false, "reason": "unknown storage backend [' + str(backend) + ']"}'
+            state_actor.Call(lambda: migrate_storage(get_settings(), backend))
+            return '{"success": true, "reason": ""}'
+        except Exception as e:
+            return '{"success": false, "reason": "An exception occured: ' + str(e) + '"}'
+
+
 class sensor_log(ProtectedPage):
     def GET(self):
-        records = read_sensor_log()
-        return template_render.water_tank_log(records, get_settings())
+        settings = get_settings()
+        start = max(0, int(web.input(start = 0).start))
+        records = list(itertools.islice(read_sensor_log(start), settings[MAX_SENSOR_LOG_RECORDS] or None))
+        return template_render.water_tank_log(records, settings, start)
 
 
 class clear_sensor_log(ProtectedPage):
     """Delete all log records"""
 
     def GET(self):
-        with io.open(LOG_FILE, "w") as f:
-            f.write("")
+        state_actor.Call(self.Clear)
         raise web.seeother("/water_plugin_sensor_log")
 
+    def Clear(self):
+        get_storage(get_settings()).ClearSensorLog()
+        sensor_log_archive.Clear()
+        binary_sensor_log.Clear()
+
+
+class ingest_stats(ProtectedPage):
+    """
+    Counters of the sensor ingest queue: readings queued, merged into a newer one, dropped,
+    other messages dropped because the queue was full (overflowed) and processed
+    """
+    def GET(self):
+        web.header(u"Content-Type", u"application/json")
+        return json.dumps(sensor_ingest_queue.Stats())
+
+
+class query_sensor_log_records(ProtectedPage):
+    """
+    Sensor log records as json, newest first, filtered by the optional query parameters
+    mqtt_topic, sensor_id, from and to (dates like 2024-05-01 or 2024-05-01 10:30:00)
+    and limit (default 1000, 0 for all)
+    """
+    def GET(self):
+        q = web.input(mqtt_topic = None, sensor_id = None, limit = 1000)
+        web.header(u"Content-Type", u"application/json")
+        try:
+            date_from = datetime.fromisoformat(q[u"from"]) if q.get(u"from") else None
+            date_to = datetime.fromisoformat(q[u"to"]) if q.get(u"to") else None
+            if date_to is not None and len(q[u"to"]) == 10:
+                date_to += timedelta(days=1, seconds=-1)  # a date includes the whole day
+            limit = int(q.limit)
+        except ValueError as e:
+            return json.dumps({u"success": False, u"reason": str(e)})
+        records = query_sensor_log(q.mqtt_topic or None, q.sensor_id or None, date_from, date_to, limit)
+        return to_json({u"success": True, u"records": records}, False)
+
+
+class simulate(ProtectedPage):
+    """
+    What-if simulation of a water tank as json. Query parameters: water_tank_id; optional
+    state levels and <overflow|warning|critical>_sn_percentage_<station> stop percentages
+    overriding the configured ones; the trajectory, either percentages (comma separated),
+    synthetic (sine or ramp, with samples, low, high and periods) or the recorded sensor
+    log of the water tank by default, with interval the seconds between the given percentages
+    (default 60); predictive_lead_minutes; initial state and max_events (default 10000).
+    A trajectory has at most SIMULATION_MAX_SAMPLES percentages, synthetic ones default to
+    SIMULATION_SAMPLES.
+    """
+    LEVELS = [u"overflow_level", u"overflow_safe_level", u"warning_level", u"warning_safe_level", u"critical_level", u"critical_safe_level", u"predictive_lead_minutes"]
+
+    def GET(self):
+        q = web.input(water_tank_id = u"", percentages = u"", synthetic = u"", samples = SIMULATION_SAMPLES, low = 0, high = 100,
+                      periods = 1, state = u"", max_events = 10000, interval = 60)
+        web.header(u"Content-Type", u"application/json")
+        try:
+            d = get_settings()[u"water_tanks"].get(q.water_tank_id)
+            if d is None:
+                return '{"success": false, "reason": "water tank with id [' + str(q.water_tank_id) + '] was not found"}'
+            overrides = {k: v for k, v in q.items() if k in self.LEVELS or u"_sn_percentage_" in k}
+            if q.percentages:
+                trajectory = [float(p) for p in q.percentages.split(u",") if p.strip()]
+                if len(trajectory) > SIMULATION_MAX_SAMPLES:
+                    raise ValueError(u"at most {} percentages can be simulated".format(SIMULATION_MAX_SAMPLES))
+            elif q.synthetic:
+                trajectory = synthetic_trajectory(q.synthetic, int(q.samples), float(q.low), float(q.high), float(q.periods))
+            else:
+                trajectory = None
+            state = WaterTankState[q.state] if q.state else None
+            start = time.monotonic()
+            result = simulate_water_tank(d, overrides, trajectory, state, int(q.max_events), float(q.interval))
+            result[u"seconds"] = round(time.monotonic() - start, 3)
+            result[u"success"] = True
+            return json.dumps(result)
+        except (ValueError, KeyError) as e:
+            return json.dumps({u"success": False, u"reason": str(e)})
+
 
 class csv_sensor_log(ProtectedPage):
     """Simple Log API"""
 
     def GET(self):
-        records = read_sensor_log()
-        data = _("Date, MQTT Topic, MQTT Payload") + "\n"
-        for r in records:
-            event = ast.literal_eval(json.dumps(r))
-            data += (
-                event["date"]
-                + ", "
-                + event["mqtt_topic"]
-                + ", "
-                + event["mqtt_payload"]
-                + "\n"
-            )
-
+        """
+        Stream the log in chunks of lines, the archive may hold many days of records
+        """
         web.header("Content-Type", "text/csv")
-        return data
+        lines = [_("Date, MQTT Topic, MQTT Payload") + "\n"]
+        for r in read_sensor_log():
+            lines.append(r["date"] + ", " + r["mqtt_topic"] + ", " + r["mqtt_payload"] + "\n")
+            if len(lines) >= 1000:
+                yield "".join(lines)
+                lines = []
+        yield "".join(lines)
 
 
 class DeadSensorMonitor(th.Thread):
@@ -2192,17 +4897,32 @@ class DeadSensorMonitor(th.Thread):
         # expires the sensor will not be considered dead. The sensor will be considered
         # dead the next time the timer expires
         while self._timer_runs.is_set():
-            now = datetime.now()
-            # print("Time passed {} secs".format((now - self.last_check_time).total_seconds()))
-            if( (now - self.last_check_time).total_seconds() > self.interval_seconds ):
-                self.last_check_time = now
-                self.check_dead_sensors()
-                # print("DeadSensorMonitor no check for the next {} seconds".format(self.interval_seconds))
+            # the thread also retries subscriptions, sends suppressed notifications and flushes
+            # the archive, so an exception must not end it
+            try:
+                now = datetime.now()
+                # print("Time passed {} secs".format((now - self.last_check_time).total_seconds()))
+                if( (now - self.last_check_time).total_seconds() > self.interval_seconds ):
+                    self.last_check_time = now
+                    self.check_dead_sensors()
+                    # print("DeadSensorMonitor no check for the next {} seconds".format(self.interval_seconds))
+                send_suppressed_notifications()
+                retry_mqtt_subscriptions()
+                self.flush_sensor_log_archive()
+            except Exception as e:
+                log.exception("Exception in the dead sensor monitor. %s", e)
             time.sleep(1)
 
     def stop(self):
         self._timer_runs.clear()
 
+    def flush_sensor_log_archive(self):
+        # a quiet system appends no records that would flush the buffered ones
+        try:
+            sensor_log_archive.FlushIfDue()
+        except Exception as e:
+            log.exception("Could not flush the sensor log archive. %s", e)
+
     def check_dead_sensors(self):
         # print("DeadSensorMonitor.check_dead_sensors()")
         settings = get_settings()
@@ -2214,7 +4934,11 @@ class DeadSensorMonitor(th.Thread):
             if(wt.id not in self.water_tank_checks):
                 # init last_check_time with yesterday's datetime to ensure first check immediately
                 self.water_tank_checks[wt.id] = now - timedelta(days=1)
-            
+
+            if wt.last_updated is None:
+                # no reading since the water tank was saved
+                continue
+
             dateDiff = now - datetime.fromisoformat(wt.last_updated)
             # print("Checking {} for dead sensor. dateDiff {}.".format(wt.label, dateDiff.total_seconds()))
 
@@ -2233,10 +4957,43 @@ class DeadSensorMonitor(th.Thread):
             
 
 
-#  Run when plugin is loaded
-detect_water_tank_js() # add water_tank.js to base.html if ncessary
-load_programs() # in order to load program names in gv.pnames
-subscribe_mqtt()
+dead_sensor_monitor = None  # created by start_plugin
+_plugin_started = False
+
+
+def start_plugin():
+    """
+    Start the background work of the plugin. Importing the module has no other side effects
+    than registering its urls, menu entry and signal handlers, this does the rest, once.
+    """
+    global _plugin_started, notification_outbox, outbox_sender, dead_sensor_monitor
+    if _plugin_started:
+        return
+    _plugin_started = True
+
+    if _log_listener is not None:
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+    state_actor.start()
+    notification_outbox = NotificationOutbox(OUTBOX_FILE)
+    outbox_sender = OutboxSender(notification_outbox, {OUTBOX_EMAIL: email_deliver, OUTBOX_XMPP: xmpp_deliver})
+    outbox_sender.start()
 
-dead_sensor_monitor = DeadSensorMonitor(5) # check for dead sensors every 5 seconds
-dead_sensor_monitor.start()
+    settings = get_settings()
+    apply_log_settings(settings)
+    apply_notification_settings(settings)
+    apply_fill_trend_settings(settings)
+    apply_sensor_log_settings(settings)
+    atexit.register(sensor_log_archive.Flush)
+    detect_water_tank_js() # add water_tank.js to base.html if ncessary
+    load_programs() # in order to load program names in gv.pnames
+    subscribe_mqtt()
+
+    dead_sensor_monitor = DeadSensorMonitor(5) # check for dead sensors every 5 seconds
+    dead_sensor_monitor.start()
+
+
+#  Run when plugin is loaded by SIP. Set WATER_TANK_NO_AUTOSTART to import the module
+#  without starting it, e.g. for tests and benchmarks.
+if not os.environ.get(u"WATER_TANK_NO_AUTOSTART"):
+    start_plugin()